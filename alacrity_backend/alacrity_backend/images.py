@@ -0,0 +1,242 @@
+"""
+Resized derivatives of uploaded profile pictures and organisation images.
+
+The original upload is stored as before; ``process_image`` then writes every
+size in ``VARIANT_SIZES`` for the image's kind, in each of ``FORMATS``, under
+a key made from the SHA-256 of the original::
+
+    images/<sha256>/<size>.<format>
+
+A key always holds the same bytes, so the objects are served with a one year
+``Cache-Control: immutable`` and a new picture gets new URLs instead of waiting
+for caches to expire. Avatars are cropped square; cover images keep their
+aspect ratio and are only limited in width. Nothing is scaled up.
+
+Originals are stored under a content-addressed key too (``store_original``),
+so replacing a picture changes its URL.
+
+Processing runs on a small thread pool (``IMAGE_DERIVATIVE_WORKERS``) after the
+upload request has been answered; with 0 workers it runs in the request. Until
+the variants exist, and for images uploaded before this pipeline, serializers
+fall back to the original (see ``variant_url``), as they do for a format the
+installed Pillow cannot write (AVIF needs Pillow 11.2 or later, see
+``available_formats``) or a variant that fails to encode; the other variants
+are stored regardless. ``ImageVariantsMixin`` picks
+the size a serializer returns. ``generate_image_variants``
+processes existing images.
+"""
+
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, features
+from rest_framework import serializers
+
+from alacrity_backend import storage
+
+
+logger = logging.getLogger(__name__)
+
+KIND_AVATAR = 'avatar'
+KIND_COVER = 'cover'
+# size name -> pixels: the side of a square avatar, the maximum width of a cover image
+VARIANT_SIZES = {
+    KIND_AVATAR: {'thumb': 64, 'small': 128, 'medium': 256, 'large': 512},
+    KIND_COVER: {'medium': 960, 'large': 1920},
+}
+# the preferred format first; WebP is the fallback every browser decodes
+FORMATS = {'avif': {'quality': 60}, 'webp': {'quality': 80, 'method': 4}}
+DEFAULT_FORMAT = 'webp'
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+MAX_PIXELS = 40_000_000
+
+
+def variant_key(digest, size, image_format):
+    return f"images/{digest}/{size}.{image_format}"
+
+
+def store_original(prefix, uploaded_file):
+    """
+    Store an uploaded image under ``<prefix>/<hash>.<extension>``.
+    Args:
+        prefix (str): E.g. ``profile_pictures/<user id>``.
+        uploaded_file (UploadedFile): The image from ``request.FILES``.
+    Returns:
+        tuple: The URL of the stored original and its bytes.
+    """
+    data = uploaded_file.read()
+    extension = uploaded_file.name.split('.')[-1] if '.' in uploaded_file.name else 'png'
+    key = f"{prefix}/{hashlib.sha256(data).hexdigest()[:32]}.{extension}"
+    storage.put_object(
+        key, io.BytesIO(data), length=len(data), content_type=uploaded_file.content_type,
+        metadata={"Cache-Control": CACHE_CONTROL},
+    )
+    return storage.object_url(key), data
+
+
+def available_formats():
+    """The entries of ``FORMATS`` the installed Pillow can encode, in order of preference."""
+    return [image_format for image_format in FORMATS if features.check(image_format)]
+
+
+def _encode(image, image_format):
+    out = io.BytesIO()
+    image.save(out, format=image_format.upper(), **FORMATS[image_format])
+    return out.getvalue()
+
+
+def _resize(image, kind, pixels):
+    if kind == KIND_AVATAR:
+        side = min(pixels, image.width, image.height)
+        return ImageOps.fit(image, (side, side), Image.Resampling.LANCZOS)
+    if image.width <= pixels:
+        return image.copy()
+    return image.resize((pixels, round(image.height * pixels / image.width)), Image.Resampling.LANCZOS)
+
+
+def render_variants(data, kind):
+    """
+    Encode every variant of an image. A variant that cannot be encoded is left
+    out and logged; the others are still returned.
+    Args:
+        data (bytes): The uploaded image.
+        kind (str): ``KIND_AVATAR`` or ``KIND_COVER``.
+    Returns:
+        dict: ``{size: {format: bytes}}``, without the sizes none of whose formats could be encoded.
+    Raises:
+        PIL.UnidentifiedImageError: If the data is not an image Pillow can read.
+        ValueError: If the image has more than ``MAX_PIXELS`` pixels.
+    """
+    with Image.open(io.BytesIO(data)) as opened:
+        if opened.width * opened.height > MAX_PIXELS:
+            raise ValueError(f"Image is too large ({opened.width}x{opened.height})")
+        image = ImageOps.exif_transpose(opened)
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+    formats = available_formats()
+    variants = {}
+    for size, pixels in VARIANT_SIZES[kind].items():
+        resized = _resize(image, kind, pixels)
+        encoded = {}
+        for image_format in formats:
+            try:
+                encoded[image_format] = _encode(resized, image_format)
+            except Exception as e:
+                logger.warning(f"Could not encode the {size} {image_format} variant: {e}")
+        if encoded:
+            variants[size] = encoded
+    return variants
+
+
+def process_image(data, kind):
+    """
+    Store every variant of an image under its content-addressed keys.
+    Returns:
+        dict: ``{size: {format: url}}``, the value kept in the ``*_variants`` fields.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    urls = {}
+    for size, formats in render_variants(data, kind).items():
+        urls[size] = {}
+        for image_format, encoded in formats.items():
+            key = variant_key(digest, size, image_format)
+            storage.put_object(
+                key, io.BytesIO(encoded), length=len(encoded), content_type=f"image/{image_format}",
+                metadata={"Cache-Control": CACHE_CONTROL},
+            )
+            urls[size][image_format] = storage.object_url(key)
+    return urls
+
+
+def variant_url(original, variants, kind, size, image_format=DEFAULT_FORMAT):
+    """
+    The URL of the variant closest to ``size`` (the next larger one, else the
+    largest), or the original when there are no variants yet.
+    Args:
+        original (str): The stored URL of the original image.
+        variants (dict): ``{size: {format: url}}`` from ``process_image``.
+        kind (str): ``KIND_AVATAR`` or ``KIND_COVER``.
+        size (str): One of the size names of ``kind``.
+    """
+    if not variants:
+        return original
+    names = list(VARIANT_SIZES[kind])
+    start = names.index(size) if size in names else 0
+    for name in names[start:] + names[:start][::-1]:
+        if image_format in variants.get(name, {}):
+            return variants[name][image_format]
+    return original
+
+
+class ImageVariantsMixin:
+    """
+    Serializer mixin that returns the variant of each image field that fits
+    where it is shown, plus the ``<field>_variants`` for ``srcset``/``<picture>``.
+
+    ``image_fields`` maps a field to ``(kind, size in lists, size on its own)``;
+    ``image_size`` in the serializer context overrides the size.
+    """
+    image_fields = {}
+
+    def to_representation(self, instance):
+        ret = super().to_representation(instance)
+        in_list = isinstance(self.parent, serializers.ListSerializer)
+        for field, (kind, list_size, detail_size) in self.image_fields.items():
+            if field not in ret:
+                continue
+            variants = getattr(instance, f"{field}_variants", None) or {}
+            size = self.context.get('image_size') or (list_size if in_list else detail_size)
+            ret[field] = variant_url(getattr(instance, field), variants, kind, size)
+            ret[f"{field}_variants"] = variants
+        return ret
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_workers(), thread_name_prefix="image-variants")
+        return _executor
+
+
+def _workers():
+    return int(getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2))
+
+
+def _process_and_save(queryset, url_field, variants_field, original_url, data, kind, in_worker):
+    try:
+        variants = process_image(data, kind)
+        # a picture replaced in the meantime keeps the variants of its own upload
+        updated = queryset.filter(**{url_field: original_url}).update(**{variants_field: variants})
+        logger.info(f"Stored {kind} variants for {updated} row(s) of {queryset.model.__name__}")
+    except Exception as e:
+        logger.warning(f"Could not create {kind} variants of {original_url}: {e}", exc_info=True)
+    finally:
+        if in_worker:
+            close_old_connections()
+
+
+def schedule_variants(instance, url_field, variants_field, data, kind):
+    """
+    Create the variants of an image just stored in ``instance.<url_field>`` and
+    save them to ``instance.<variants_field>``, once the current transaction has committed.
+    Args:
+        instance (Model): The saved user or organisation.
+        data (bytes): The uploaded image.
+        kind (str): ``KIND_AVATAR`` or ``KIND_COVER``.
+    """
+    queryset = type(instance).objects.filter(pk=instance.pk)
+    original_url = getattr(instance, url_field)
+    arguments = (queryset, url_field, variants_field, original_url, data, kind)
+    if _workers() <= 0:
+        transaction.on_commit(lambda: _process_and_save(*arguments, in_worker=False))
+    else:
+        transaction.on_commit(lambda: _get_executor().submit(_process_and_save, *arguments, in_worker=True))
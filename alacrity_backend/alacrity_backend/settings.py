@@ -18,7 +18,6 @@ from pathlib import Path
 from alacrity_backend.config import FRONTEND_URL, BACKEND_URL
 import os
 import sys
-from minio import Minio
 from dotenv import load_dotenv
 
 
@@ -191,17 +190,42 @@ MINIO_SECRET_KEY = "Notgood1"
 MINIO_BUCKET_NAME = "alacrity"
 MINIO_SECURE = False
 
-# MINIO CLIENT
-minioClient = Minio(
-    MINIO_URL,
-    access_key=MINIO_ACCESS_KEY,
-    secret_key=MINIO_SECRET_KEY,
-    secure=MINIO_SECURE
-)
+# Object storage client (alacrity_backend/storage.py): one pooled client per process
+STORAGE_POOL_SIZE = int(os.getenv('STORAGE_POOL_SIZE', 32))  # connections kept open to MinIO
+STORAGE_CONNECT_TIMEOUT = float(os.getenv('STORAGE_CONNECT_TIMEOUT', 5))  # seconds
+STORAGE_READ_TIMEOUT = float(os.getenv('STORAGE_READ_TIMEOUT', 60))  # seconds
+STORAGE_RETRIES = int(os.getenv('STORAGE_RETRIES', 5))  # on connection errors and 5xx responses
+STORAGE_RETRY_BACKOFF = float(os.getenv('STORAGE_RETRY_BACKOFF', 0.5))  # seconds, doubled on each retry
+# `manage.py sweep_orphaned_objects` (datasets/reconcile.py) deletes unreferenced objects older than this.
+STORAGE_ORPHAN_GRACE = int(os.getenv('STORAGE_ORPHAN_GRACE', 86400))  # seconds
 
 DEFAULT_FILE_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
 DATA_UPLOAD_MAX_MEMORY_SIZE = 524288000  # 500MB
-FILE_UPLOAD_MAX_MEMORY_SIZE = 524288000  # 500MB
+# uploads bigger than this are spooled to a temporary file instead of being held in memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', 10485760))  # 10MB
+
+# Streaming dataset ingest: peak memory per upload is roughly the sum of these, plus the row group being
+# buffered (at most 4 blocks, see datasets/parquet_profiles.py)
+DATASET_INGEST_BLOCK_SIZE = int(os.getenv('DATASET_INGEST_BLOCK_SIZE', 8388608))  # 8MB of CSV per record batch
+DATASET_INGEST_PART_SIZE = int(os.getenv('DATASET_INGEST_PART_SIZE', 16777216))  # 16MB multipart parts (min 5MB)
+DATASET_ENCRYPTION_SEGMENT_SIZE = int(os.getenv('DATASET_ENCRYPTION_SEGMENT_SIZE', 4194304))  # 4MB per encrypted segment
+DATASET_ENCRYPTION_WORKERS = int(os.getenv('DATASET_ENCRYPTION_WORKERS', os.cpu_count() or 1))  # segments sealed/opened in parallel
+# Parquet write profile for stored datasets: fast-ingest, balanced, archival, or auto to choose by upload size
+DATASET_PARQUET_PROFILE = os.getenv('DATASET_PARQUET_PROFILE', 'auto')
+# Charset detection reads a head, middle and tail window of this size, and at most
+# DATASET_CHARSET_MAX_SCAN bytes in total when the first guess is not confident
+DATASET_CHARSET_SAMPLE_SIZE = int(os.getenv('DATASET_CHARSET_SAMPLE_SIZE', 65536))  # 64KB
+DATASET_CHARSET_MAX_SCAN = int(os.getenv('DATASET_CHARSET_MAX_SCAN', 8388608))  # 8MB
+# Google Drive / Dropbox imports are fetched as parallel Range requests of this size
+DATASET_DOWNLOAD_CHUNK_SIZE = int(os.getenv('DATASET_DOWNLOAD_CHUNK_SIZE', 8388608))  # 8MB
+DATASET_DOWNLOAD_WORKERS = int(os.getenv('DATASET_DOWNLOAD_WORKERS', 4))
+DATASET_DOWNLOAD_RETRIES = int(os.getenv('DATASET_DOWNLOAD_RETRIES', 3))  # per range, resuming from the last byte
+# Value counts kept per text column in the stored dataset profile
+DATASET_PROFILE_TOP_K = int(os.getenv('DATASET_PROFILE_TOP_K', 50))
+# Store ingested columns with the tightest safe types (int8/16/32, float32, date, category)
+DATASET_OPTIMIZE_TYPES = os.getenv('DATASET_OPTIMIZE_TYPES', 'true').lower() == 'true'
+# Text columns with at most this many distinct values are dictionary-encoded
+DATASET_DICTIONARY_MAX_CARDINALITY = int(os.getenv('DATASET_DICTIONARY_MAX_CARDINALITY', 1000))
 
 AWS_ACCESS_KEY_ID = MINIO_ACCESS_KEY
 AWS_SECRET_ACCESS_KEY = MINIO_SECRET_KEY
@@ -295,6 +319,57 @@ print("DEFAULT_FROM_EMAIL", DEFAULT_FROM_EMAIL)
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# Dataset ingestion jobs: uploads are staged in MinIO (uploads/) until an ingest worker on any host
+# picks them up; the worker keeps its temporary copies in DATASET_INGEST_STAGING_DIR, which need not be shared.
+# Workers run as threads in the web process, or separately with `manage.py run_ingest_workers`
+# (set DATASET_INGEST_WORKERS=0 to only use the separate process).
+DATASET_INGEST_STAGING_DIR = os.getenv('DATASET_INGEST_STAGING_DIR', os.path.join(BASE_DIR, "ingest_staging"))
+DATASET_INGEST_WORKERS = int(os.getenv('DATASET_INGEST_WORKERS', 2))
+DATASET_INGEST_STALE_AFTER = int(os.getenv('DATASET_INGEST_STALE_AFTER', 600))  # seconds without a heartbeat
+DATASET_INGEST_MAX_ATTEMPTS = int(os.getenv('DATASET_INGEST_MAX_ATTEMPTS', 3))  # claims before a stale job is failed
+
+# Direct-to-storage uploads (datasets/uploads.py): the browser PUTs parts of this size to presigned
+# MinIO URLs that stay valid for DATASET_UPLOAD_EXPIRY seconds; unfinished sessions are aborted after that.
+DATASET_UPLOAD_PART_SIZE = int(os.getenv('DATASET_UPLOAD_PART_SIZE', 67108864))  # 64MB (min 5MB)
+DATASET_UPLOAD_EXPIRY = int(os.getenv('DATASET_UPLOAD_EXPIRY', 21600))  # 6 hours
+# Resumable uploads through the API are forwarded to MinIO in chunks of this size, each held in memory once.
+DATASET_RESUMABLE_CHUNK_SIZE = int(os.getenv('DATASET_RESUMABLE_CHUNK_SIZE', 8388608))  # 8MB (min 5MB)
+
+# Node-local disk cache of the encrypted dataset objects, shared by every worker process on the host.
+# Entries are keyed by object key and ETag and evicted least recently used first; fill it with
+# `manage.py warm_object_cache`.
+DATASET_OBJECT_CACHE_ENABLED = os.getenv('DATASET_OBJECT_CACHE_ENABLED', 'true').lower() == 'true'
+DATASET_OBJECT_CACHE_DIR = os.getenv('DATASET_OBJECT_CACHE_DIR', os.path.join(BASE_DIR, "object_cache"))
+DATASET_OBJECT_CACHE_MAX_BYTES = int(os.getenv('DATASET_OBJECT_CACHE_MAX_BYTES', 10737418240))  # 10GB
+# In-memory copies of datasets shared by the analysis endpoints (datasets/dataset_cache.py), one per
+# dataset version and variant in each process. Least recently used copies are evicted beyond the byte
+# budget or after the idle TTL (0: never), except for pinned datasets; evictions are saved as CacheEviction rows.
+DATASET_CACHE_MAX_BYTES = int(os.getenv('DATASET_CACHE_MAX_BYTES', 4294967296))  # 4GB
+DATASET_CACHE_IDLE_TTL = int(os.getenv('DATASET_CACHE_IDLE_TTL', 3600))  # seconds
+DATASET_CACHE_PINNED = [d for d in os.getenv('DATASET_CACHE_PINNED', '').split(',') if d]  # dataset ids
+# Decoded tables shared by every process on the host as Arrow IPC files on a tmpfs (datasets/shared_store.py),
+# memory-mapped instead of decoded and held once per process. Least recently used files go beyond the budget.
+DATASET_SHARED_STORE_ENABLED = os.getenv('DATASET_SHARED_STORE_ENABLED', 'true').lower() == 'true'
+DATASET_SHARED_STORE_DIR = os.getenv('DATASET_SHARED_STORE_DIR', '')  # default /dev/shm/alacrity_datasets
+DATASET_SHARED_STORE_MAX_BYTES = int(os.getenv('DATASET_SHARED_STORE_MAX_BYTES', 4294967296))  # 4GB
+# Datasets loaded into the cache in the background when access is granted, when they are bought and when
+# their user opens another dataset (datasets/prefetch.py), only while no request has used the cache for
+# DATASET_PREFETCH_QUIET seconds. Prefetched copies never evict others nor take the cache beyond
+# DATASET_PREFETCH_MAX_BYTES (0: half of DATASET_CACHE_MAX_BYTES).
+DATASET_PREFETCH_ENABLED = os.getenv('DATASET_PREFETCH_ENABLED', 'true').lower() == 'true'
+DATASET_PREFETCH_QUIET = int(os.getenv('DATASET_PREFETCH_QUIET', 5))  # seconds
+DATASET_PREFETCH_RECENT = int(os.getenv('DATASET_PREFETCH_RECENT', 3))  # recently opened datasets per user
+DATASET_PREFETCH_MAX_BYTES = int(os.getenv('DATASET_PREFETCH_MAX_BYTES', 0))
+# Threads that resize uploaded profile pictures and organisation images (alacrity_backend/images.py);
+# 0 resizes in the upload request.
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv('IMAGE_DERIVATIVE_WORKERS', 2))
+if 'test' in sys.argv:
+    DATASET_INGEST_WORKERS = 0
+    IMAGE_DERIVATIVE_WORKERS = 0
+    DATASET_OBJECT_CACHE_ENABLED = False
+    DATASET_SHARED_STORE_ENABLED = False
+    DATASET_PREFETCH_ENABLED = False
+
 if DEBUG:
     import mimetypes
     mimetypes.add_type("application/javascript", ".js", True)
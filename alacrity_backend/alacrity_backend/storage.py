@@ -0,0 +1,289 @@
+"""
+Object storage (MinIO) shared by every app.
+
+There is one ``Minio`` client per process (``client``), over a urllib3 pool
+sized for the request threads, ingest workers and download workers that use it
+at the same time. Requests time out (``STORAGE_CONNECT_TIMEOUT`` and
+``STORAGE_READ_TIMEOUT``) instead of hanging for the client's default five
+minutes. Connection errors and 5xx responses (503 ``SlowDown`` included) are
+retried ``STORAGE_RETRIES`` times with exponential backoff, honouring
+``Retry-After``.
+
+Browsers upload large files straight to the bucket: ``create_multipart_upload``
+starts a multipart upload, ``presigned_part_url`` signs a URL the browser PUTs
+one part to, and ``complete_multipart_upload`` joins the parts into the object.
+``upload_part`` sends a part from the server, for clients that cannot reach
+MinIO themselves. minio-py has no public API for multipart uploads driven part
+by part, so these wrap its underscored methods; ``requirements.txt`` pins minio
+to the releases they were tested with. ``list_objects`` pages through the bucket for the orphan
+sweeper (``datasets/reconcile.py``).
+
+Objects are addressed by key. ``object_key`` takes a stored link in any form
+(``http://host/bucket/key``, ``https://...``, ``s3://bucket/key`` or a bare key),
+and ``object_url`` builds the link stored for a new object.
+
+The ``a``-prefixed functions (``aget_object``, ``astream_object``, ...) are the
+asyncio API for async views and consumers. They run the blocking client on a
+dedicated thread pool as large as the connection pool, so the event loop never
+waits on storage and async callers cannot exhaust the default executor.
+"""
+
+import asyncio
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import unquote
+
+import certifi
+import urllib3
+from django.conf import settings
+from minio import Minio
+from minio.datatypes import Part
+from minio.deleteobjects import DeleteObject
+from urllib3.util import Retry, Timeout
+
+from alacrity_backend.settings import MINIO_ACCESS_KEY, MINIO_BUCKET_NAME, MINIO_SECRET_KEY, MINIO_SECURE, MINIO_URL
+
+
+BUCKET = MINIO_BUCKET_NAME
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+_SCHEME_AND_HOST = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*://[^/]*")
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def get_pool_size():
+    return int(_setting('STORAGE_POOL_SIZE', 32))
+
+
+def create_http_client():
+    """The tuned urllib3 pool the storage client uses."""
+    return urllib3.PoolManager(
+        num_pools=4,
+        maxsize=get_pool_size(),
+        timeout=Timeout(
+            connect=float(_setting('STORAGE_CONNECT_TIMEOUT', 5)),
+            read=float(_setting('STORAGE_READ_TIMEOUT', 60)),
+        ),
+        retries=Retry(
+            total=int(_setting('STORAGE_RETRIES', 5)),
+            backoff_factor=float(_setting('STORAGE_RETRY_BACKOFF', 0.5)),
+            status_forcelist=[500, 502, 503, 504],
+            respect_retry_after_header=True,
+        ),
+        cert_reqs='CERT_REQUIRED',
+        ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+    )
+
+
+client = Minio(
+    endpoint=MINIO_URL,
+    access_key=MINIO_ACCESS_KEY,
+    secret_key=MINIO_SECRET_KEY,
+    secure=MINIO_SECURE,
+    http_client=create_http_client(),
+)
+
+
+def object_key(link):
+    """
+    The object key of a stored link, whatever its scheme.
+    Args:
+        link (str): ``http(s)://<host>/<bucket>/<key>``, ``s3://<bucket>/<key>`` or a key.
+    Returns:
+        str: The key within ``BUCKET``.
+    """
+    path = unquote(_SCHEME_AND_HOST.sub("", link, count=1)).lstrip("/")
+    if path.startswith(f"{BUCKET}/"):
+        return path[len(BUCKET) + 1:]
+    marker = f"/{BUCKET}/"
+    if marker in path:
+        # a link stored without a scheme: <host>/<bucket>/<key>
+        return path.split(marker, 1)[1]
+    return path
+
+
+def object_url(key):
+    """The link stored for the object ``key`` (see ``object_key``)."""
+    return f"{'https' if MINIO_SECURE else 'http'}://{MINIO_URL}/{BUCKET}/{key}"
+
+
+def get_object(key, offset=0, length=None):
+    """
+    Read an object, or ``length`` bytes of it from ``offset``.
+    Returns:
+        bytes: The data read.
+    """
+    response = client.get_object(bucket_name=BUCKET, object_name=key, offset=offset, length=length)
+    try:
+        return response.read()
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def stream_object(key, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield an object in chunks of up to ``chunk_size`` bytes."""
+    response = client.get_object(bucket_name=BUCKET, object_name=key)
+    try:
+        yield from response.stream(chunk_size)
+    finally:
+        response.close()
+        response.release_conn()
+
+
+def stat_object(key):
+    """The object's metadata (``size``, ``etag``, ...)."""
+    return client.stat_object(BUCKET, key)
+
+
+def put_object(key, data, length=-1, part_size=0, content_type="application/octet-stream", metadata=None):
+    """
+    Upload an object from a file-like ``data``. With ``length=-1`` the data is
+    streamed as a multipart upload in parts of ``part_size`` bytes. ``metadata``
+    holds extra headers served with the object, such as ``Cache-Control``.
+    """
+    return client.put_object(
+        bucket_name=BUCKET,
+        object_name=key,
+        data=data,
+        length=length,
+        part_size=part_size,
+        content_type=content_type,
+        metadata=metadata,
+    )
+
+
+def remove_object(key):
+    client.remove_object(BUCKET, key)
+
+
+def list_objects(prefix="", start_after=None):
+    """
+    Iterate over the objects under ``prefix`` in key order, starting after the
+    key ``start_after``. Pages of up to 1000 keys are fetched as the iterator is consumed.
+    """
+    return client.list_objects(BUCKET, prefix=prefix or None, recursive=True, start_after=start_after)
+
+
+def remove_objects(keys):
+    """
+    Delete several objects in one request per 1000 keys.
+    Returns:
+        list: The keys that could not be deleted.
+    """
+    return [error.name for error in client.remove_objects(BUCKET, [DeleteObject(key) for key in keys])]
+
+
+def create_multipart_upload(key, content_type="application/octet-stream"):
+    """
+    Start a multipart upload of ``key`` whose parts are sent by someone else.
+    Returns:
+        str: The upload id.
+    """
+    return client._create_multipart_upload(BUCKET, key, {"Content-Type": content_type})
+
+
+def presigned_part_url(key, upload_id, part_number, expires=timedelta(hours=6)):
+    """A URL that accepts one ``PUT`` of part ``part_number`` without credentials."""
+    return client.get_presigned_url(
+        "PUT", BUCKET, key, expires=expires,
+        extra_query_params={"uploadId": upload_id, "partNumber": str(part_number)},
+    )
+
+
+def upload_part(key, upload_id, part_number, data):
+    """
+    Upload one part of a multipart upload from the server.
+    Returns:
+        str: The part's ETag.
+    """
+    return client._upload_part(BUCKET, key, data, None, upload_id, part_number)
+
+
+def list_parts(key, upload_id):
+    """
+    The parts uploaded so far.
+    Returns:
+        list: ``(part number, etag, size)`` in part number order.
+    """
+    parts = []
+    marker = None
+    while True:
+        result = client._list_parts(BUCKET, key, upload_id, part_number_marker=marker)
+        parts.extend((part.part_number, part.etag, part.size) for part in result.parts)
+        if not result.is_truncated:
+            return parts
+        marker = result.next_part_number_marker
+
+
+def complete_multipart_upload(key, upload_id, parts):
+    """
+    Join uploaded parts into the object.
+    Args:
+        parts (list): ``(part number, etag)`` pairs, in part number order.
+    """
+    return client._complete_multipart_upload(
+        BUCKET, key, upload_id, [Part(part_number, etag) for part_number, etag in parts],
+    )
+
+
+def abort_multipart_upload(key, upload_id):
+    """Discard a multipart upload and the parts sent for it."""
+    client._abort_multipart_upload(BUCKET, key, upload_id)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=get_pool_size(), thread_name_prefix="storage")
+        return _executor
+
+
+async def _run(function, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), lambda: function(*args, **kwargs))
+
+
+async def aget_object(key, offset=0, length=None):
+    """Async :func:`get_object`."""
+    return await _run(get_object, key, offset=offset, length=length)
+
+
+async def astream_object(key, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Async :func:`stream_object`: an async iterator over the object's chunks."""
+    response = await _run(client.get_object, bucket_name=BUCKET, object_name=key)
+    try:
+        chunks = iter(response.stream(chunk_size))
+        while True:
+            chunk = await _run(next, chunks, None)
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        response.close()
+        response.release_conn()
+
+
+async def astat_object(key):
+    """Async :func:`stat_object`."""
+    return await _run(stat_object, key)
+
+
+async def aput_object(key, data, length=-1, part_size=0, content_type="application/octet-stream"):
+    """Async :func:`put_object`."""
+    return await _run(put_object, key, data, length=length, part_size=part_size, content_type=content_type)
+
+
+async def aremove_object(key):
+    """Async :func:`remove_object`."""
+    return await _run(remove_object, key)
@@ -6,6 +6,7 @@ from payments.models import DatasetPurchase
 from users.decorators import role_required
 from .models import DatasetRequest
 from datasets.models import Dataset
+from datasets.prefetch import schedule_prefetch
 from users.models import User
 from rest_framework.decorators import api_view
 from django.shortcuts import get_object_or_404
@@ -262,6 +263,8 @@ class request_actions(APIView):
 
                 dataset.view_count = approved_count
                 dataset.save()
+                # load it before the researcher opens it
+                schedule_prefetch([dataset.dataset_id], "request approved")
             except Dataset.DoesNotExist:
                 return Response({'error': 'Dataset does not exist'}, status=status.HTTP_404_NOT_FOUND)
 
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class DatasetsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'datasets'
+
+    def ready(self):
+        # registers the handler that releases stored objects when dataset parts are deleted
+        from . import dedup  # noqa: F401
+        # registers the handler that queues recently opened datasets for prefetching
+        from . import prefetch  # noqa: F401
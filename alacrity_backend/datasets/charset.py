@@ -0,0 +1,144 @@
+"""
+Charset detection for dataset uploads.
+
+Running ``charset_normalizer.detect`` over a whole upload is slow for large
+files and needs all of it in memory. Instead we detect on a few bounded windows
+(head, middle and tail of the file) and only widen the scan to more windows when
+the detector is not confident. Candidate encodings are then checked against the
+same windows, so encodings that obviously cannot decode the file are dropped
+before the ingest pipeline ever reads it.
+"""
+
+import codecs
+import io
+import logging
+
+from charset_normalizer import detect
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_ENCODINGS = ['utf-8', 'latin1', 'windows-1252']
+CONFIDENCE_THRESHOLD = 0.8
+DEFAULT_SAMPLE_SIZE = 64 * 1024
+DEFAULT_MAX_SCAN = 8 * 1024 * 1024
+
+
+def get_sample_size():
+    return int(getattr(settings, 'DATASET_CHARSET_SAMPLE_SIZE', DEFAULT_SAMPLE_SIZE))
+
+
+def get_max_scan():
+    return int(getattr(settings, 'DATASET_CHARSET_MAX_SCAN', DEFAULT_MAX_SCAN))
+
+
+def _file_size(source):
+    source.seek(0, io.SEEK_END)
+    size = source.tell()
+    source.seek(0)
+    return size
+
+
+def _read_window(source, offset, length, size):
+    """
+    Read one window and trim it to whole lines, so multi-byte characters are
+    never cut in half at the window edges.
+    """
+    source.seek(offset)
+    window = source.read(length)
+    if offset > 0:
+        newline = window.find(b"\n")
+        window = window[newline + 1:] if newline != -1 else b""
+    if offset + length < size:
+        newline = window.rfind(b"\n")
+        window = window[:newline + 1] if newline != -1 else b""
+    return window
+
+
+def read_samples(source, windows=3, sample_size=None):
+    """
+    Read evenly spaced windows from a file.
+    Args:
+        source: A seekable binary file object.
+        windows (int): Number of windows; the first is always the head and the
+            last always the tail of the file.
+        sample_size (int, optional): Bytes per window.
+    Returns:
+        list: The sampled byte strings (the whole file if it is small enough).
+    """
+    sample_size = sample_size or get_sample_size()
+    size = _file_size(source)
+    try:
+        if size <= sample_size * windows:
+            return [source.read()]
+        step = (size - sample_size) / (windows - 1)
+        offsets = [int(step * index) for index in range(windows)]
+        return [_read_window(source, offset, sample_size, size) for offset in offsets]
+    finally:
+        source.seek(0)
+
+
+def _normalise(encoding):
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return None
+    # a file that only looks ascii in the samples may still contain utf-8 further on
+    return 'utf-8' if name == 'ascii' else name
+
+
+def _decodes(encoding, samples):
+    try:
+        for sample in samples:
+            sample.decode(encoding)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def _detect(samples):
+    detection = detect(b"".join(samples))
+    return detection.get('encoding'), detection.get('confidence') or 0
+
+
+def detect_encodings(source):
+    """
+    Work out which encodings to try for an upload, most likely first.
+
+    The detector sees only the sampled windows. When its confidence is low it is
+    run again over a wider spread of windows, capped at ``DATASET_CHARSET_MAX_SCAN``
+    bytes. Candidates that fail to decode the samples are dropped.
+    Args:
+        source: A seekable binary file object.
+    Returns:
+        list: Encodings to try. Never empty for a non-empty file.
+    """
+    sample_size = get_sample_size()
+    samples = read_samples(source, windows=3, sample_size=sample_size)
+    if not any(samples):
+        return []
+
+    detected_encoding, confidence = _detect(samples)
+    logger.info(f"Detected encoding: {detected_encoding} with confidence: {confidence} (sampled)")
+
+    if detected_encoding is None or confidence < CONFIDENCE_THRESHOLD:
+        windows = max(3, get_max_scan() // sample_size)
+        wider = read_samples(source, windows=windows, sample_size=sample_size)
+        if sum(map(len, wider)) > sum(map(len, samples)):
+            samples = wider
+            detected_encoding, confidence = _detect(samples)
+            logger.info(f"Detected encoding: {detected_encoding} with confidence: {confidence} (wider scan)")
+
+    if detected_encoding is None or confidence < CONFIDENCE_THRESHOLD:
+        logger.warning("Low confidence in encoding detection, attempting common encodings")
+        candidates = list(FALLBACK_ENCODINGS)
+    else:
+        candidates = [detected_encoding] + FALLBACK_ENCODINGS
+
+    encodings_to_try = []
+    for encoding in candidates:
+        name = _normalise(encoding)
+        if name and name not in encodings_to_try and _decodes(name, samples):
+            encodings_to_try.append(name)
+    return encodings_to_try or ['latin1']
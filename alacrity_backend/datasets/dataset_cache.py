@@ -0,0 +1,418 @@
+"""
+In-memory copies of the datasets the analysis endpoints (``new.py``) query.
+
+There is one copy per ``(dataset_id, version, variant)``, shared by every user
+who analyses the dataset. The variant is ``raw`` or ``normalized`` (duplicates
+and rows with missing values removed). Only the raw copy is read from storage:
+the normalized copy is computed from it by DuckDB the first time it is asked
+for and cached next to it, so switching between the two costs no I/O and
+cleaning runs once per version. A copy is a table nobody writes to;
+``get_cursor`` gives each request a DuckDB cursor of its own with the copy
+registered as ``temp``, so requests share the data but no connection state and
+can query at the same time. The cache does not know who may read a dataset:
+the views check access on every request before asking for a cursor.
+
+A new version of a dataset is a new key. When an earlier raw copy is cached
+and the new version only appends parts to it, the copy is extended with the
+new parts instead of being reloaded, and the earlier version is dropped. The
+normalized copy of the new version is computed again from the extended one.
+
+Loading is single-flight per key: the first request for a copy that is not
+cached loads it, without holding ``CACHE_LOCK``; requests for the same copy
+wait for that load and get its result (or its error), while requests for other
+datasets, cached or not, carry on. ``CACHE_LOCK`` only guards the bookkeeping.
+
+The cache is limited by memory, not by a number of entries. Each copy is
+measured once it is loaded (``table_bytes``, strings included), and while the
+copies take more than ``DATASET_CACHE_MAX_BYTES`` the least recently used one
+is evicted. Copies unused for ``DATASET_CACHE_IDLE_TTL`` seconds are evicted
+too. Datasets listed in ``DATASET_CACHE_PINNED``, or pinned at run time with
+``pin_dataset``, are never evicted for space or idleness; a copy larger than
+the whole budget is served to its request but not kept, unless it is pinned.
+
+Every eviction is saved as a ``CacheEviction`` row with its reason, size, age
+and hits, and ``stats`` gives the counters of this process.
+
+Copies can also be loaded ahead of the first request (``prefetch.py``). A
+prefetched copy never evicts another: it is kept only while the cache holds no
+more than ``DATASET_PREFETCH_MAX_BYTES``, and prefetches neither count as use
+of a copy nor end a quiet period (``is_quiet``).
+
+Copies are Arrow tables, as read from the Parquet parts, and DuckDB scans
+them in place: nothing is converted to pandas on the way in, and the
+endpoints fetch query results, not the table. With the shared store enabled
+(``shared_store.py``) a copy is not decoded per process either: it is
+memory-mapped from the host's tmpfs, written by the first process that needed it.
+Evicting such a copy here only unmaps it in this process; it is still counted
+at its full size, as the pages are resident while any process maps them.
+"""
+
+import logging
+import os
+import socket
+import time
+from collections import Counter, OrderedDict
+from threading import Event, Lock
+
+import duckdb
+import pyarrow as pa
+from django.conf import settings
+
+from .models import CacheEviction
+from .dtypes import conform_table
+from .profiling import cleaned_query
+from .shared_store import get_shared_store
+from .versions import get_parts, parts_schema, read_parts
+
+
+logger = logging.getLogger(__name__)
+
+VARIANT_RAW = "raw"
+VARIANT_NORMALIZED = "normalized"
+DEFAULT_MAX_BYTES = 4 * 1024 * 1024 * 1024
+DEFAULT_IDLE_TTL = 60 * 60
+
+DATASET_CACHE = OrderedDict()
+# guards the bookkeeping only (DATASET_CACHE, _flights, the counters); copies are loaded without it
+CACHE_LOCK = Lock()
+# key -> the _Flight loading it
+_flights = {}
+# datasets pinned at run time, in addition to DATASET_CACHE_PINNED
+_pinned = set()
+_counters = Counter()
+_evicted_bytes = Counter()
+# when a request last asked for a copy, for is_quiet
+_last_request = 0.0
+
+# the cursors of every request are opened on this one in-memory database
+_database = duckdb.connect(":memory:")
+
+
+def get_max_bytes():
+    return int(getattr(settings, 'DATASET_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+
+
+def get_idle_ttl():
+    """Seconds an unused copy is kept; 0 keeps copies until they are evicted for space."""
+    return float(getattr(settings, 'DATASET_CACHE_IDLE_TTL', DEFAULT_IDLE_TTL))
+
+
+def get_prefetch_max_bytes():
+    """The most the cache may hold after a prefetch; half the cache by default."""
+    return int(getattr(settings, 'DATASET_PREFETCH_MAX_BYTES', None) or get_max_bytes() // 2)
+
+
+def is_pinned(dataset_id):
+    return dataset_id in _pinned or dataset_id in getattr(settings, 'DATASET_CACHE_PINNED', ())
+
+
+def pin_dataset(dataset_id):
+    """Keep every copy of a dataset in the cache until ``unpin_dataset``."""
+    with CACHE_LOCK:
+        _pinned.add(dataset_id)
+
+
+def unpin_dataset(dataset_id):
+    with CACHE_LOCK:
+        _pinned.discard(dataset_id)
+
+
+def table_bytes(table):
+    """The memory the buffers of a pyarrow Table take up, strings and dictionaries included."""
+    return int(table.nbytes)
+
+
+def variant_name(normalize):
+    return VARIANT_NORMALIZED if normalize else VARIANT_RAW
+
+
+def cache_key(dataset, normalize=False):
+    """The key of a dataset's cached copy: ``(dataset_id, version, variant)``."""
+    return dataset.dataset_id, dataset.version, variant_name(normalize)
+
+
+def clean_data(table):
+    """
+    Remove duplicates and rows with missing values from a raw copy, in DuckDB.
+    Args:
+        table: pyarrow Table of the raw copy
+    returns:
+        pyarrow Table of the cleaned rows, which shares no buffers with the raw copy
+    """
+    cursor = _database.cursor()
+    try:
+        cursor.register("raw", table)
+        return cursor.execute(cleaned_query(cursor, "raw")).to_arrow_table()
+    finally:
+        cursor.close()
+
+
+def can_extend(cached_schema, schema):
+    """
+    Whether a cached copy read with ``cached_schema`` can be extended to ``schema``
+    instead of being reloaded: the columns are the same and only numeric types changed.
+    """
+    if cached_schema is None or schema is None or cached_schema.names != schema.names:
+        return False
+    for cached, field in zip(cached_schema, schema):
+        numeric = all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in (cached.type, field.type))
+        if not (cached.type.equals(field.type) or numeric):
+            return False
+    return True
+
+
+def _earlier_versions(dataset_id, variant):
+    """The cached keys of other versions of a dataset's variant, most recently used last."""
+    return [key for key in DATASET_CACHE if key[0] == dataset_id and key[2] == variant]
+
+
+def _evict(key, reason, entry=None):
+    """Drop a copy (call with ``CACHE_LOCK`` held); returns the eviction to record."""
+    entry = DATASET_CACHE.pop(key, None) if entry is None else entry
+    now = time.monotonic()
+    _counters[f"evictions_{reason}"] += 1
+    _evicted_bytes[reason] += entry["bytes"]
+    logger.info(f"Dataset {key} evicted from cache ({reason}, {entry['bytes']} bytes, {entry['hits']} hits)")
+    return CacheEviction(
+        dataset_id=key[0], version=key[1], variant=key[2], reason=reason, size=entry["bytes"],
+        hits=entry["hits"], age=now - entry["loaded_at"], idle=now - entry["last_used"],
+        worker=f"{socket.gethostname()}:{os.getpid()}",
+    )
+
+
+def _expire_idle():
+    ttl = get_idle_ttl()
+    if ttl <= 0:
+        return []
+    now = time.monotonic()
+    return [
+        _evict(key, CacheEviction.REASON_IDLE)
+        for key, entry in list(DATASET_CACHE.items())
+        if now - entry["last_used"] > ttl and not is_pinned(key[0])
+    ]
+
+
+def _make_room(keep):
+    """Evict least recently used copies, other than ``keep``, until the cache fits its budget."""
+    evicted = []
+    max_bytes = get_max_bytes()
+    total = sum(entry["bytes"] for entry in DATASET_CACHE.values())
+    while total > max_bytes:
+        victim = next((key for key in DATASET_CACHE if key != keep and not is_pinned(key[0])), None)
+        if victim is None:
+            logger.warning(f"Dataset cache holds {total} bytes of pinned copies, over its budget of {max_bytes}")
+            break
+        total -= DATASET_CACHE[victim]["bytes"]
+        evicted.append(_evict(victim, CacheEviction.REASON_BUDGET))
+    return evicted
+
+
+def _record(evictions):
+    if not evictions:
+        return
+    try:
+        CacheEviction.objects.bulk_create(evictions)
+    except Exception as e:
+        logger.warning(f"Could not record {len(evictions)} cache eviction(s): {e}")
+
+
+def _build_table(key, parts, schema, previous):
+    """The Arrow table of a raw copy, extending the table of ``previous`` when it can."""
+    if previous is not None:
+        # rows were appended since the copy was loaded: read only the new parts
+        new_parts = parts[len(previous["parts"]):]
+        logger.info(f"Dataset {key} extended with {len(new_parts)} new part(s)")
+        return pa.concat_tables([conform_table(previous["data"], schema), read_parts(new_parts, schema)])
+    return read_parts(parts, schema)
+
+
+class _Flight:
+    """A load in progress, which requests for the same key wait on instead of loading it again."""
+
+    def __init__(self):
+        self.done = Event()
+        self.entry = None
+        self.error = None
+
+
+def _new_entry(data, size, parts, schema):
+    now = time.monotonic()
+    return {
+        "data": data, "parts": parts, "schema": schema, "bytes": size,
+        "hits": 0, "loaded_at": now, "last_used": now,
+    }
+
+
+def _clean_entry(dataset, key):
+    """Compute a normalized copy from the raw copy of the same version, loading that first if needed."""
+    raw = get_entry(dataset, normalize=False)
+    store = get_shared_store()
+    if store is not None:
+        data = store.get_or_create(key, lambda: clean_data(raw["data"]))
+    else:
+        data = clean_data(raw["data"])
+    logger.info(f"Dataset {key} cleaned from its raw copy: duplicates and missing values removed")
+    return _new_entry(data, table_bytes(data), raw["parts"], raw["schema"])
+
+
+def _read_entry(dataset, key, normalize, previous):
+    """Read a copy, without holding ``CACHE_LOCK``; ``previous`` is an earlier version to extend."""
+    if normalize:
+        return _clean_entry(dataset, key)
+    parts = get_parts(dataset)
+    schema = parts_schema(parts)
+    part_ids = [part.pk for part in parts]
+    if previous is not None and not (can_extend(previous["schema"], schema)
+                                     and part_ids[:len(previous["parts"])] == previous["parts"]):
+        previous = None
+    store = get_shared_store()
+    if store is not None:
+        # mapped from the host's shared store; built there by whichever process needs it first
+        data = store.get_or_create(key, lambda: _build_table(key, parts, schema, previous))
+    else:
+        data = _build_table(key, parts, schema, previous)
+    return _new_entry(data, table_bytes(data), part_ids, schema)
+
+
+def _insert_entry(key, entry, evicted):
+    """Add a loaded copy (call with ``CACHE_LOCK`` held), adding the copies it evicts to ``evicted``."""
+    evicted += [
+        _evict(old_key, CacheEviction.REASON_SUPERSEDED)
+        for old_key in _earlier_versions(key[0], key[2]) if old_key[1] < key[1]
+    ]
+    if entry.get("prefetched"):
+        total = sum(other["bytes"] for other in DATASET_CACHE.values()) + entry["bytes"]
+        if total > min(get_prefetch_max_bytes(), get_max_bytes()):
+            # a guess about what will be used never pushes out what is being used
+            evicted.append(_evict(key, CacheEviction.REASON_BUDGET, entry))
+            return
+    if entry["bytes"] > get_max_bytes() and not is_pinned(key[0]):
+        # served to the requests waiting for it only: keeping it would empty the cache
+        evicted.append(_evict(key, CacheEviction.REASON_TOO_LARGE, entry))
+        return
+    DATASET_CACHE[key] = entry
+    evicted += _make_room(keep=key)
+    logger.info(f"Dataset {key} loaded into cache ({entry['bytes']} bytes)")
+
+
+def get_entry(dataset, normalize=False, prefetch=False):
+    """
+    The cached copy of a dataset at its current version, loaded if needed.
+    Only one request loads a given copy; the others asking for it meanwhile
+    wait for that load, and requests for other copies do not wait at all.
+    Args:
+        dataset: Dataset instance, as read for this request
+        normalize: Boolean indicating whether to return the cleaned variant
+        prefetch: Boolean indicating that no request needs the copy yet (see ``prefetch.py``)
+    returns:
+        dict: the ``data``, the ``parts`` and ``schema`` it was read from, its size in ``bytes`` and use counters
+    """
+    global _last_request
+    key = cache_key(dataset, normalize)
+    evicted = []
+    with CACHE_LOCK:
+        evicted += _expire_idle()
+        entry = DATASET_CACHE.get(key)
+        if not prefetch:
+            _last_request = time.monotonic()
+            if entry is not None:
+                DATASET_CACHE.move_to_end(key)
+                entry["hits"] += 1
+                entry["last_used"] = _last_request
+                _counters["hits"] += 1
+                if entry.pop("prefetched", False):
+                    _counters["prefetch_hits"] += 1
+        flight = _flights.get(key) if entry is None else None
+        leader = entry is None and flight is None
+        if flight is not None:
+            _counters["waits"] += 1
+        if leader:
+            _counters["prefetches" if prefetch else "misses"] += 1
+            flight = _flights[key] = _Flight()
+            earlier = [other for other in _earlier_versions(key[0], key[2]) if other[1] < key[1]]
+            # only raw copies are extended; a normalized one is computed from the raw copy
+            previous = DATASET_CACHE[earlier[-1]] if earlier and not normalize else None
+    # written outside the lock, so other requests do not wait on the database
+    _record(evicted)
+    if entry is not None:
+        logger.info(f"Dataset {key} retrieved from cache")
+        return entry
+
+    if not leader:
+        logger.info(f"Dataset {key} is being loaded by another request, waiting")
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.entry
+
+    evicted = []
+    try:
+        flight.entry = _read_entry(dataset, key, normalize, previous)
+        if prefetch:
+            flight.entry["prefetched"] = True
+        with CACHE_LOCK:
+            _insert_entry(key, flight.entry, evicted)
+        return flight.entry
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with CACHE_LOCK:
+            _flights.pop(key, None)
+        flight.done.set()
+        _record(evicted)
+
+
+def get_cursor(dataset, normalize=False):
+    """
+    A DuckDB cursor for one request, with the shared copy of the dataset as ``temp``.
+    The caller closes it when done.
+    """
+    data = get_entry(dataset, normalize)["data"]
+    cursor = _database.cursor()
+    cursor.register("temp", data)
+    return cursor
+
+
+def is_cached(dataset, normalize=False):
+    with CACHE_LOCK:
+        return cache_key(dataset, normalize) in DATASET_CACHE
+
+
+def is_quiet(seconds):
+    """Whether no copy is being loaded and no request has asked for one in the last ``seconds``."""
+    with CACHE_LOCK:
+        return not _flights and time.monotonic() - _last_request >= seconds
+
+
+def evict_dataset(dataset_id):
+    """
+    Drop every cached copy of a dataset; it is loaded again on the next request.
+    Returns:
+        int: Number of copies dropped.
+    """
+    with CACHE_LOCK:
+        evicted = [_evict(key, CacheEviction.REASON_CLEARED) for key in list(DATASET_CACHE) if key[0] == dataset_id]
+    store = get_shared_store()
+    if store is not None:
+        store.clear(dataset_id)
+    _record(evicted)
+    return len(evicted)
+
+
+def stats():
+    """The counters of this process's cache, for sizing it."""
+    with CACHE_LOCK:
+        return {
+            "entries": len(DATASET_CACHE),
+            "bytes": sum(entry["bytes"] for entry in DATASET_CACHE.values()),
+            "max_bytes": get_max_bytes(),
+            "pinned": sorted({key[0] for key in DATASET_CACHE if is_pinned(key[0])}),
+            "hits": _counters["hits"],
+            "misses": _counters["misses"],
+            "waits": _counters["waits"],
+            "prefetches": _counters["prefetches"],
+            "prefetch_hits": _counters["prefetch_hits"],
+            "evictions": {reason: _counters[f"evictions_{reason}"] for reason, _ in CacheEviction.REASONS},
+            "evicted_bytes": dict(_evicted_bytes),
+        }
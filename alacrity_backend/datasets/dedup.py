@@ -0,0 +1,200 @@
+"""
+Content-hash deduplication of stored dataset objects.
+
+Every upload is hashed (SHA-256 of the uploaded bytes) while it is staged, or
+after the download for cloud imports. Before converting a file the ingest worker
+looks for a ``StoredObject`` with the same hash written with the same ingest
+settings for the same owner: the uploader's organisation, or the uploader alone
+without one (``dedup_owner``). If there is one, the new dataset part points at
+that object and the conversion, encryption and upload are skipped. Objects are
+never shared across organisations, so an upload neither reveals that another
+organisation holds the same file nor collides with its datasets.
+
+``StoredObject.ref_count`` counts the parts and running jobs using an object.
+A job takes its reference when it finds or registers the object, under the row
+lock ``release`` takes too, so an object cannot be deleted between being found
+and being used. The part the job records inherits the reference; a job that
+fails before that gives it back with ``release``. The count is decremented when
+a part is deleted and the MinIO object is removed once nothing refers to it.
+"""
+
+import hashlib
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .dtypes import decode_schema, encode_schema, optimize_types_enabled
+from .models import DatasetPart, DatasetProfile, DatasetVersion, StoredObject
+from .parquet_profiles import select_profile
+from .versions import remove_object
+
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file):
+    """
+    SHA-256 of a seekable binary file, read in chunks; the file is left at the start.
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    file.seek(0)
+    while True:
+        chunk = file.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def ingest_variant(size):
+    """
+    The ingest settings that decide what an upload of ``size`` bytes is stored as.
+    Identical bytes only share an object when these match too.
+    """
+    return f"{select_profile(size)}:{'typed' if optimize_types_enabled() else 'untyped'}"
+
+
+def dedup_owner(user):
+    """Whose uploads may share stored objects: the user's organisation, or the user alone."""
+    if user.organization_id:
+        return f"organization:{user.organization_id}"
+    return f"user:{user.pk}"
+
+
+def claim_stored_object(content_hash, variant, owner):
+    """
+    Take a reference to the stored object for identical content uploaded by ``owner``.
+    Returns:
+        StoredObject | None: The object, with the caller's reference counted, or
+            None if there is none (or it was released in the meantime).
+    """
+    if not content_hash:
+        return None
+    with transaction.atomic():
+        stored_object = (
+            StoredObject.objects.select_for_update()
+            .filter(content_hash=content_hash, variant=variant, owner=owner).first()
+        )
+        if stored_object is not None:
+            stored_object.ref_count += 1
+            stored_object.save(update_fields=['ref_count'])
+    return stored_object
+
+
+def register_stored_object(content_hash, variant, owner, link, result):
+    """
+    Record a freshly uploaded object so later identical uploads can reuse it,
+    with the caller's reference counted.
+    Args:
+        content_hash (str): SHA-256 of the upload.
+        variant (str): As returned by :func:`ingest_variant`.
+        owner (str): As returned by :func:`dedup_owner`.
+        link (str): URL of the stored object.
+        result (dict): The ingest result.
+    Returns:
+        tuple: ``(StoredObject, created)``. ``created`` is False when an identical
+            upload finished first; the caller should then drop its own copy.
+    """
+    while True:
+        try:
+            with transaction.atomic():
+                stored_object = StoredObject.objects.create(
+                    content_hash=content_hash,
+                    variant=variant,
+                    owner=owner,
+                    link=link,
+                    encryption_key=result["encryption_key"].decode(),
+                    rows=result["rows"],
+                    stored_size=result["stored_size"],
+                    schema=result["schema"],
+                    arrow_schema=encode_schema(result["arrow_schema"]),
+                    ref_count=1,
+                )
+            return stored_object, True
+        except IntegrityError:
+            stored_object = claim_stored_object(content_hash, variant, owner)
+            if stored_object is not None:
+                return stored_object, False
+            # the other copy was released before it could be claimed: record ours after all
+
+
+def stored_result(stored_object):
+    """The ingest result for an upload that reuses ``stored_object``."""
+    return {
+        "rows": stored_object.rows,
+        "schema": stored_object.schema,
+        "arrow_schema": decode_schema(stored_object.arrow_schema),
+        "encryption_key": stored_object.encryption_key.encode(),
+        "stored_size": stored_object.stored_size,
+        "deduplicated": True,
+    }
+
+
+def release(stored_object_id):
+    """
+    Count one reference fewer to an object, deleting it when none are left.
+    The MinIO object is removed after the transaction commits.
+    """
+    with transaction.atomic():
+        stored_object = StoredObject.objects.select_for_update().filter(pk=stored_object_id).first()
+        if stored_object is None:
+            return
+        stored_object.ref_count = max(stored_object.ref_count - 1, 0)
+        if stored_object.ref_count > 0 or stored_object.parts.exists():
+            stored_object.save(update_fields=['ref_count'])
+            return
+        link = stored_object.link
+        stored_object.delete()
+        logger.info(f"Stored object {stored_object.content_hash[:12]} has no references left, removing it")
+        transaction.on_commit(lambda: remove_object(link))
+
+
+@receiver(post_delete, sender=DatasetPart)
+def release_part_object(sender, instance, **kwargs):
+    if instance.stored_object_id:
+        release(instance.stored_object_id)
+
+
+def reuse_profiles(dataset, stored_object):
+    """
+    Copy the profiles of another dataset version made of just ``stored_object``
+    to the current version of ``dataset``, which holds the same rows.
+    Returns:
+        bool: False if there was no profile to copy.
+    """
+    version = (
+        DatasetVersion.objects.annotate(part_count=Count('parts', distinct=True))
+        .filter(part_count=1, parts__stored_object=stored_object)
+        .exclude(dataset=dataset)
+        .first()
+    )
+    if version is None:
+        return False
+    profiles = list(DatasetProfile.objects.filter(dataset=version.dataset, version=version.number))
+    if not profiles:
+        return False
+    for profile in profiles:
+        DatasetProfile.objects.update_or_create(
+            dataset=dataset,
+            version=dataset.version,
+            normalized=profile.normalized,
+            defaults={
+                "total_rows": profile.total_rows,
+                "columns": profile.columns,
+                "duplicate_rows": profile.duplicate_rows,
+                "missing_values": profile.missing_values,
+                "numeric_stats": profile.numeric_stats,
+                "categorical_stats": profile.categorical_stats,
+                "source_link": dataset.link,
+            },
+        )
+    logger.info(f"Reused the profile of dataset {version.dataset_id} for dataset {dataset.dataset_id}")
+    return True
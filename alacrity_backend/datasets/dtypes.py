@@ -0,0 +1,266 @@
+"""
+Column type optimisation for ingested datasets.
+
+Readers infer wide types (every integer is int64, every float float64, every
+text column a plain string). Before the batches are written to Parquet, the
+first batch of an upload is used to pick the tightest type that still holds
+its values:
+
+    integers     the smallest signed type that fits the observed range with
+                 ``INTEGER_HEADROOM`` times head-room
+    floats       float32 when every value survives the round trip exactly
+    timestamps   date32 when every value is at midnight
+    text         dictionary-encoded (pandas ``category``) when the column has
+                 few distinct values
+
+Every later batch is cast to the same types. If a batch does not fit (an
+integer overflows, a float loses precision) a ``ColumnTypeError`` names the
+column and the type the reader produced, and the ingest restarts with that
+column left as read.
+
+Each column is described twice. ``dtype_name`` gives the pandas dtype name of
+the type it was narrowed from, kept in ``Dataset.schema`` and shown to clients
+(every integer is ``int64``, every float ``float64``, dictionary-encoded text
+``object``), so a column looks the same whether or not it was narrowed.
+``logical_type`` gives the stored type, kept in ``Dataset.logical_schema``
+(``int16``, ``float32``, ``category``, ``date``, ...); ``is_numeric_dtype``
+accepts the numeric names of either and is what the analysis endpoints use to
+validate columns.
+
+The parts of an appended dataset are optimised independently, so the same
+column can be int8 in one part and int16 in the next. ``unify_schemas`` picks
+the type every part is read as (see ``versions.py``).
+"""
+
+import base64
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from django.conf import settings
+
+
+INTEGER_LADDER = [pa.int8(), pa.int16(), pa.int32(), pa.int64()]
+INTEGER_HEADROOM = 4
+DEFAULT_DICTIONARY_MAX_CARDINALITY = 1000
+# share of distinct values among non-null values, above which text stays plain
+DICTIONARY_MAX_RATIO = 0.5
+DICTIONARY_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+NUMERIC_DTYPES = {
+    'int8', 'int16', 'int32', 'int64',
+    'uint8', 'uint16', 'uint32', 'uint64',
+    'float16', 'float32', 'float64',
+}
+
+
+class ColumnTypeError(Exception):
+    """
+    A batch does not fit the types chosen for some columns from the earlier batches.
+    Args:
+        columns (list): The offending column names.
+        types (dict, optional): Types to fix those columns to on the next attempt;
+            without them the columns are widened along ``ingest.TYPE_PROMOTIONS``.
+    """
+
+    def __init__(self, columns, types=None):
+        super().__init__(f"Inconsistent values in column(s): {', '.join(columns)}")
+        self.columns = columns
+        self.types = types or {}
+
+
+def optimize_types_enabled():
+    return bool(getattr(settings, 'DATASET_OPTIMIZE_TYPES', True))
+
+
+def get_dictionary_max_cardinality():
+    return int(getattr(settings, 'DATASET_DICTIONARY_MAX_CARDINALITY', DEFAULT_DICTIONARY_MAX_CARDINALITY))
+
+
+def _all_true(mask):
+    return pc.all(mask).as_py() is True
+
+
+def _smallest_integer(array):
+    bounds = pc.min_max(array).as_py()
+    if bounds["min"] is None:
+        return array.type
+    low, high = bounds["min"] * INTEGER_HEADROOM, bounds["max"] * INTEGER_HEADROOM
+    for candidate in INTEGER_LADDER:
+        if candidate.bit_width >= array.type.bit_width:
+            break
+        limit = 1 << (candidate.bit_width - 1)
+        if -limit <= low and high < limit:
+            return candidate
+    return array.type
+
+
+def _fits_float32(array):
+    narrowed = array.cast(pa.float32(), safe=False).cast(array.type)
+    return _all_true(pc.or_kleene(pc.equal(narrowed, array), pc.is_nan(array)))
+
+
+def _is_date_only(array):
+    return _all_true(pc.equal(array.cast(pa.date32()).cast(array.type), array))
+
+
+def _is_low_cardinality(array):
+    values = len(array) - array.null_count
+    if values == 0:
+        return False
+    distinct = pc.count_distinct(array).as_py()
+    return distinct <= get_dictionary_max_cardinality() and distinct <= values * DICTIONARY_MAX_RATIO
+
+
+def tightest_type(array):
+    """The narrowest type that holds every value of ``array`` (see the module docstring)."""
+    column_type = array.type
+    if pa.types.is_signed_integer(column_type):
+        return _smallest_integer(array)
+    if pa.types.is_float64(column_type) and array.null_count < len(array) and _fits_float32(array):
+        return pa.float32()
+    if pa.types.is_timestamp(column_type) and column_type.tz is None and array.null_count < len(array) \
+            and _is_date_only(array):
+        return pa.date32()
+    if pa.types.is_string(column_type) and _is_low_cardinality(array):
+        return DICTIONARY_TYPE
+    return column_type
+
+
+def plan_schema(batch, fixed_types=None):
+    """
+    Choose the stored schema from the first batch of an upload.
+    Args:
+        batch (pyarrow.RecordBatch): The first batch, with the reader's types.
+        fixed_types (dict, optional): Columns whose type must not be changed.
+    Returns:
+        pyarrow.Schema: The schema every batch is cast to.
+    """
+    fixed_types = fixed_types or {}
+    fields = []
+    for field, array in zip(batch.schema, batch.columns):
+        column_type = field.type if field.name in fixed_types else tightest_type(array)
+        fields.append(pa.field(field.name, column_type))
+    return pa.schema(fields)
+
+
+def _cast(array, target):
+    cast = array.cast(target)
+    if pa.types.is_float32(target) and pa.types.is_floating(array.type) and not _fits_float32(array):
+        raise pa.ArrowInvalid("float32 would lose precision")
+    if pa.types.is_date32(target) and pa.types.is_timestamp(array.type) and not _is_date_only(array):
+        raise pa.ArrowInvalid("date32 would drop the time of day")
+    return cast
+
+
+def cast_batch(batch, schema):
+    """
+    Cast a batch to the planned schema.
+    Raises:
+        ColumnTypeError: Naming the columns whose values do not fit, with the
+            reader's type for each so the next attempt keeps it.
+    """
+    if batch.schema.equals(schema):
+        return batch
+    arrays = []
+    failed = {}
+    for field, array in zip(schema, batch.columns):
+        if array.type.equals(field.type):
+            arrays.append(array)
+            continue
+        try:
+            arrays.append(_cast(array, field.type))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+            failed[field.name] = array.type
+    if failed:
+        raise ColumnTypeError(list(failed), types=failed)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def dtype_name(arrow_type):
+    """
+    The type name recorded in ``Dataset.schema`` for a stored Arrow type: the
+    pandas dtype name of the type it was narrowed from (``int64``, ``float64``,
+    ``object``, ``bool``, ``datetime64[ms]``, ...).
+    """
+    if pa.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    if pa.types.is_integer(arrow_type):
+        return 'int64'
+    if pa.types.is_floating(arrow_type):
+        return 'float64'
+    try:
+        return str(np.dtype(arrow_type.to_pandas_dtype()))
+    except (NotImplementedError, TypeError):
+        return 'object'
+
+
+def logical_type(arrow_type):
+    """
+    The type name recorded in ``Dataset.logical_schema`` for a stored Arrow type.
+    Numbers keep their NumPy names (``int16``, ``float32``); other types are
+    ``bool``, ``category``, ``date``, ``datetime`` or ``object``.
+    """
+    if pa.types.is_dictionary(arrow_type):
+        return 'category'
+    if pa.types.is_boolean(arrow_type):
+        return 'bool'
+    if pa.types.is_integer(arrow_type) or pa.types.is_floating(arrow_type):
+        return str(arrow_type.to_pandas_dtype().__name__)
+    if pa.types.is_date(arrow_type):
+        return 'date'
+    if pa.types.is_timestamp(arrow_type):
+        return 'datetime'
+    return 'object'
+
+
+def is_numeric_dtype(name):
+    """True for the ``Dataset.schema`` and ``Dataset.logical_schema`` type names the numeric analyses accept."""
+    return name in NUMERIC_DTYPES
+
+
+def _common_type(types):
+    first = types[0]
+    if all(column_type.equals(first) for column_type in types):
+        return first
+    try:
+        return pa.unify_schemas(
+            [pa.schema([("value", column_type)]) for column_type in types], promote_options="permissive"
+        ).field("value").type
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        pass
+    plain = [column_type.value_type if pa.types.is_dictionary(column_type) else column_type for column_type in types]
+    if all(pa.types.is_date(column_type) or pa.types.is_timestamp(column_type) for column_type in plain):
+        return pa.timestamp("us")
+    return pa.string()
+
+
+def unify_schemas(schemas):
+    """
+    The schema the parts of a dataset are read as: numbers are promoted to a type
+    that holds every part (int8 and int16 give int16, ints and floats a float),
+    dates and timestamps become timestamps and anything else that differs is text.
+    Args:
+        schemas (list): ``pyarrow.Schema`` of every part, with the same column names.
+    Returns:
+        pyarrow.Schema: Columns in the order of the first schema.
+    """
+    return pa.schema([
+        pa.field(name, _common_type([schema.field(name).type for schema in schemas]))
+        for name in schemas[0].names
+    ])
+
+
+def conform_table(table, schema):
+    """Cast a part read from storage to the dataset's unified schema."""
+    table = table.select(schema.names)
+    return table if table.schema.equals(schema) else table.cast(schema)
+
+
+def encode_schema(schema):
+    """Serialise an Arrow schema for a text column (see ``DatasetPart.arrow_schema``)."""
+    return base64.b64encode(schema.serialize().to_pybytes()).decode()
+
+
+def decode_schema(text):
+    return pa.ipc.read_schema(pa.py_buffer(base64.b64decode(text)))
@@ -0,0 +1,329 @@
+"""
+Encryption helpers for the dataset objects stored in MinIO.
+
+New objects are written in a segmented AEAD format: the plaintext is cut into
+fixed-size segments, each sealed with AES-256-GCM under its own nonce and tag.
+Segments can be encrypted and decrypted as they stream through, in parallel,
+and the ciphertext is only 16 bytes per segment larger than the Parquet file.
+
+Segmented layout::
+
+    SEGMENTED_MAGIC | segment size (4 byte big-endian) | nonce prefix (7 bytes)
+    | (ciphertext + 16 byte tag) * n
+
+Every segment except the last holds exactly ``segment size`` bytes of plaintext;
+the last holds the rest (possibly nothing). The nonce of segment ``i`` is the
+prefix, ``i`` as 4 bytes and a flag byte that is 1 for the last segment, and
+the header is authenticated with every segment, so reordered, dropped or
+truncated segments fail to decrypt. The AES key is derived with HKDF from the
+dataset's Fernet key, so existing keys are used unchanged.
+
+Two older formats remain readable:
+
+    framed       FRAMED_MAGIC | (4 byte big-endian frame length | Fernet token) * n
+    fernet       a single Fernet token over the whole file
+
+``migrate_dataset_encryption`` rewrites objects in the older formats.
+"""
+
+import base64
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+
+
+FRAMED_MAGIC = b"ALCFRM1\n"
+FRAME_HEADER = struct.Struct(">I")
+SEGMENTED_MAGIC = b"ALCSEG1\n"
+SEGMENT_HEADER = struct.Struct(">I7s")
+TAG_SIZE = 16
+MAGIC_SIZE = len(SEGMENTED_MAGIC)
+HEADER_SIZE = MAGIC_SIZE + SEGMENT_HEADER.size
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+KEY_INFO = b"alacrity dataset segments v1"
+
+FORMAT_SEGMENTED = 'segmented'
+FORMAT_FRAMED = 'framed'
+FORMAT_FERNET = 'fernet'
+
+_executor = None
+
+
+def get_encryption_workers():
+    return max(1, int(getattr(settings, 'DATASET_ENCRYPTION_WORKERS', os.cpu_count() or 1)))
+
+
+def _map(function, items):
+    """``map`` over segments, on a shared thread pool when there is more than one."""
+    global _executor
+    workers = get_encryption_workers()
+    if workers == 1 or len(items) < 2:
+        return [function(item) for item in items]
+    if _executor is None or _executor._max_workers != workers:
+        _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dataset-crypto")
+    return list(_executor.map(function, items))
+
+
+def object_format(data):
+    """The format of an encrypted object (``FORMAT_*``) from its first bytes."""
+    if data.startswith(SEGMENTED_MAGIC):
+        return FORMAT_SEGMENTED
+    if data.startswith(FRAMED_MAGIC):
+        return FORMAT_FRAMED
+    return FORMAT_FERNET
+
+
+def _key_bytes(key):
+    return key.encode() if isinstance(key, str) else key
+
+
+def _segment_cipher(key):
+    raw = base64.urlsafe_b64decode(_key_bytes(key))
+    return AESGCM(HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=KEY_INFO).derive(raw))
+
+
+class _Segments:
+    """The AES-GCM state shared by every segment of one object."""
+
+    def __init__(self, key, header):
+        self.cipher = _segment_cipher(key)
+        self.header = header
+        self.segment_size, self.nonce_prefix = SEGMENT_HEADER.unpack(header[MAGIC_SIZE:])
+
+    def nonce(self, index, last):
+        return self.nonce_prefix + struct.pack(">IB", index, 1 if last else 0)
+
+    def seal(self, index, plaintext, last=False):
+        return self.cipher.encrypt(self.nonce(index, last), plaintext, self.header)
+
+    def open(self, index, ciphertext, last=False):
+        return self.cipher.decrypt(self.nonce(index, last), ciphertext, self.header)
+
+
+class StreamEncryptor:
+    """
+    Encrypt a byte stream chunk by chunk into the segmented format.
+
+    Plaintext is buffered until a full segment is available; segments that are
+    complete after one ``update`` are sealed in parallel.
+    """
+
+    def __init__(self, key, segment_size=DEFAULT_SEGMENT_SIZE):
+        Fernet(_key_bytes(key))  # reject malformed keys up front
+        header = SEGMENTED_MAGIC + SEGMENT_HEADER.pack(segment_size, os.urandom(7))
+        self.segments = _Segments(key, header)
+        self.segment_size = segment_size
+        self._pending = bytearray()
+        self._index = 0
+        self._started = False
+
+    def _start(self, out):
+        if not self._started:
+            out += self.segments.header
+            self._started = True
+
+    def update(self, data):
+        """
+        Feed plaintext into the encryptor.
+        Args:
+            data (bytes): The next piece of plaintext.
+        Returns:
+            bytes: Ciphertext ready to be written, possibly empty.
+        """
+        out = bytearray()
+        self._start(out)
+        self._pending += data
+        # the last segment is only sealed by finalize(), so keep at least one byte back
+        count = (len(self._pending) - 1) // self.segment_size
+        if count > 0:
+            with memoryview(self._pending) as view:
+                jobs = [
+                    (self._index + n, bytes(view[n * self.segment_size:(n + 1) * self.segment_size]))
+                    for n in range(count)
+                ]
+            for sealed in _map(lambda job: self.segments.seal(*job), jobs):
+                out += sealed
+            del self._pending[:count * self.segment_size]
+            self._index += count
+        return bytes(out)
+
+    def finalize(self):
+        """
+        Seal the remaining plaintext as the last segment.
+        Returns:
+            bytes: The last segment (and the header if nothing was written yet).
+        """
+        out = bytearray()
+        self._start(out)
+        out += self.segments.seal(self._index, bytes(self._pending), last=True)
+        self._pending = bytearray()
+        return bytes(out)
+
+
+class StreamDecryptor:
+    """
+    Decrypt a stored object chunk by chunk, in any of the three formats.
+
+    Segmented and framed objects yield plaintext as soon as a segment (or frame)
+    has arrived and been authenticated. A single Fernet token can only be
+    checked as a whole, so legacy objects are buffered until ``finalize``.
+    """
+
+    def __init__(self, key):
+        self.key = _key_bytes(key)
+        self.format = None
+        self._buffer = bytearray()
+        self._segments = None
+        self._index = 0
+
+    def update(self, data):
+        """
+        Feed ciphertext into the decryptor.
+        Returns:
+            bytes: Authenticated plaintext, possibly empty.
+        """
+        self._buffer += data
+        if self.format is None:
+            if len(self._buffer) < MAGIC_SIZE:
+                return b""
+            self.format = object_format(self._buffer)
+            if self.format == FORMAT_FRAMED:
+                self._fernet = Fernet(self.key)
+                del self._buffer[:MAGIC_SIZE]
+        if self.format == FORMAT_SEGMENTED:
+            return self._segmented()
+        if self.format == FORMAT_FRAMED:
+            return self._frames()
+        return b""
+
+    def _segmented(self, final=False):
+        if self._segments is None:
+            if len(self._buffer) < HEADER_SIZE:
+                if final:
+                    raise ValueError("Encrypted dataset object is truncated")
+                return b""
+            self._segments = _Segments(self.key, bytes(self._buffer[:HEADER_SIZE]))
+            del self._buffer[:HEADER_SIZE]
+        stride = self._segments.segment_size + TAG_SIZE
+        # the last segment is only known to be last at the end of the stream
+        count = (len(self._buffer) - 1) // stride if self._buffer else 0
+        out = bytearray()
+        if count > 0:
+            with memoryview(self._buffer) as view:
+                jobs = [(self._index + n, bytes(view[n * stride:(n + 1) * stride])) for n in range(count)]
+            for plaintext in _map(lambda job: self._segments.open(*job), jobs):
+                out += plaintext
+            del self._buffer[:count * stride]
+            self._index += count
+        if final:
+            if len(self._buffer) < TAG_SIZE:
+                raise ValueError("Encrypted dataset object is truncated")
+            out += self._segments.open(self._index, bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+        return bytes(out)
+
+    def _frames(self):
+        out = bytearray()
+        offset = 0
+        while len(self._buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self._buffer, offset)
+            if len(self._buffer) - offset - FRAME_HEADER.size < length:
+                break
+            start = offset + FRAME_HEADER.size
+            out += self._fernet.decrypt(bytes(self._buffer[start:start + length]))
+            offset = start + length
+        del self._buffer[:offset]
+        return bytes(out)
+
+    def finalize(self):
+        """
+        Check the end of the object and return the remaining plaintext.
+        Raises:
+            cryptography.exceptions.InvalidTag: If a segment fails authentication.
+            cryptography.fernet.InvalidToken: If a Fernet token or frame fails authentication.
+            ValueError: If the object is truncated.
+        """
+        if self.format is None:
+            self.format = object_format(self._buffer)
+            if self.format != FORMAT_FERNET:
+                raise ValueError("Encrypted dataset object is truncated")
+        if self.format == FORMAT_SEGMENTED:
+            return self._segmented(final=True)
+        if self.format == FORMAT_FRAMED:
+            out = self._frames()
+            if self._buffer:
+                raise ValueError("Encrypted dataset object is truncated")
+            return out
+        plaintext = Fernet(self.key).decrypt(bytes(self._buffer))
+        self._buffer = bytearray()
+        return plaintext
+
+
+class SegmentIndex:
+    """
+    Where each segment of a segmented object lies, from its header and size, so
+    that a byte range of the plaintext can be read with one ranged request for
+    just the segments that hold it.
+    Args:
+        key (str | bytes): The dataset's Fernet key.
+        header (bytes): The first ``HEADER_SIZE`` bytes of the object.
+        object_size (int): Size of the whole object in bytes.
+    """
+
+    def __init__(self, key, header, object_size):
+        self.segments = _Segments(_key_bytes(key), bytes(header[:HEADER_SIZE]))
+        self.segment_size = self.segments.segment_size
+        self.stride = self.segment_size + TAG_SIZE
+        self.object_size = object_size
+        self.count = max(1, -(-(object_size - HEADER_SIZE) // self.stride))
+        self.plaintext_size = object_size - HEADER_SIZE - self.count * TAG_SIZE
+        if self.plaintext_size < 0:
+            raise ValueError("Encrypted dataset object is truncated")
+
+    def segments_for(self, start, end):
+        """The first and last segment holding plaintext bytes ``[start, end)``."""
+        last = max(end, start + 1) - 1
+        return start // self.segment_size, min(last // self.segment_size, self.count - 1)
+
+    def byte_range(self, first, last):
+        """The ``(offset, length)`` of segments ``first`` to ``last`` in the object."""
+        offset = HEADER_SIZE + first * self.stride
+        return offset, min(HEADER_SIZE + (last + 1) * self.stride, self.object_size) - offset
+
+    def decrypt(self, first, data):
+        """
+        Authenticate and decrypt consecutive segments starting at ``first``.
+        Returns:
+            list: The plaintext of each segment.
+        """
+        jobs = [(first + n, data[start:start + self.stride]) for n, start in enumerate(range(0, len(data), self.stride))]
+        return _map(lambda job: self.segments.open(job[0], job[1], last=job[0] == self.count - 1), jobs)
+
+
+def decrypt_dataset_object(key, data):
+    """
+    Decrypt a whole stored dataset object in any of the three formats.
+    Args:
+        key (str | bytes): The dataset's Fernet key.
+        data (bytes): The encrypted object as read from MinIO.
+    Returns:
+        bytes: The decrypted Parquet file.
+    Raises:
+        cryptography.exceptions.InvalidTag: If a segment fails authentication.
+        cryptography.fernet.InvalidToken: If a Fernet token or frame fails authentication.
+        ValueError: If the object is truncated.
+    """
+    decryptor = StreamDecryptor(key)
+    return decryptor.update(data) + decryptor.finalize()
+
+
+def encrypt_dataset_object(key, data, segment_size=DEFAULT_SEGMENT_SIZE):
+    """Encrypt a whole Parquet file in the segmented format."""
+    encryptor = StreamEncryptor(key, segment_size=segment_size)
+    return encryptor.update(data) + encryptor.finalize()
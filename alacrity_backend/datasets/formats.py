@@ -0,0 +1,344 @@
+"""
+Input formats for dataset uploads.
+
+``ingest_upload`` looks at the first bytes of an upload (and, for text formats,
+its file name) to pick a reader:
+
+    csv        the CSV pipeline in ``ingest.py``
+    csv.gz     the same, decompressed on the fly
+    jsonl      JSON Lines (``.jsonl``/``.ndjson``/``.json``, or text starting with ``{``),
+               optionally gzipped; a JSON array is rejected with a clear message
+    excel      the first sheet of an ``.xlsx`` workbook, read row by row (a ZIP
+               archive that is not a workbook is rejected)
+    parquet    validated, then stored as-is when it already matches the write
+               profile, otherwise re-encoded row group by row group
+
+Every reader produces Arrow record batches for the shared pipeline, so memory
+stays bounded and ``Dataset.schema`` is derived from the Arrow schema in the
+same way for every format.
+"""
+
+import functools
+import gzip
+import logging
+import zipfile
+from itertools import islice
+
+import pyarrow as pa
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+from cryptography.fernet import Fernet
+
+from .encryption import StreamEncryptor, get_encryption_workers
+from .ingest import (
+    BatchIngest,
+    ColumnTypeError,
+    IngestError,
+    _CountingReader,
+    _SourceView,
+    get_block_size,
+    get_segment_size,
+    ingest_csv,
+    ingest_result,
+    open_input,
+    run_ingest,
+)
+from .parquet_profiles import matches_profile, select_profile
+
+
+logger = logging.getLogger(__name__)
+
+PARQUET_MAGIC = b"PAR1"
+GZIP_MAGIC = b"\x1f\x8b"
+ZIP_MAGIC = b"PK\x03\x04"
+OLE_MAGIC = b"\xd0\xcf\x11\xe0"
+WORKBOOK_ENTRY = "xl/workbook.xml"
+LEADING_BLANKS = b"\xef\xbb\xbf \t\r\n"
+JSONL_EXTENSIONS = (".jsonl", ".ndjson", ".json")
+EXCEL_BATCH_ROWS = 50000
+PARQUET_BATCH_ROWS = 65536
+
+
+def detect_format(source, file_name=""):
+    """
+    Work out the format of an upload.
+    Args:
+        source: A seekable binary file object.
+        file_name (str): The uploaded file name, used to tell text formats apart.
+    Returns:
+        tuple: ``(format, compression)``, e.g. ``("csv", "gzip")``.
+    Raises:
+        IngestError: For formats that cannot be ingested.
+    """
+    source.seek(0)
+    head = source.read(1024)
+    source.seek(0)
+    name = (file_name or "").lower()
+
+    if head.startswith(PARQUET_MAGIC):
+        return "parquet", None
+    if head.startswith(GZIP_MAGIC):
+        inner = name[:-3] if name.endswith(".gz") else name
+        if not inner.endswith(JSONL_EXTENSIONS):
+            return "csv", "gzip"
+        try:
+            with gzip.GzipFile(fileobj=source) as decompressed:
+                _check_json_lines(decompressed.read(1024))
+        except (OSError, EOFError) as e:
+            raise IngestError(f"Invalid gzip file: {e}")
+        finally:
+            source.seek(0)
+        return "jsonl", "gzip"
+    if head.startswith(ZIP_MAGIC):
+        _check_workbook(source)
+        return "excel", None
+    if head.startswith(OLE_MAGIC):
+        raise IngestError("Legacy .xls workbooks are not supported, save the sheet as .xlsx or CSV")
+    if name.endswith(JSONL_EXTENSIONS) or head.lstrip(LEADING_BLANKS).startswith(b"{"):
+        _check_json_lines(head)
+        return "jsonl", None
+    return "csv", None
+
+
+def _check_json_lines(head):
+    if head.lstrip(LEADING_BLANKS).startswith(b"["):
+        raise IngestError(
+            "JSON Lines expected (one JSON object per line); the file holds a JSON array, "
+            "convert it to JSON Lines or CSV"
+        )
+
+
+def _check_workbook(source):
+    """ZIP is also the container of .xlsx: only a workbook is accepted."""
+    try:
+        with zipfile.ZipFile(source) as archive:
+            is_workbook = WORKBOOK_ENTRY in archive.namelist()
+    except zipfile.BadZipFile as e:
+        raise IngestError(f"Invalid .xlsx or ZIP file: {e}")
+    finally:
+        source.seek(0)
+    if not is_workbook:
+        raise IngestError("ZIP archives are not supported, upload the files they contain one at a time")
+
+
+class JSONLinesIngest(BatchIngest):
+    """JSON Lines uploads, read with pyarrow's streaming JSON reader."""
+
+    def __init__(self, *args, compression=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compression = compression
+
+    def open_batches(self):
+        if self.column_types:
+            parse_options = pa_json.ParseOptions(
+                explicit_schema=pa.schema(list(self.column_types.items())),
+                unexpected_field_behavior="infer",
+            )
+        else:
+            parse_options = pa_json.ParseOptions()
+        try:
+            reader = pa_json.open_json(
+                open_input(self.source, self.compression),
+                read_options=pa_json.ReadOptions(block_size=get_block_size()),
+                parse_options=parse_options,
+            )
+        except pa.ArrowInvalid as e:
+            if "Empty JSON" in str(e):
+                raise IngestError("Uploaded file is empty")
+            raise IngestError(f"Invalid JSON Lines file: {e}")
+        return reader.schema, self._batches(reader)
+
+    def _batches(self, reader):
+        try:
+            yield from reader
+        except pa.ArrowInvalid as e:
+            # pyarrow does not say which column held the non-integer, so widen every integer column
+            if "Failed to convert JSON to int" in str(e):
+                integers = [field.name for field in reader.schema if pa.types.is_integer(field.type)]
+                if integers:
+                    raise ColumnTypeError(integers)
+            raise IngestError(f"Invalid JSON Lines file: {e}")
+
+
+def _column_names(header):
+    names = []
+    for index, value in enumerate(header):
+        name = str(value).strip() if value is not None and str(value).strip() else f"column_{index + 1}"
+        while name in names:
+            name = f"{name}_{index + 1}"
+        names.append(name)
+    return names
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+class ExcelIngest(BatchIngest):
+    """The first sheet of an .xlsx workbook, streamed row by row with openpyxl's read-only mode."""
+
+    def open_batches(self):
+        try:
+            import openpyxl
+        except ImportError:
+            raise IngestError("Excel uploads are not supported on this server (openpyxl is not installed)")
+        try:
+            workbook = openpyxl.load_workbook(_SourceView(self.source), read_only=True, data_only=True)
+        except (zipfile.BadZipFile, KeyError, OSError, ValueError) as e:
+            raise IngestError(f"Invalid Excel file: {e}")
+
+        rows = (row for row in workbook.worksheets[0].iter_rows(values_only=True) if any(value is not None for value in row))
+        header = next(rows, None)
+        if header is None:
+            workbook.close()
+            raise IngestError("Uploaded file is empty")
+        names = _column_names(header)
+        first = self._to_batch(names, list(islice(rows, EXCEL_BATCH_ROWS)), None)
+        return first.schema, self._batches(workbook, names, first, rows)
+
+    def _batches(self, workbook, names, first, rows):
+        try:
+            yield first
+            while True:
+                chunk = list(islice(rows, EXCEL_BATCH_ROWS))
+                if not chunk:
+                    break
+                yield self._to_batch(names, chunk, first.schema)
+        finally:
+            workbook.close()
+
+    def _to_batch(self, names, rows, schema):
+        arrays = []
+        for index, name in enumerate(names):
+            values = [row[index] if index < len(row) else None for row in rows]
+            column_type = schema.field(name).type if schema is not None else self.column_types.get(name)
+            arrays.append(self._to_array(name, values, column_type))
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+
+    def _to_array(self, name, values, column_type):
+        if column_type is not None and pa.types.is_string(column_type):
+            return pa.array([_text(value) for value in values], type=pa.string())
+        try:
+            return pa.array(values, type=column_type)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            if column_type is not None:
+                raise ColumnTypeError([name])
+            # mixed values within the first batch: keep the column as text
+            return pa.array([_text(value) for value in values], type=pa.string())
+
+
+class ParquetIngest(BatchIngest):
+    """Parquet uploads that do not match the write profile, rewritten row group by row group."""
+
+    def open_batches(self):
+        parquet_file = pq.ParquetFile(_SourceView(self.source))
+        return parquet_file.schema_arrow, parquet_file.iter_batches(batch_size=PARQUET_BATCH_ROWS)
+
+
+class ParquetPassthrough(BatchIngest):
+    """Parquet uploads that already match the write profile: the file is encrypted and stored unchanged."""
+
+    def __init__(self, source, encryption_key, parquet_file, **kwargs):
+        super().__init__(source, encryption_key, **kwargs)
+        self.schema = parquet_file.schema_arrow
+        self.total_rows = parquet_file.metadata.num_rows
+
+    def chunks(self):
+        self.source.seek(0)
+        if self.parquet_copy is not None:
+            self.parquet_copy.seek(0)
+            self.parquet_copy.truncate()
+        segment_size = get_segment_size()
+        encryptor = StreamEncryptor(self.encryption_key, segment_size=segment_size)
+        # read enough for every encryption worker to seal a segment at once
+        read_size = segment_size * get_encryption_workers()
+        while True:
+            data = self.source.read(read_size)
+            if not data:
+                break
+            if self.parquet_copy is not None:
+                self.parquet_copy.write(data)
+            yield encryptor.update(data)
+            if self.progress:
+                fraction = self.source.bytes_read / max(self.source.total, 1)
+                self.progress(int(self.total_rows * fraction), fraction)
+        self.rows = self.total_rows
+        yield encryptor.finalize()
+
+
+def open_parquet(source):
+    """
+    Open and validate a Parquet upload: the footer must parse, the row groups must
+    add up to the row count and the first page must decode.
+    Raises:
+        IngestError: If the file is not valid Parquet.
+    """
+    try:
+        parquet_file = pq.ParquetFile(_SourceView(source))
+        metadata = parquet_file.metadata
+        schema = parquet_file.schema_arrow
+        next(parquet_file.iter_batches(batch_size=1), None)
+    except (pa.ArrowException, OSError) as e:
+        raise IngestError(f"Invalid Parquet file: {e}")
+    if len(schema) == 0:
+        raise IngestError("Invalid Parquet file: no columns")
+    if sum(metadata.row_group(index).num_rows for index in range(metadata.num_row_groups)) != metadata.num_rows:
+        raise IngestError("Invalid Parquet file: row groups do not add up to the row count")
+    return parquet_file
+
+
+def ingest_parquet(source, upload, progress=None, profile=None, parquet_copy=None):
+    """
+    Store a Parquet upload, passing it through unchanged when it already matches
+    the write profile. Arguments and result are as for ``ingest_csv``; the result
+    also says whether the file was passed through.
+    """
+    source = _CountingReader(source)
+    parquet_file = open_parquet(source)
+    profile = profile or select_profile(source.total)
+    encryption_key = Fernet.generate_key()
+    options = {"progress": progress, "profile": profile, "parquet_copy": parquet_copy}
+
+    if matches_profile(parquet_file.metadata, profile):
+        logger.info(f"Parquet upload matches the '{profile}' profile, storing it unchanged")
+        ingest = run_ingest(lambda column_types: ParquetPassthrough(source, encryption_key, parquet_file, **options), upload)
+        return ingest_result(ingest, encryption_key, "parquet", passthrough=True)
+
+    logger.info(f"Rewriting Parquet upload with the '{profile}' profile")
+    ingest = run_ingest(lambda column_types: ParquetIngest(source, encryption_key, column_types, **options), upload)
+    return ingest_result(ingest, encryption_key, "parquet", passthrough=False)
+
+
+def ingest_upload(source, upload, file_name="", progress=None, profile=None, parquet_copy=None):
+    """
+    Convert an upload in any supported format to encrypted Parquet and stream it
+    to object storage. Arguments and result are as for ``ingest_csv``.
+    Args:
+        file_name (str): The uploaded file name, used to tell text formats apart.
+    Raises:
+        IngestError: If the file is empty, malformed or in an unsupported format.
+    """
+    file_format, compression = detect_format(source, file_name)
+    logger.info(f"Ingesting upload as {file_format}" + (f" ({compression})" if compression else ""))
+    if file_format == "csv":
+        return ingest_csv(source, upload, progress, profile, parquet_copy, compression)
+    if file_format == "parquet":
+        return ingest_parquet(source, upload, progress, profile, parquet_copy)
+
+    source = _CountingReader(source)
+    if source.total == 0:
+        raise IngestError("Uploaded file is empty")
+    profile = profile or select_profile(source.total)
+    encryption_key = Fernet.generate_key()
+    if file_format == "jsonl":
+        make_ingest = functools.partial(JSONLinesIngest, compression=compression)
+    else:
+        make_ingest = ExcelIngest
+    ingest = run_ingest(
+        lambda column_types: make_ingest(
+            source, encryption_key, column_types, progress=progress, profile=profile, parquet_copy=parquet_copy
+        ),
+        upload,
+    )
+    logger.info(f"Successfully read {file_format} upload, rows: {ingest.rows}")
+    return ingest_result(ingest, encryption_key, file_format + (".gz" if compression else ""))
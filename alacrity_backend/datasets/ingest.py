@@ -0,0 +1,436 @@
+"""
+Streaming ingest pipeline for dataset uploads.
+
+The CSV is read in record batches, the batches are written out as Parquet row
+groups (sized by the write profile, see ``parquet_profiles.py``), the Parquet
+bytes are encrypted as they are produced and the ciphertext is sent to MinIO as
+a multipart upload. Only one row group (of at most ``ROW_GROUP_BUFFER_BLOCKS``
+blocks), one encryption segment and one upload part are held at a time, so the
+memory used does not depend on the size of the uploaded file or its row width.
+
+The working set is controlled by the settings below:
+
+    DATASET_INGEST_BLOCK_SIZE   bytes of CSV parsed per record batch
+    DATASET_PARQUET_PROFILE     write profile, or "auto" to choose by file size
+    DATASET_INGEST_PART_SIZE    bytes per multipart upload part (min 5 MiB)
+    DATASET_ENCRYPTION_SEGMENT_SIZE   plaintext bytes per encrypted frame
+"""
+
+import io
+import logging
+import re
+from itertools import chain
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from cryptography.fernet import Fernet
+from django.conf import settings
+
+from .charset import detect_encodings, get_max_scan
+from .dtypes import ColumnTypeError, cast_batch, dtype_name, logical_type, optimize_types_enabled, plan_schema
+from .encryption import DEFAULT_SEGMENT_SIZE, StreamEncryptor
+from .parquet_profiles import RowGroupWriter, select_profile
+
+
+logger = logging.getLogger(__name__)
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Column types are inferred from the first batch only. When a later batch does
+# not fit, the column is widened along this ladder and the upload is restarted.
+TYPE_PROMOTIONS = {
+    'null': pa.string(),
+    'bool': pa.string(),
+    'int8': pa.float64(),
+    'int16': pa.float64(),
+    'int32': pa.float64(),
+    'int64': pa.float64(),
+    'uint8': pa.float64(),
+    'uint16': pa.float64(),
+    'uint32': pa.float64(),
+    'uint64': pa.float64(),
+}
+CONVERSION_ERROR = re.compile(r"In CSV column #(\d+): .*CSV conversion error to (\w+)")
+
+
+class IngestError(Exception):
+    """Raised when an upload cannot be turned into a dataset (reported as a 400)."""
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def get_block_size():
+    return int(_setting('DATASET_INGEST_BLOCK_SIZE', 8 * 1024 * 1024))
+
+
+def get_part_size():
+    return max(MIN_PART_SIZE, int(_setting('DATASET_INGEST_PART_SIZE', 16 * 1024 * 1024)))
+
+
+def get_segment_size():
+    return int(_setting('DATASET_ENCRYPTION_SEGMENT_SIZE', DEFAULT_SEGMENT_SIZE))
+
+
+def arrow_schema_to_dtypes(schema):
+    """
+    Describe an Arrow schema with the type names stored in ``Dataset.schema``.
+    Args:
+        schema (pyarrow.Schema): The schema of the ingested table.
+    Returns:
+        dict: Column name to type name, e.g. ``{"age": "int64", "city": "object"}``.
+    """
+    return {field.name: dtype_name(field.type) for field in schema}
+
+
+def arrow_schema_to_logical_types(schema):
+    """
+    Describe an Arrow schema with the stored types kept in ``Dataset.logical_schema``.
+    Returns:
+        dict: Column name to type name, e.g. ``{"age": "int16", "city": "category"}``.
+    """
+    return {field.name: logical_type(field.type) for field in schema}
+
+
+class _ParquetSink(io.RawIOBase):
+    """Write-only buffer the Parquet writer flushes into; drained after every row group."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer = bytearray()
+        return data
+
+
+class IngestStream(io.RawIOBase):
+    """
+    Readable file object over a generator of byte chunks.
+
+    MinIO's ``put_object`` pulls ``part_size`` bytes at a time from it, which
+    drives the whole pipeline lazily.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = bytearray()
+        self._exhausted = False
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while not self._exhausted and (size is None or size < 0 or len(self._pending) < size):
+            try:
+                self._pending += next(self._chunks)
+            except StopIteration:
+                self._exhausted = True
+        if size is None or size < 0:
+            size = len(self._pending)
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        self.bytes_read += len(data)
+        return data
+
+
+class _CountingReader(io.RawIOBase):
+    """Wrap the source file and count the bytes the CSV reader has pulled, for progress reporting."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+        raw.seek(0, io.SEEK_END)
+        self.total = raw.tell()
+        raw.seek(0)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        position = self.raw.seek(offset, whence)
+        self.bytes_read = position
+        return position
+
+    def tell(self):
+        return self.raw.tell()
+
+
+class _SourceView(io.RawIOBase):
+    """
+    A view of the source for pyarrow readers. pyarrow closes the file objects it
+    wraps when they are garbage collected; closing a view leaves the source open
+    for the next attempt.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.source.read(size)
+
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.source.seek(offset, whence)
+
+    def tell(self):
+        return self.source.tell()
+
+
+class BatchIngest:
+    """
+    One streaming conversion of an upload into an encrypted Parquet object.
+
+    Subclasses implement :meth:`open_batches` for one input format. Iterating
+    :meth:`chunks` produces the ciphertext; ``rows`` and ``schema`` are filled
+    in as the input is consumed.
+    """
+
+    def __init__(self, source, encryption_key, column_types=None, progress=None, profile="balanced",
+                 parquet_copy=None, optimize_types=None):
+        self.source = source
+        self.optimize_types = optimize_types_enabled() if optimize_types is None else optimize_types
+        self.parquet_copy = parquet_copy
+        self.progress = progress
+        self.profile = profile
+        self.encryption_key = encryption_key
+        self.column_types = column_types if column_types is not None else {}
+        self.rows = 0
+        self.schema = None
+        self.reader_schema = None
+        # bytes of ciphertext uploaded, i.e. the size of the stored object
+        self.stored_size = 0
+
+    def open_batches(self):
+        """
+        Start reading the upload from the beginning.
+        Returns:
+            tuple: The Arrow schema and an iterator of record batches.
+        Raises:
+            ColumnTypeError: From the iterator, if a batch does not fit the schema.
+        """
+        raise NotImplementedError
+
+    def chunks(self):
+        self.source.seek(0)
+        self.reader_schema, batches = self.open_batches()
+        self.schema = self.reader_schema
+        if self.optimize_types:
+            # the stored types are chosen from the first batch, see dtypes.py
+            batches = iter(batches)
+            first = next(batches, None)
+            if first is not None:
+                self.schema = plan_schema(first, self.column_types)
+                batches = (cast_batch(batch, self.schema) for batch in chain([first], batches))
+
+        if self.parquet_copy is not None:
+            self.parquet_copy.seek(0)
+            self.parquet_copy.truncate()
+        encryptor = StreamEncryptor(self.encryption_key, segment_size=get_segment_size())
+        sink = _ParquetSink()
+        writer = RowGroupWriter(sink, self.schema, self.profile)
+        for batch in batches:
+            self.rows += batch.num_rows
+            if writer.write_batch(batch):
+                yield encryptor.update(self._drain(sink))
+            if self.progress:
+                self.progress(self.rows, self.source.bytes_read / max(self.source.total, 1))
+        writer.close()
+        yield encryptor.update(self._drain(sink))
+        yield encryptor.finalize()
+
+    def _drain(self, sink):
+        data = sink.drain()
+        if self.parquet_copy is not None:
+            self.parquet_copy.write(data)
+        return data
+
+
+class CSVIngest(BatchIngest):
+    """CSV uploads, optionally compressed (``compression`` is a pyarrow codec name such as ``gzip``)."""
+
+    def __init__(self, source, encoding, encryption_key, column_types=None, progress=None, profile="balanced",
+                 parquet_copy=None, compression=None):
+        super().__init__(source, encryption_key, column_types, progress, profile, parquet_copy)
+        self.encoding = encoding
+        self.compression = compression
+
+    def open_batches(self):
+        reader = pa_csv.open_csv(
+            open_input(self.source, self.compression),
+            read_options=pa_csv.ReadOptions(encoding=self.encoding, block_size=get_block_size()),
+            convert_options=pa_csv.ConvertOptions(column_types=self.column_types),
+        )
+        for field in reader.schema:
+            if pa.types.is_binary(field.type):
+                raise UnicodeDecodeError(self.encoding, b"", 0, 1, f"column '{field.name}' is not valid text")
+        return reader.schema, self._batches(reader)
+
+    def _batches(self, reader):
+        try:
+            yield from reader
+        except pa.ArrowInvalid as e:
+            match = CONVERSION_ERROR.search(str(e))
+            if match and match.group(2) != 'string':
+                raise ColumnTypeError([reader.schema.field(int(match.group(1))).name])
+            raise
+
+
+def open_input(source, compression=None):
+    """A readable stream over the source, decompressing it on the fly if ``compression`` is set."""
+    view = _SourceView(source)
+    if compression:
+        return pa.input_stream(view, compression=compression)
+    return view
+
+
+def widen_columns(columns, schema, column_types):
+    """
+    Widen columns one step along ``TYPE_PROMOTIONS``.
+    Returns:
+        bool: False if a column is already text and cannot be widened further.
+    """
+    for name in columns:
+        current = column_types.get(name, schema.field(name).type)
+        if pa.types.is_string(current) or pa.types.is_large_string(current):
+            return False
+        column_types[name] = TYPE_PROMOTIONS.get(str(current), pa.string())
+        logger.info(f"Widening column '{name}' from {current} to {column_types[name]} and restarting ingest")
+    return True
+
+
+def run_ingest(make_ingest, upload):
+    """
+    Stream one upload, restarting with wider column types whenever a later batch
+    does not fit the types inferred from the first one.
+    Args:
+        make_ingest (callable): Called as ``make_ingest(column_types)``; returns a ``BatchIngest``.
+        upload (callable): As for :func:`ingest_csv`.
+    Returns:
+        BatchIngest: The ingest that completed.
+    Raises:
+        IngestError: If a column cannot be widened any further.
+    """
+    column_types = {}
+    part_size = get_part_size()
+    while True:
+        ingest = make_ingest(column_types)
+        try:
+            stream = IngestStream(ingest.chunks())
+            upload(stream, part_size)
+            ingest.stored_size = stream.bytes_read
+            return ingest
+        except ColumnTypeError as e:
+            if e.types:
+                logger.info(f"Keeping the read types for {e.columns} and restarting ingest")
+                column_types.update(e.types)
+                continue
+            if not widen_columns(e.columns, ingest.reader_schema, column_types):
+                logger.error(f"Cannot widen columns {e.columns}")
+                raise IngestError(str(e))
+
+
+def ingest_result(ingest, encryption_key, file_format, **extra):
+    """The summary every ingest path returns."""
+    return {
+        "rows": ingest.rows,
+        "schema": arrow_schema_to_dtypes(ingest.schema),
+        "arrow_schema": ingest.schema,
+        "encryption_key": encryption_key,
+        "stored_size": ingest.stored_size,
+        "profile": ingest.profile,
+        "format": file_format,
+        **extra,
+    }
+
+
+def ingest_csv(source, upload, progress=None, profile=None, parquet_copy=None, compression=None):
+    """
+    Convert a CSV upload to encrypted Parquet and stream it to object storage.
+    Args:
+        source: A seekable binary file object containing the CSV.
+        upload (callable): Called as ``upload(stream, part_size)``; must consume
+            ``stream`` until it is exhausted (e.g. a MinIO multipart put).
+        progress (callable, optional): Called as ``progress(rows, fraction)`` after
+            every batch, where ``fraction`` is the share of the source read so far.
+        profile (str, optional): Parquet write profile; chosen from the file size if omitted.
+        parquet_copy (file, optional): Writable file that receives the unencrypted
+            Parquet as well, e.g. to profile the dataset once the upload is done.
+        compression (str, optional): Codec the CSV is compressed with, e.g. ``gzip``.
+    Returns:
+        dict: ``rows``, ``schema`` (column to dtype name), ``arrow_schema`` (the stored
+            ``pyarrow.Schema``), ``encryption_key``, ``stored_size``, ``encoding``, ``profile``
+            and ``format``.
+    Raises:
+        IngestError: If the file is empty, malformed or in an unsupported encoding.
+    """
+    if compression:
+        # charset detection only sees the start of a compressed file
+        with open_input(source, compression) as stream:
+            head = stream.read(get_max_scan())
+        encodings_to_try = detect_encodings(io.BytesIO(head))
+    else:
+        encodings_to_try = detect_encodings(source)
+    if not encodings_to_try:
+        raise IngestError("Uploaded file is empty")
+    source = _CountingReader(source)
+    profile = profile or select_profile(source.total)
+    logger.info(f"Writing Parquet with the '{profile}' profile")
+    encryption_key = Fernet.generate_key()
+
+    for encoding in encodings_to_try:
+        try:
+            logger.info(f"Attempting to read CSV with encoding: {encoding}")
+            ingest = run_ingest(
+                lambda column_types: CSVIngest(
+                    source, encoding, encryption_key, column_types, progress, profile, parquet_copy, compression
+                ),
+                upload,
+            )
+            logger.info(f"Successfully read CSV with encoding: {encoding}, rows: {ingest.rows}")
+            return ingest_result(ingest, encryption_key, "csv.gz" if compression else "csv", encoding=encoding)
+        except (UnicodeDecodeError, LookupError) as e:
+            logger.warning(f"Failed to read CSV with encoding {encoding}: {e}")
+        except pa.ArrowInvalid as e:
+            if "invalid UTF8" in str(e):
+                logger.warning(f"Failed to read CSV with encoding {encoding}: {e}")
+                continue
+            if "Empty CSV file" in str(e):
+                raise IngestError("Uploaded file is empty")
+            logger.error(f"Invalid CSV format: {e}")
+            raise IngestError("Invalid CSV file format")
+
+    logger.error("Unable to read CSV with any supported encoding")
+    raise IngestError("Unable to read the file: unsupported or invalid encoding")
@@ -0,0 +1,636 @@
+"""
+Asynchronous dataset ingestion.
+
+``CreateDatasetView`` stages the upload and queues an ``IngestionJob``; the
+actual work (cloud download, conversion, encryption and the MinIO upload) runs
+in a pool of worker threads that claim queued jobs straight from the database.
+
+Workers run either inside the web process (``DATASET_INGEST_WORKERS`` threads,
+started on the first upload) or as a separate process::
+
+    python manage.py run_ingest_workers --workers 4
+
+Progress and completion are pushed to the uploader over the ``user_{id}``
+channel group that ``users.consumers.UserConsumer`` listens on.
+
+Uploaded files are staged in MinIO under ``uploads/`` and queued with
+``staged_key`` set, whether the browser sent them straight to MinIO (see
+``uploads.py``) or through the request (``stage_upload``), so any worker on any
+host can run the job. The worker streams the staging object to local disk and
+deletes it when the job is done. ``staged_path`` is only read for jobs queued
+before files were staged in MinIO.
+
+Append jobs (``IngestionJob.KIND_APPEND``) go through the same pipeline but
+store the file as a new part of an existing dataset (see ``versions.py``).
+
+A running job's ``heartbeat_at`` is refreshed on a timer for as long as its
+worker is alive, whatever the job is doing (a cloud download can go minutes
+without progress). Each pool requeues jobs without a heartbeat for
+``DATASET_INGEST_STALE_AFTER`` seconds, when it starts and then periodically,
+and fails those already claimed ``DATASET_INGEST_MAX_ATTEMPTS`` times.
+
+The Google Drive access token of a cloud import is kept on the job encrypted
+with ``ENCRYPTION_KEY`` and cleared when the job ends.
+"""
+
+import hashlib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from alacrity_backend import storage
+from .dedup import (
+    claim_stored_object,
+    dedup_owner,
+    hash_file,
+    ingest_variant,
+    register_stored_object,
+    release,
+    reuse_profiles,
+    stored_result,
+)
+from .downloads import download_from_dropbox, download_from_google_drive, is_google_drive_url
+from .formats import ingest_upload
+from .ingest import IngestError, arrow_schema_to_logical_types
+from .models import Dataset, IngestionJob
+from .profiling import profile_stored_dataset, save_profiles
+from .versions import (
+    append_part,
+    check_append_columns,
+    ensure_manifest,
+    record_initial_version,
+    remove_object,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# progress is only saved and pushed when it moves by at least this many percent
+PROGRESS_STEP = 5
+# how often the pool aborts expired upload sessions, in seconds
+SESSION_SWEEP_INTERVAL = 600
+# how often the pool requeues jobs whose worker stopped, in seconds
+STALE_SWEEP_INTERVAL = 60
+# MinIO prefix of uploaded files waiting for a worker
+STAGING_PREFIX = "uploads"
+
+
+def get_stale_after():
+    return int(getattr(settings, 'DATASET_INGEST_STALE_AFTER', 600))
+
+
+def get_max_attempts():
+    return int(getattr(settings, 'DATASET_INGEST_MAX_ATTEMPTS', 3))
+
+
+def get_heartbeat_interval():
+    """Several heartbeats fit in the stale timeout, so one slow database write does not get a job requeued."""
+    return max(1.0, get_stale_after() / 5)
+
+
+def seal_token(token):
+    """Encrypt an OAuth token for storage on a job row."""
+    if not token:
+        return ''
+    return Fernet(settings.ENCRYPTION_KEY).encrypt(token.encode()).decode()
+
+
+def open_token(sealed):
+    try:
+        return Fernet(settings.ENCRYPTION_KEY).decrypt(sealed.encode()).decode()
+    except InvalidToken:
+        # queued before tokens were encrypted
+        return sealed
+
+
+def get_staging_dir():
+    """Local directory for a worker's temporary copies; nothing in it outlives a job."""
+    staging_dir = getattr(settings, 'DATASET_INGEST_STAGING_DIR', os.path.join(settings.BASE_DIR, 'ingest_staging'))
+    os.makedirs(staging_dir, exist_ok=True)
+    return staging_dir
+
+
+class _HashingReader:
+    """Pass an uploaded file to MinIO, hashing it on the way."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.digest.update(data)
+        return data
+
+
+def stage_upload(uploaded_file):
+    """
+    Copy an uploaded file to a staging object in MinIO so a worker on any host
+    can pick it up after the request has finished, hashing it on the way.
+    Args:
+        uploaded_file (UploadedFile): The file from ``request.FILES``.
+    Returns:
+        tuple: Key of the staging object and the SHA-256 of its content.
+    """
+    staged_key = f"{STAGING_PREFIX}/{uuid.uuid4()}/{os.path.basename(uploaded_file.name) or 'upload'}"
+    uploaded_file.seek(0)
+    reader = _HashingReader(uploaded_file)
+    storage.put_object(staged_key, reader, length=uploaded_file.size)
+    return staged_key, reader.digest.hexdigest()
+
+
+def enqueue_ingest_job(user, metadata, local_file=None, file_url=None, access_token=None, file_name=None,
+                       dataset=None, staged_key=None, file_size=0):
+    """
+    Queue a dataset upload for the worker pool.
+    Args:
+        user (User): The uploader.
+        metadata (dict): ``title``, ``category``, ``tags``, ``description`` and ``price``.
+        local_file (UploadedFile, optional): A file uploaded with the request.
+        file_url (str, optional): A Google Drive or Dropbox link to import instead.
+        access_token (str, optional): OAuth token for Google Drive.
+        file_name (str, optional): Name to use for cloud imports and staged objects.
+        dataset (Dataset, optional): Append the rows to this dataset instead of creating one.
+        staged_key (str, optional): A staging object in MinIO holding the file (see ``uploads.py``).
+        file_size (int, optional): Size of the staged object.
+    Returns:
+        IngestionJob: The queued job.
+    """
+    job = IngestionJob(user=user, metadata=metadata)
+    if dataset is not None:
+        job.kind = IngestionJob.KIND_APPEND
+        job.dataset = dataset
+    if local_file:
+        job.staged_key, job.content_hash = stage_upload(local_file)
+        job.file_name = local_file.name
+        job.file_size = local_file.size
+    elif staged_key:
+        job.staged_key = staged_key
+        job.file_name = file_name or 'uploaded_file'
+        job.file_size = file_size
+    else:
+        job.source_url = file_url
+        job.access_token = seal_token(access_token)
+        job.file_name = file_name or 'uploaded_file'
+    job.save()
+    logger.info(f"Queued ingestion job {job.job_id} for user {user.id}")
+    notify_job(job)
+    ensure_worker_pool()
+    return job
+
+
+def job_payload(job):
+    """The job fields shared by the status endpoint and the websocket events."""
+    return {
+        "job_id": job.job_id,
+        "status": job.status,
+        "stage": job.stage,
+        "progress": job.progress,
+        "dataset_id": job.dataset_id,
+        "error": job.error or None,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def notify_job(job):
+    """Push the job state to the uploader's ``user_{id}`` channel group."""
+    try:
+        channel_layer = get_channel_layer()
+        if channel_layer is None:
+            return
+        async_to_sync(channel_layer.group_send)(
+            f"user_{job.user_id}",
+            {
+                "type": "user_message",
+                "message": {"type": "dataset_ingestion", **job_payload(job)},
+            }
+        )
+    except Exception as e:
+        logger.warning(f"Could not send progress for ingestion job {job.job_id}: {e}")
+
+
+def _update_job(job, **fields):
+    for name, value in fields.items():
+        setattr(job, name, value)
+    job.heartbeat_at = timezone.now()
+    job.save(update_fields=list(fields) + ['heartbeat_at'])
+    notify_job(job)
+
+
+def claim_next_job(worker_name):
+    """
+    Claim the oldest queued job.
+    The claim is a conditional UPDATE, so several workers (threads or processes)
+    can poll the same table without handing out a job twice.
+    Args:
+        worker_name (str): Recorded on the job for debugging.
+    Returns:
+        IngestionJob | None: The claimed job, or None if the queue is empty.
+    """
+    for job_id in IngestionJob.objects.filter(status=IngestionJob.STATUS_QUEUED).values_list('job_id', flat=True)[:5]:
+        now = timezone.now()
+        claimed = IngestionJob.objects.filter(job_id=job_id, status=IngestionJob.STATUS_QUEUED).update(
+            status=IngestionJob.STATUS_RUNNING,
+            worker=worker_name,
+            started_at=now,
+            heartbeat_at=now,
+        )
+        if claimed:
+            job = IngestionJob.objects.get(job_id=job_id)
+            job.attempts += 1
+            job.save(update_fields=['attempts'])
+            return job
+    return None
+
+
+def requeue_stale_jobs():
+    """
+    Put running jobs whose worker stopped sending heartbeats back on the queue.
+    A job that has already been claimed ``DATASET_INGEST_MAX_ATTEMPTS`` times is
+    failed instead: it most likely takes its worker down with it (out of memory,
+    a crash in a reader) and would otherwise stop every worker in turn.
+    Returns:
+        int: Number of jobs requeued.
+    """
+    cutoff = timezone.now() - timedelta(seconds=get_stale_after())
+    stale = IngestionJob.objects.filter(status=IngestionJob.STATUS_RUNNING, heartbeat_at__lt=cutoff)
+    for job in stale.filter(attempts__gte=get_max_attempts()):
+        failed = stale.filter(job_id=job.job_id).update(
+            status=IngestionJob.STATUS_FAILED,
+            stage='failed',
+            error="Upload failed: the worker processing it stopped repeatedly",
+            finished_at=timezone.now(),
+        )
+        if not failed:
+            continue
+        job.refresh_from_db()
+        logger.error(f"Ingestion job {job.job_id} stopped its worker {job.attempts} times, giving up")
+        _cleanup(job)
+        notify_job(job)
+    requeued = stale.update(status=IngestionJob.STATUS_QUEUED, stage='queued', progress=0, worker='')
+    if requeued:
+        logger.warning(f"Requeued {requeued} stale ingestion job(s)")
+    return requeued
+
+
+class Heartbeat:
+    """
+    Refresh a running job's ``heartbeat_at`` every ``interval`` seconds from a
+    background thread, for as long as the ``with`` block runs.
+    """
+
+    def __init__(self, job, interval=None):
+        self.job_id = job.job_id
+        self.interval = get_heartbeat_interval() if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    IngestionJob.objects.filter(job_id=self.job_id, status=IngestionJob.STATUS_RUNNING).update(
+                        heartbeat_at=timezone.now(),
+                    )
+                except Exception as e:
+                    logger.warning(f"Could not record heartbeat of ingestion job {self.job_id}: {e}")
+        finally:
+            close_old_connections()
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name=f"ingest-heartbeat-{self.job_id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def _download_staged_object(job, destination):
+    """Copy a job's staging object to local disk, hashing it on the way."""
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in storage.stream_object(job.staged_key):
+        digest.update(chunk)
+        destination.write(chunk)
+        size += len(chunk)
+    destination.seek(0)
+    job.content_hash = digest.hexdigest()
+    job.file_size = size
+    job.save(update_fields=['content_hash', 'file_size'])
+    return destination
+
+
+def _open_source(job):
+    """Open the file a job should ingest, downloading it first for cloud imports and staged objects."""
+    if job.staged_path:
+        return open(job.staged_path, 'rb')
+    destination = tempfile.TemporaryFile(dir=get_staging_dir())
+    try:
+        if job.staged_key:
+            return _download_staged_object(job, destination)
+        if is_google_drive_url(job.source_url):
+            source, job.file_size = download_from_google_drive(
+                job.source_url, open_token(job.access_token), destination,
+            )
+        else:
+            source, job.file_size = download_from_dropbox(job.source_url, destination)
+    except Exception:
+        destination.close()
+        raise
+    return source
+
+
+def _cleanup(job):
+    if job.staged_path and os.path.exists(job.staged_path):
+        os.remove(job.staged_path)
+    if job.staged_key:
+        try:
+            storage.remove_object(job.staged_key)
+        except Exception as e:
+            logger.warning(f"Could not remove staging object {job.staged_key}: {e}")
+    if job.access_token:
+        job.access_token = ''
+        job.save(update_fields=['access_token'])
+
+
+def _profile_dataset(dataset, parquet_path=None, link=None):
+    """
+    Store the column statistics for the new version of a dataset. A failure here
+    does not fail the upload; the detail page computes the profile on first use instead.
+    Args:
+        dataset (Dataset): The dataset, at its new version.
+        parquet_path (str, optional): Local copy of the part just ingested; the
+            other parts of the version are downloaded next to it.
+        link (str, optional): Stored URL of that part.
+    """
+    try:
+        local = {link: parquet_path} if parquet_path else None
+        save_profiles(dataset, profile_stored_dataset(dataset, get_staging_dir(), local))
+    except Exception as e:
+        logger.warning(f"Could not profile dataset {dataset.dataset_id}: {e}", exc_info=True)
+
+
+def _append(job, result, stored_url, stored_object):
+    """Add an ingested (or reused) object to the job's dataset as a new part and version."""
+    from .views import convert_to_mbs
+
+    append_part(
+        job.dataset, stored_url, result["encryption_key"].decode(), result, result["stored_size"], job.user,
+        stored_object=stored_object,
+    )
+    Dataset.objects.filter(pk=job.dataset.pk).update(size=F('size') + Decimal(str(convert_to_mbs(job.file_size))))
+    job.dataset.refresh_from_db()
+    return job.dataset
+
+
+def _ingest(job, source, parquet_copy):
+    """
+    Convert, encrypt and upload a job's file.
+    Returns:
+        tuple: The ingest result and the MinIO key of the stored object.
+    """
+    base_name = job.file_name.split('.')[0] if '.' in job.file_name else job.file_name
+    minio_key = f"encrypted/{uuid.uuid4()}_{base_name}.parquet.enc"
+
+    def upload(stream, part_size):
+        storage.put_object(minio_key, stream, length=-1, part_size=part_size)
+
+    def progress(rows, fraction):
+        percent = min(99, int(fraction * 100))
+        if percent - job.progress >= PROGRESS_STEP:
+            _update_job(job, stage='converting', progress=percent)
+
+    _update_job(job, stage='converting', progress=0)
+    result = ingest_upload(source, upload, file_name=job.file_name, progress=progress, parquet_copy=parquet_copy)
+    return result, minio_key
+
+
+def run_job(job):
+    """
+    Run one claimed ingestion job to completion.
+    Args:
+        job (IngestionJob): A job in the running state.
+    Returns:
+        IngestionJob: The job, now completed or failed.
+    """
+    from .views import convert_to_mbs, generate_id
+
+    start_time = time.time()
+    parquet_copy = None
+    # the stored object reference this job holds until a part takes it over
+    claimed = None
+    try:
+        if job.kind == IngestionJob.KIND_APPEND:
+            if job.dataset is None:
+                raise IngestError("The dataset to append to no longer exists")
+            # datasets stored before manifests existed get one before their first append
+            ensure_manifest(job.dataset)
+        _update_job(job, stage='downloading' if job.source_url or job.staged_key else 'reading', progress=0)
+        source = _open_source(job)
+        # the plaintext Parquet is kept on local disk until the dataset has been profiled
+        parquet_copy = tempfile.NamedTemporaryFile(dir=get_staging_dir(), suffix='.parquet', delete=False)
+        try:
+            if not job.content_hash:
+                job.content_hash = hash_file(source)
+                job.save(update_fields=['content_hash'])
+            variant = ingest_variant(job.file_size)
+            owner = dedup_owner(job.user)
+            stored_object = claimed = claim_stored_object(job.content_hash, variant, owner)
+            if stored_object is not None:
+                logger.info(f"Ingestion job {job.job_id} matches stored object {stored_object.pk}, skipping conversion")
+                result = stored_result(stored_object)
+                _update_job(job, stage='deduplicated', progress=90)
+            else:
+                result, minio_key = _ingest(job, source, parquet_copy)
+        finally:
+            source.close()
+            parquet_copy.close()
+
+        if stored_object is None:
+            stored_url = storage.object_url(minio_key)
+            if job.kind == IngestionJob.KIND_APPEND:
+                try:
+                    check_append_columns(job.dataset, result["arrow_schema"])
+                except IngestError:
+                    remove_object(stored_url)
+                    raise
+            stored_object, created = register_stored_object(job.content_hash, variant, owner, stored_url, result)
+            claimed = stored_object
+            if not created:
+                # an identical upload finished first: use its object and drop ours
+                remove_object(stored_url)
+                result = stored_result(stored_object)
+        else:
+            if job.kind == IngestionJob.KIND_APPEND:
+                check_append_columns(job.dataset, result["arrow_schema"])
+        stored_url = stored_object.link
+        profile_path = None if result.get("deduplicated") else parquet_copy.name
+
+        if job.kind == IngestionJob.KIND_APPEND:
+            dataset = _append(job, result, stored_url, stored_object)
+        else:
+            metadata = job.metadata
+            # the dataset and its first version are recorded together or not at all
+            with transaction.atomic():
+                try:
+                    dataset = Dataset.objects.create(
+                        dataset_id=generate_id(),
+                        contributor_id=job.user,
+                        title=metadata.get('title'),
+                        tags=metadata.get('tags', ''),
+                        category=metadata.get('category'),
+                        link=stored_url,
+                        description=metadata.get('description'),
+                        encryption_key=stored_object.encryption_key,
+                        schema=result["schema"],
+                        logical_schema=arrow_schema_to_logical_types(result["arrow_schema"]),
+                        price=metadata.get('price', 0),
+                        number_of_rows=result["rows"],
+                        size=convert_to_mbs(job.file_size),
+                    )
+                except IntegrityError:
+                    raise IngestError("A dataset with this title and the same file already exists")
+                record_initial_version(
+                    dataset, stored_url, stored_object.encryption_key, result, result["stored_size"], job.user,
+                    stored_object=stored_object,
+                )
+        claimed = None
+        _update_job(job, stage='profiling', progress=99)
+        if profile_path is not None or job.kind == IngestionJob.KIND_APPEND or not reuse_profiles(dataset, stored_object):
+            _profile_dataset(dataset, profile_path, stored_url)
+        _update_job(
+            job,
+            status=IngestionJob.STATUS_COMPLETED,
+            stage='completed',
+            progress=100,
+            dataset=dataset,
+            file_size=job.file_size,
+            finished_at=timezone.now(),
+        )
+        logger.info(f"Ingestion job {job.job_id} completed in {time.time() - start_time:.2f}s")
+    except IngestError as e:
+        logger.error(f"Ingestion job {job.job_id} rejected: {e}")
+        _update_job(job, status=IngestionJob.STATUS_FAILED, stage='failed', error=str(e), finished_at=timezone.now())
+    except Exception as e:
+        logger.error(f"Ingestion job {job.job_id} failed: {e}", exc_info=True)
+        _update_job(job, status=IngestionJob.STATUS_FAILED, stage='failed', error=f"Upload failed: {e}", finished_at=timezone.now())
+    finally:
+        if claimed is not None:
+            release(claimed.pk)
+        if parquet_copy is not None and os.path.exists(parquet_copy.name):
+            os.remove(parquet_copy.name)
+        _cleanup(job)
+    return job
+
+
+def process_next_job(worker_name="inline"):
+    """
+    Claim and run a single job, sending heartbeats while it runs.
+    Returns:
+        IngestionJob | None: The job that was processed, or None if the queue was empty.
+    """
+    job = claim_next_job(worker_name)
+    if job is None:
+        return None
+    with Heartbeat(job):
+        return run_job(job)
+
+
+class IngestWorkerPool:
+    """A fixed number of threads polling the database queue for ingestion jobs."""
+
+    def __init__(self, workers=2, poll_interval=2.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+        self._next_sweep = 0
+        self._next_stale_sweep = 0
+
+    def _worker_name(self, index):
+        return f"{socket.gethostname()}:{os.getpid()}:{index}"
+
+    def _sweep_sessions(self):
+        from .uploads import abort_expired_sessions
+
+        if time.monotonic() < self._next_sweep:
+            return
+        self._next_sweep = time.monotonic() + SESSION_SWEEP_INTERVAL
+        try:
+            abort_expired_sessions()
+        except Exception as e:
+            logger.error(f"Could not abort expired upload sessions: {e}", exc_info=True)
+
+    def _requeue_stale(self):
+        if time.monotonic() < self._next_stale_sweep:
+            return
+        self._next_stale_sweep = time.monotonic() + STALE_SWEEP_INTERVAL
+        try:
+            requeue_stale_jobs()
+        except Exception as e:
+            logger.error(f"Could not requeue stale ingestion jobs: {e}", exc_info=True)
+
+    def _run(self, index):
+        worker_name = self._worker_name(index)
+        logger.info(f"Ingest worker {worker_name} started")
+        while not self._stop.is_set():
+            close_old_connections()
+            if index == 0:
+                self._requeue_stale()
+            try:
+                job = process_next_job(worker_name)
+            except Exception as e:
+                logger.error(f"Ingest worker {worker_name} error: {e}", exc_info=True)
+                job = None
+            if job is None:
+                if index == 0:
+                    self._sweep_sessions()
+                self._stop.wait(self.poll_interval)
+        close_old_connections()
+        logger.info(f"Ingest worker {worker_name} stopped")
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(index,), name=f"ingest-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def ensure_worker_pool():
+    """Start the in-process worker pool once, unless ``DATASET_INGEST_WORKERS`` is 0."""
+    global _pool
+    workers = getattr(settings, 'DATASET_INGEST_WORKERS', 2)
+    if workers <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = IngestWorkerPool(workers=workers).start()
+    return _pool
@@ -0,0 +1,50 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from django.core.management.base import BaseCommand, CommandError
+
+from datasets.parquet_profiles import PARQUET_PROFILES, benchmark_profiles
+
+
+def synthetic_table(rows, seed=42):
+    """A table with the column mix typical of uploaded datasets."""
+    rng = np.random.default_rng(seed)
+    return pa.table({
+        "id": np.arange(rows, dtype=np.int64),
+        "age": rng.integers(18, 90, rows),
+        "income": rng.normal(40000, 12000, rows),
+        "score": rng.random(rows),
+        "region": pa.array(rng.choice(["north", "south", "east", "west"], rows)),
+        "label": pa.array([f"item-{value}" for value in rng.integers(0, rows // 10 + 1, rows)]),
+    })
+
+
+class Command(BaseCommand):
+    help = "Compare the Parquet write profiles: write time, file size and DuckDB scan time."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--csv', help="CSV file to benchmark with (defaults to synthetic data)")
+        parser.add_argument('--rows', type=int, default=1_000_000, help="Rows of synthetic data")
+        parser.add_argument('--profiles', nargs='+', choices=sorted(PARQUET_PROFILES), help="Profiles to compare")
+        parser.add_argument('--repeat', type=int, default=3, help="Scans to average per profile")
+
+    def handle(self, *args, **options):
+        if options['csv']:
+            try:
+                table = pa_csv.read_csv(options['csv'])
+            except (OSError, pa.ArrowInvalid) as e:
+                raise CommandError(f"Could not read {options['csv']}: {e}")
+        else:
+            table = synthetic_table(options['rows'])
+
+        self.stdout.write(f"Benchmarking {table.num_rows} rows x {table.num_columns} columns "
+                          f"({table.nbytes / (1024 * 1024):.1f} MB in memory)")
+        results = benchmark_profiles(table, profiles=options['profiles'], repeat=options['repeat'])
+
+        self.stdout.write(f"{'profile':<12} {'write (s)':>10} {'size (MB)':>10} {'row groups':>11} {'scan (ms)':>10}")
+        for result in results:
+            self.stdout.write(
+                f"{result['profile']:<12} {result['write_seconds']:>10.2f} "
+                f"{result['size_bytes'] / (1024 * 1024):>10.2f} {result['row_groups']:>11} "
+                f"{result['scan_seconds'] * 1000:>10.1f}"
+            )
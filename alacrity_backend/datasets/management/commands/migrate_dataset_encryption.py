@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+
+from datasets.encryption import FORMAT_SEGMENTED
+from datasets.ingest import get_segment_size
+from datasets.jobs import get_staging_dir
+from datasets.models import Dataset, DatasetPart, StoredObject
+from datasets.versions import reencrypt_object, stored_format
+
+
+def stored_objects(dataset_id=None):
+    """Every distinct stored object as ``(link, encryption_key)``, parts first."""
+    parts = DatasetPart.objects.all()
+    datasets = Dataset.objects.filter(parts__isnull=True)
+    shared = StoredObject.objects.all()
+    if dataset_id:
+        parts = parts.filter(dataset_id=dataset_id)
+        datasets = datasets.filter(dataset_id=dataset_id)
+        shared = shared.filter(parts__dataset_id=dataset_id)
+    seen = set()
+    for queryset in (parts, datasets, shared):
+        for link, encryption_key in queryset.values_list('link', 'encryption_key').distinct():
+            if link not in seen:
+                seen.add(link)
+                yield link, encryption_key
+
+
+class Command(BaseCommand):
+    help = "Rewrite dataset objects stored as Fernet tokens in the segmented encryption format."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', help="Only migrate the objects of this dataset")
+        parser.add_argument('--limit', type=int, help="Stop after rewriting this many objects")
+        parser.add_argument('--dry-run', action='store_true', help="Only report the objects that would be rewritten")
+
+    def handle(self, *args, **options):
+        segment_size = get_segment_size()
+        rewritten = skipped = failed = 0
+        for link, encryption_key in stored_objects(options['dataset']):
+            if options['limit'] is not None and rewritten >= options['limit']:
+                break
+            try:
+                stored = stored_format(link)
+                if stored == FORMAT_SEGMENTED:
+                    skipped += 1
+                    continue
+                if options['dry_run']:
+                    self.stdout.write(f"would rewrite {link} ({stored})")
+                    rewritten += 1
+                    continue
+                size = reencrypt_object(link, encryption_key, segment_size, staging_dir=get_staging_dir())
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Could not migrate {link}: {e}")
+                continue
+            DatasetPart.objects.filter(link=link).update(size=size)
+            StoredObject.objects.filter(link=link).update(stored_size=size)
+            rewritten += 1
+            self.stdout.write(f"rewrote {link} ({stored}, now {size} bytes)")
+
+        verb = "would rewrite" if options['dry_run'] else "rewrote"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {rewritten} object(s), {skipped} already segmented, {failed} failed"
+        ))
@@ -0,0 +1,37 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from datasets.jobs import IngestWorkerPool, process_next_job, requeue_stale_jobs
+
+
+class Command(BaseCommand):
+    help = "Run a pool of dataset ingestion workers that poll the database queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help="Number of worker threads")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="Process the queued jobs and exit")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            requeue_stale_jobs()
+            processed = 0
+            while process_next_job("manage.py") is not None:
+                processed += 1
+            self.stdout.write(self.style.SUCCESS(f"Processed {processed} ingestion job(s)"))
+            return
+
+        pool = IngestWorkerPool(workers=options['workers'], poll_interval=options['poll_interval']).start()
+        self.stdout.write(self.style.SUCCESS(f"Started {options['workers']} ingestion worker(s)"))
+
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+        try:
+            while not stopped.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write("Stopping ingestion workers...")
+        pool.stop()
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from datasets.reconcile import sweep
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete objects in the bucket that no dataset, image or upload refers to. "
+        "Run it from cron; with --limit each run carries on where the last one stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, help="Keys to look at in this run (default: the rest of the bucket)")
+        parser.add_argument('--grace', type=int, help="Keep orphans younger than this many seconds (default: STORAGE_ORPHAN_GRACE)")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted")
+        parser.add_argument('--restart', action='store_true', help="Start a new pass from the first key")
+
+    def handle(self, *args, **options):
+        if options['limit'] is not None and options['limit'] <= 0:
+            raise CommandError("--limit must be positive")
+        grace = timedelta(seconds=options['grace']) if options['grace'] is not None else None
+        report = sweep(limit=options['limit'], grace=grace, dry_run=options['dry_run'], restart=options['restart'])
+        verb = "would reclaim" if options['dry_run'] else "reclaimed"
+        self.stdout.write(
+            f"Scanned {report['scanned']} object(s) ({report['bytes_scanned']} bytes); "
+            f"{report['orphans']} orphan(s) found, {report['deleted']} deleted"
+        )
+        status = "pass finished" if report['finished'] else "pass continues on the next run"
+        self.stdout.write(self.style.SUCCESS(f"Sweep {report['sweep']} {verb} {report['bytes_reclaimed']} bytes; {status}"))
@@ -0,0 +1,56 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from datasets.models import Dataset
+from datasets.object_cache import get_object_cache
+from datasets.versions import cache_object, get_parts
+
+
+class Command(BaseCommand):
+    help = "Fill the node-local dataset object cache, by default with the most accessed datasets."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', action='append', help="Dataset to cache (repeatable)")
+        parser.add_argument('--top', type=int, default=20, help="Number of most accessed datasets to cache")
+        parser.add_argument('--days', type=int, default=7, help="Window for counting accesses")
+        parser.add_argument('--stats', action='store_true', help="Only print the cache counters")
+        parser.add_argument('--clear', action='store_true', help="Empty the cache and reset its counters")
+
+    def handle(self, *args, **options):
+        cache = get_object_cache()
+        if cache is None:
+            raise CommandError("The object cache is disabled (DATASET_OBJECT_CACHE_ENABLED)")
+        if options['clear']:
+            cache.clear()
+            self.stdout.write(self.style.SUCCESS("Object cache cleared"))
+            return
+        if not options['stats']:
+            if options['dataset']:
+                datasets = Dataset.objects.filter(dataset_id__in=options['dataset'])
+            else:
+                since = timezone.now() - timedelta(days=options['days'])
+                datasets = (
+                    Dataset.objects.filter(is_deleted=False)
+                    .annotate(accesses=Count('access_metrics', filter=Q(access_metrics__access_time__gte=since)))
+                    .filter(accesses__gt=0)
+                    .order_by('-accesses')[:options['top']]
+                )
+            objects = failed = 0
+            for dataset in datasets:
+                for part in get_parts(dataset):
+                    try:
+                        cache_object(part)
+                        objects += 1
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"Could not cache {part.link}: {e}")
+            self.stdout.write(f"Cached {objects} object(s), {failed} failed")
+
+        stats = cache.stats()
+        self.stdout.write(self.style.SUCCESS(
+            f"{stats['entries']} entries, {stats['bytes']} of {stats['max_bytes']} bytes; "
+            f"{stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions"
+        ))
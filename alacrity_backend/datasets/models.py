@@ -22,6 +22,8 @@ class Dataset(models.Model):
     description = models.TextField(validators=[MinLengthValidator(10)])
     tags = models.JSONField(default=list)
     schema = models.JSONField()
+    # the stored type of each column (int16, float32, category, ...); empty for datasets stored before it was kept
+    logical_schema = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
@@ -34,6 +36,8 @@ class Dataset(models.Model):
     is_deleted = models.BooleanField(default=False)
     number_of_downloads = models.PositiveIntegerField(default=0)
     number_of_rows = models.PositiveIntegerField(default=0)
+    # the DatasetVersion readers load; appends add a version (see ``datasets/versions.py``)
+    version = models.PositiveIntegerField(default=1)
 
     # The size of the dataset in bytes (or any other unit you prefe   can be a decimal field if you want to allow for fractions)
     size = models.DecimalField(max_digits=10, decimal_places=2, default=0.00)
@@ -116,3 +120,279 @@ class DatasetAccessMetrics(models.Model):
     def __str__(self):
         return f"{self.action} by {self.user} on {self.dataset.title} at {self.access_time}"
 
+
+
+class IngestionJob(models.Model):
+    """
+    A queued dataset upload. Rows in this table are the work queue for the ingest
+    worker pool (see ``datasets/jobs.py``), so no external broker is needed.
+    """
+    KIND_CREATE = 'create'
+    KIND_APPEND = 'append'
+    KINDS = [
+        (KIND_CREATE, 'Create'),
+        (KIND_APPEND, 'Append'),
+    ]
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUSES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    job_id = models.CharField(max_length=100, primary_key=True, default=generate_id, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    # appends are queued with ``dataset`` already set to the dataset they extend
+    kind = models.CharField(max_length=10, choices=KINDS, default=KIND_CREATE)
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_QUEUED, db_index=True)
+    stage = models.CharField(max_length=50, default='queued')
+    progress = models.PositiveSmallIntegerField(default=0)
+    # where the worker reads the file from: a staged local file, a staged MinIO object or a cloud URL
+    staged_path = models.CharField(max_length=500, blank=True, default='')
+    staged_key = models.CharField(max_length=500, blank=True, default='')
+    source_url = models.CharField(max_length=1000, blank=True, default='')
+    access_token = models.TextField(blank=True, default='')
+    file_name = models.CharField(max_length=255, blank=True, default='')
+    file_size = models.PositiveBigIntegerField(default=0)
+    # SHA-256 of the uploaded bytes, used to reuse an identical stored object (see ``dedup.py``)
+    content_hash = models.CharField(max_length=64, blank=True, default='')
+    # title, category, tags, description and price for the Dataset row
+    metadata = models.JSONField(default=dict)
+    dataset = models.ForeignKey(Dataset, on_delete=models.SET_NULL, null=True, blank=True, related_name='ingestion_jobs')
+    error = models.TextField(blank=True, default='')
+    worker = models.CharField(max_length=100, blank=True, default='')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"Ingestion job {self.job_id} ({self.status})"
+
+
+class DatasetProfile(models.Model):
+    """
+    Column statistics for a dataset, computed once at ingest (see ``datasets/profiling.py``)
+    so the dataset detail page does not have to scan the data on every request.
+    There is one row for the raw data and one for the cleaned (``normalize``) view
+    of every dataset version.
+    """
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name='profiles')
+    version = models.PositiveIntegerField(default=1)
+    normalized = models.BooleanField(default=False)
+    total_rows = models.PositiveBigIntegerField(default=0)
+    columns = models.JSONField(default=list)
+    duplicate_rows = models.PositiveBigIntegerField(default=0)
+    missing_values = models.JSONField(default=dict)
+    numeric_stats = models.JSONField(default=dict)
+    # the top DATASET_PROFILE_TOP_K values of every text column
+    categorical_stats = models.JSONField(default=dict)
+    # the stored object the statistics were computed from; a profile is stale once the link changes
+    source_link = models.CharField(max_length=255)
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['dataset', 'version', 'normalized']
+
+    def __str__(self):
+        return f"Profile for {self.dataset.title} v{self.version} (normalized={self.normalized})"
+
+    def as_overview(self):
+        """The profile in the shape of the ``overview`` returned by the dataset detail endpoint."""
+        return {
+            "total_rows": self.total_rows,
+            "columns": self.columns,
+            "duplicate_rows": self.duplicate_rows,
+            "missing_values": self.missing_values,
+            "numeric_stats": self.numeric_stats,
+            "categorical_stats": self.categorical_stats,
+        }
+
+
+class StoredObject(models.Model):
+    """
+    An encrypted Parquet object in MinIO, shared by every dataset part made from
+    the same uploaded bytes by one organisation (see ``datasets/dedup.py``). ``ref_count`` is the number
+    of parts using it; the object is deleted when the last one goes.
+    """
+    content_hash = models.CharField(max_length=64)
+    # the ingest settings the object was written with; the same bytes written differently are another object
+    variant = models.CharField(max_length=100)
+    # the organisation (or user without one) whose uploads may share the object
+    owner = models.CharField(max_length=100, default='')
+    link = models.CharField(max_length=255)
+    encryption_key = models.CharField(max_length=255)
+    rows = models.PositiveBigIntegerField(default=0)
+    stored_size = models.PositiveBigIntegerField(default=0)
+    schema = models.JSONField(default=dict)
+    arrow_schema = models.TextField(blank=True, default='')
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['content_hash', 'variant', 'owner']
+
+    def __str__(self):
+        return f"Stored object {self.content_hash[:12]} ({self.ref_count} references)"
+
+
+class DatasetPart(models.Model):
+    """
+    One immutable encrypted Parquet object holding some of a dataset's rows.
+    A dataset starts with one part; every append adds another.
+    """
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name='parts')
+    # null for objects stored before deduplication, which belong to this part alone
+    stored_object = models.ForeignKey(StoredObject, on_delete=models.PROTECT, null=True, blank=True, related_name='parts')
+    sequence = models.PositiveIntegerField()
+    link = models.CharField(max_length=255)
+    encryption_key = models.CharField(max_length=255)
+    rows = models.PositiveBigIntegerField(default=0)
+    size = models.PositiveBigIntegerField(default=0)
+    # column types as stored in this part, before unification with the other parts
+    schema = models.JSONField(default=dict)
+    arrow_schema = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['dataset', 'sequence']
+        ordering = ['sequence']
+
+    def __str__(self):
+        return f"Part {self.sequence} of {self.dataset.title}"
+
+
+class DatasetVersion(models.Model):
+    """
+    The manifest of one dataset version: the parts readers load the union of.
+    Versions are never changed once written, so caches and profiles can be keyed by them.
+    """
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, related_name='versions')
+    number = models.PositiveIntegerField()
+    parts = models.ManyToManyField(DatasetPart, related_name='versions')
+    rows = models.PositiveBigIntegerField(default=0)
+    schema = models.JSONField(default=dict)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='dataset_versions')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ['dataset', 'number']
+        ordering = ['number']
+
+    def __str__(self):
+        return f"{self.dataset.title} v{self.number}"
+
+
+class UploadSession(models.Model):
+    """
+    A browser upload sent straight to MinIO as a presigned multipart upload
+    (see ``datasets/uploads.py``). Completing the session queues an
+    ``IngestionJob`` that reads the file from ``object_key``.
+    """
+    STATUS_OPEN = 'open'
+    STATUS_COMPLETED = 'completed'
+    STATUS_ABORTED = 'aborted'
+    STATUSES = [
+        (STATUS_OPEN, 'Open'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_ABORTED, 'Aborted'),
+    ]
+
+    session_id = models.CharField(max_length=100, primary_key=True, default=generate_id, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    # set for uploads that append to an existing dataset
+    dataset = models.ForeignKey(Dataset, on_delete=models.CASCADE, null=True, blank=True, related_name='upload_sessions')
+    metadata = models.JSONField(default=dict)
+    file_name = models.CharField(max_length=255)
+    file_size = models.PositiveBigIntegerField()
+    part_size = models.PositiveBigIntegerField()
+    # the staging object the parts are joined into, and the MinIO multipart upload id
+    object_key = models.CharField(max_length=500)
+    upload_id = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_OPEN, db_index=True)
+    job = models.OneToOneField(IngestionJob, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload_session')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        ordering = ['created_at']
+
+    @property
+    def part_count(self):
+        return max(1, -(-self.file_size // self.part_size))
+
+    def __str__(self):
+        return f"Upload session {self.session_id} ({self.status})"
+
+
+class StorageSweep(models.Model):
+    """
+    One pass of the orphan sweeper over the bucket (see ``datasets/reconcile.py``).
+    ``cursor`` is the last key looked at, so a pass can be spread over several runs.
+    """
+    dry_run = models.BooleanField(default=False)
+    cursor = models.CharField(max_length=1024, blank=True, default='')
+    objects_scanned = models.PositiveBigIntegerField(default=0)
+    bytes_scanned = models.PositiveBigIntegerField(default=0)
+    orphans_found = models.PositiveBigIntegerField(default=0)
+    objects_deleted = models.PositiveBigIntegerField(default=0)
+    bytes_reclaimed = models.PositiveBigIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    # null until the listing has reached the end of the bucket
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['started_at']
+
+    def __str__(self):
+        return f"Storage sweep {self.pk} ({'finished' if self.finished_at else 'at ' + (self.cursor or 'start')})"
+
+
+class CacheEviction(models.Model):
+    """
+    A copy of a dataset dropped from the in-memory analysis cache, and why
+    (see ``datasets/dataset_cache.py``). Used to size ``DATASET_CACHE_MAX_BYTES``
+    and ``DATASET_CACHE_IDLE_TTL``.
+    """
+    REASON_BUDGET = 'budget'
+    REASON_IDLE = 'idle'
+    REASON_SUPERSEDED = 'superseded'
+    REASON_CLEARED = 'cleared'
+    REASON_TOO_LARGE = 'too_large'
+    REASONS = [
+        (REASON_BUDGET, 'Byte budget exceeded'),
+        (REASON_IDLE, 'Idle past the TTL'),
+        (REASON_SUPERSEDED, 'Replaced by a newer version'),
+        (REASON_CLEARED, 'Cleared'),
+        (REASON_TOO_LARGE, 'Larger than the whole budget'),
+    ]
+
+    # not a foreign key: the dataset may be deleted while its copy is cached
+    dataset_id = models.CharField(max_length=100, db_index=True)
+    version = models.PositiveIntegerField()
+    variant = models.CharField(max_length=20)
+    reason = models.CharField(max_length=20, choices=REASONS, db_index=True)
+    size = models.PositiveBigIntegerField()
+    hits = models.PositiveIntegerField(default=0)
+    # seconds since the copy was loaded, and since it was last used
+    age = models.FloatField(default=0)
+    idle = models.FloatField(default=0)
+    # host:pid of the process whose cache it was
+    worker = models.CharField(max_length=100, blank=True, default='')
+    evicted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-evicted_at']
+
+    def __str__(self):
+        return f"{self.dataset_id} v{self.version} {self.variant} evicted ({self.reason})"
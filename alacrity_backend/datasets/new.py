@@ -16,13 +16,13 @@ from rest_framework.response import Response
 from rest_framework import status
 
 from payments.models import DatasetPurchase
+from .dtypes import is_numeric_dtype
 from .models import Dataset
 from .serializer import DatasetSerializer
 from rest_framework.views import APIView
 from users.decorators import role_required
 import pandas as pd
 import numpy as np
-from minio import Minio
 import io
 import duckdb
 import scipy.stats as stats
@@ -36,8 +36,6 @@ import seaborn as sns
 from io import BytesIO
 import base64
 from scipy.stats import linregress
-from collections import OrderedDict
-from threading import Lock
 from sklearn.preprocessing import LabelEncoder
 import json
 import tenseal as ts
@@ -47,8 +45,11 @@ import gzip
 import time
 from typing import List, Dict
 from django.http import HttpResponse
-from .pre_analysis import pre_analysis
-from alacrity_backend.settings import MINIO_ACCESS_KEY, MINIO_BUCKET_NAME, MINIO_SECRET_KEY, MINIO_URL, MINIO_SECURE
+from .profiling import get_current_profile, profile_stored_dataset, save_profiles
+from .dataset_cache import evict_dataset, get_cursor, is_cached
+from .jobs import get_staging_dir
+from .prefetch import schedule_prefetch
+from .versions import read_dataset_table
 from .models import DatasetAccessMetrics 
 from dataset_requests.models import DatasetRequest
 from django.utils import timezone  
@@ -57,17 +58,6 @@ from django.utils import timezone
 logger = logging.getLogger(__name__)
 
 
-minio_client = Minio(
-    endpoint=MINIO_URL, 
-    access_key=MINIO_ACCESS_KEY,
-    secret_key=MINIO_SECRET_KEY, 
-    secure=MINIO_SECURE
-    )
-BUCKET = "alacrity"
-DATASET_CACHE = OrderedDict()
-CACHE_LOCK = Lock()
-MAX_CACHE_SIZE = 100
-
 def get_jwt_hash(request):
     auth_header = request.headers.get("Authorization", "")
     if auth_header.startswith("Bearer "):
@@ -77,66 +67,28 @@ def get_jwt_hash(request):
 
 def load_dataset_into_cache(request, dataset_id, normalize=False):
     """
-    Load a dataset into cache and return the connection object.
-    If the dataset is already in cache and normalization is not requested,
-    return the existing connection object.
+    Check the user's access to a dataset and return a DuckDB cursor over its
+    cached copy, loading the copy first if needed. The copy is shared by every
+    user (see ``dataset_cache.py``); the cursor is this request's own and the
+    caller closes it.
     Args:
         request: Django request object
         dataset_id: ID of the dataset to load
-        normalize: Boolean indicating whether to normalize the dataset
+        normalize: Boolean indicating whether to query the cleaned data
 
     returns:
-        duckdb connection object for the loaded dataset
+        duckdb cursor with the dataset registered as ``temp``, or a 403 Response
 
     """
     has_access = has_access_to_dataset(request.user.id, dataset_id)
     if not has_access:
         return Response({"error": "You do not have access to this dataset"}, status=403)
-    jwt_hash = get_jwt_hash(request)
-    if not jwt_hash:
-        raise ValueError("No valid JWT token found")
-    cache_key = f"{dataset_id}:{jwt_hash}"
-    
-    with CACHE_LOCK:
-        if cache_key in DATASET_CACHE and DATASET_CACHE[cache_key]["normalized"] == normalize:
-            DATASET_CACHE.move_to_end(cache_key)
-            logger.info(f"Dataset {cache_key} retrieved from cache")
-            return DATASET_CACHE[cache_key]["con"]
-
-        try:
-            dataset = Dataset.objects.get(dataset_id=dataset_id)
-            cipher = Fernet(dataset.encryption_key.encode())
-            file_key = dataset.link.split(f"http://{MINIO_URL}/{BUCKET}/")[1]
-            response = minio_client.get_object(bucket_name=BUCKET, object_name=file_key)
-            encrypted_data = response.read()
-            decrypted_data = cipher.decrypt(encrypted_data)
-
-            parquet_file = io.BytesIO(decrypted_data)
-            df = pd.read_parquet(parquet_file, engine="pyarrow")
-            
-            if normalize:
-                # Clean data: remove duplicates and rows with missing values
-                df = df.drop_duplicates().dropna()
-                logger.info(f"Dataset {dataset_id} cleaned: duplicates and missing values removed")
-
-            con = duckdb.connect(":memory:")
-            con.register("temp", df)
-            
-            if cache_key in DATASET_CACHE:
-                DATASET_CACHE[cache_key]["con"].close()
-                del DATASET_CACHE[cache_key]
-            
-            if len(DATASET_CACHE) >= MAX_CACHE_SIZE:
-                oldest_key = next(iter(DATASET_CACHE))
-                DATASET_CACHE[oldest_key]["con"].close()
-                del DATASET_CACHE[oldest_key]
-            
-            DATASET_CACHE[cache_key] = {"con": con, "normalized": normalize}
-            logger.info(f"Dataset {cache_key} loaded into cache (normalized={normalize})")
-            return con
-        except Exception as e:
-            logger.error(f"Failed to load dataset {dataset_id}: {e}", exc_info=True)
-            raise
+    try:
+        dataset = Dataset.objects.get(dataset_id=dataset_id)
+        return get_cursor(dataset, normalize)
+    except Exception as e:
+        logger.error(f"Failed to load dataset {dataset_id}: {e}", exc_info=True)
+        raise
 
 def has_access_to_dataset(user_id, dataset_id):
 
@@ -203,39 +155,58 @@ def generate_pie_chart(series):
     buffer.close()
     return f"data:image/png;base64,{image_base64}"
 
+def get_dataset_profile(dataset, normalize=False):
+    """
+    Get the stored column statistics for a dataset.
+    Profiles are written at ingest time for every version; datasets stored before
+    that, or whose stored object has changed since, are profiled once here from
+    their Parquet parts on disk (not loaded into memory) and the result saved.
+    Args:
+        dataset: Dataset instance
+        normalize: Boolean indicating whether to return the profile of the cleaned data
+    returns:
+        DatasetProfile: the current profile
+    """
+    profile = get_current_profile(dataset, normalize)
+    if profile is not None:
+        return profile
+    logger.info(f"No current profile for dataset {dataset.dataset_id} version {dataset.version}, computing it")
+    return save_profiles(dataset, profile_stored_dataset(dataset, get_staging_dir()))[normalize]
+
 @api_view(['GET'])
 def dataset_detail(request, dataset_id):
 
     """
     Get detailed information about a dataset, including schema and overview.
-    The overview includes basic statistics and a pie chart for categorical columns.
+    The overview is the precomputed DatasetProfile, so the data is not loaded here;
+    ``is_loaded`` says whether the analyses will find it in the cache, and if not
+    it is queued for prefetching (see ``prefetch.py``).
     Args:
         request: Django request object
         dataset_id: ID of the dataset to get details for
     returns:
         Response: JSON response containing dataset details and overview
     """
-    has_access = has_access_to_dataset(request.user.id, dataset_id)
-    if not has_access:
-        return Response({"error": "You do not have access to this dataset"}, status=403)
     try:
-        dataset = Dataset.objects.get(dataset_id=dataset_id)
         normalize = request.GET.get("normalize", "false").lower() == "true"
         jwt_hash = get_jwt_hash(request)
         if not jwt_hash:
             return Response({"error": "Authentication required"}, status=401)
-        cache_key = f"{dataset_id}:{jwt_hash}"
-        
-        con = load_dataset_into_cache(request, dataset_id, normalize=normalize)
-        df = con.execute("SELECT * FROM temp").fetchdf()
-        overview = pre_analysis(df)
-      
-        
+
+        if not has_access_to_dataset(request.user.id, dataset_id):
+            return Response({"error": "You do not have access to this dataset"}, status=403)
+        dataset = Dataset.objects.get(dataset_id=dataset_id)
+        overview = get_dataset_profile(dataset, normalize).as_overview()
+        # the normalized copy is computed from the raw one, so only the raw copy is prefetched
+        is_loaded = is_cached(dataset, normalize)
+        if not is_cached(dataset):
+            schedule_prefetch([dataset.dataset_id], "opened")
+
         serializer = DatasetSerializer(dataset)
         data = serializer.data
-        data['is_loaded'] = cache_key in DATASET_CACHE
+        data['is_loaded'] = is_loaded
         data['overview'] = overview
-        data['normalized'] = DATASET_CACHE[cache_key]["normalized"]
+        data['normalized'] = normalize
         # update metrics
         DatasetAccessMetrics.objects.update_or_create(
             dataset=dataset,
@@ -255,7 +226,9 @@ def clear_dataset_cache(request, dataset_id):
 
     """
     Clear the cache for a specific dataset.
-    This will close the connection and remove the dataset from the cache.
+    The cached copies are shared by every user analysing the dataset, so only its
+    contributor drops them (to force a reload); for anyone else the copy is kept
+    and left to the cache's own eviction.
     Args:
 
         request: Django request object
@@ -271,13 +244,11 @@ def clear_dataset_cache(request, dataset_id):
         jwt_hash = get_jwt_hash(request)
         if not jwt_hash:
             return Response({"error": "Authentication required"}, status=401)
-        cache_key = f"{dataset_id}:{jwt_hash}"
-        with CACHE_LOCK:
-            if cache_key in DATASET_CACHE:
-                DATASET_CACHE[cache_key]["con"].close()
-                del DATASET_CACHE[cache_key]
-                logger.info(f"Cache cleared for {cache_key}")
-                return Response({"message": "Cache cleared"}, status=200)
+        if not Dataset.objects.filter(dataset_id=dataset_id, contributor_id=request.user.id).exists():
+            return Response({"message": "The cached copy is shared with other users and was kept"}, status=200)
+        if evict_dataset(dataset_id):
+            logger.info(f"Cache cleared for dataset {dataset_id}")
+            return Response({"message": "Cache cleared"}, status=200)
         return Response({"message": "No cache to clear"}, status=200)
     except Exception as e:
         logger.error(f"Error clearing cache for {dataset_id}: {e}", exc_info=True)
@@ -395,11 +366,15 @@ def calculate_chi_square(con, column1, column2, filter_query):
         contingency table, image of heatmap, and accuracy note
 
         """
-    query = f"SELECT {column1}, {column2} FROM temp"
+    # counted by DuckDB: only the contingency table is fetched, not the rows
+    query = f"SELECT {column1}, {column2}, COUNT(*) AS frequency FROM temp"
     if filter_query:
         query += f" WHERE {filter_query}"
-    df_result = con.execute(query).fetchdf()
-    contingency_table = df_result.pivot_table(index=column1, columns=column2, aggfunc='size', fill_value=0)
+    query += f" GROUP BY {column1}, {column2}"
+    counts = con.execute(query).fetchdf()
+    contingency_table = counts.pivot_table(
+        index=column1, columns=column2, values="frequency", aggfunc="sum", fill_value=0, observed=True,
+    ).astype(int)
     chi2, p, dof, expected = stats.chi2_contingency(contingency_table)
     
     plt.figure(figsize=(8, 6))
@@ -498,9 +473,9 @@ def calculate_correlation(con, column1, column2, filter_query, method="pearson")
     query = f"SELECT {column1}, {column2} FROM temp"
     if filter_query:
         query += f" WHERE {filter_query}"
+    # sampled by DuckDB, so at most 1000 rows are fetched
+    query = f"SELECT * FROM ({query}) USING SAMPLE reservoir(1000 ROWS) REPEATABLE (42)"
     df_result = con.execute(query).fetchdf()
-    if len(df_result) > 1000:
-        df_result = df_result.sample(n=1000, random_state=42)
     corr_func = stats.pearsonr if method == "pearson" else stats.spearmanr
     corr, p_value = corr_func(df_result[column1].dropna(), df_result[column2].dropna())
     
@@ -553,6 +528,7 @@ def analyze_dataset(request, dataset_id):
     filter_value = request.GET.get("filter_value")
     normalize = request.GET.get("normalize", "false").lower() == "true"
 
+    con = None
     try:
         if not operation:
             logger.error("No operation specified")
@@ -560,11 +536,12 @@ def analyze_dataset(request, dataset_id):
 
         logger.info(f"Performing {operation} on dataset {dataset_id}")
         dataset = Dataset.objects.get(dataset_id=dataset_id)
-        jwt_hash = get_jwt_hash(request)
-        cache_key = f"{dataset_id}:{jwt_hash}"
-        
         con = load_dataset_into_cache(request, dataset_id, normalize=normalize)
+        if isinstance(con, Response):
+            return con
         schema = dataset.schema
+        # the stored types, where they were recorded, decide which analyses a column allows
+        column_types = {**schema, **(dataset.logical_schema or {})}
 
         if column and column not in schema:
             return Response({"error": f"Column '{column}' not in schema"}, status=400)
@@ -580,8 +557,8 @@ def analyze_dataset(request, dataset_id):
             valid_operators = ["=", "!=", ">", ">=", "<", "<="]
             if filter_operator not in valid_operators:
                 return Response({"error": f"Invalid filter operator. Use one of: {valid_operators}"}, status=400)
-            col_type = schema[filter_column]
-            filter_query = f"{filter_column} {filter_operator} {float(filter_value) if col_type in ['int64', 'float64'] else filter_value}"
+            col_type = column_types[filter_column]
+            filter_query = f"{filter_column} {filter_operator} {float(filter_value) if is_numeric_dtype(col_type) else filter_value}"
 
         analysis_functions = {
             "mean": calculate_mean,
@@ -598,17 +575,17 @@ def analyze_dataset(request, dataset_id):
             return Response({"error": f"Unsupported operation: {operation}"}, status=400)
 
         if operation in ["mean", "median", "mode"]:
-            if not column or (schema[column] not in ["int64", "float64"] and operation != "mode"):
+            if not column or (not is_numeric_dtype(column_types[column]) and operation != "mode"):
                 return Response({"error": f"Numeric column required for {operation}"}, status=400)
             result = analysis_functions[operation](con, column, filter_query)
         else:
             if not (column1 and column2):
                 return Response({"error": f"Two columns required for {operation}"}, status=400)
-            if operation in ["t_test", "pearson", "spearman"] and (schema[column1] not in ["int64", "float64"] or schema[column2] not in ["int64", "float64"]):
+            if operation in ["t_test", "pearson", "spearman"] and (not is_numeric_dtype(column_types[column1]) or not is_numeric_dtype(column_types[column2])):
                 return Response({"error": f"Numeric columns required for {operation}"}, status=400)
             result = analysis_functions[operation](con, column1, column2, filter_query)
         
-        result["normalized"] = DATASET_CACHE[cache_key]["normalized"]
+        result["normalized"] = normalize
         return Response(result, status=200)
 
     except Dataset.DoesNotExist:
@@ -620,6 +597,9 @@ def analyze_dataset(request, dataset_id):
     except Exception as e:
         logger.error(f"Error in analyze_dataset: {e}", exc_info=True)
         return Response({"error": "Something went wrong"}, status=500)
+    finally:
+        if con is not None and not isinstance(con, Response):
+            con.close()
     
 
 
@@ -689,17 +669,21 @@ import json
 import threading
 
 
+# pandas dtypes whose values are encoded as ordinals of their sorted distinct values
+ORDINAL_DTYPES = ("object", "category", "datetime64")
+
+
 def encode_column(values: List, col_type: str) -> List[float]:
 
     """Encode values based on type for HE compatibility with improved efficiency.
 
     Args:
         values: List of values to encode
-        col_type: Data type of the column (e.g., 'object', 'int64', 'float64')
+        col_type: Data type of the column (e.g., 'object', 'category', 'int16', 'float32')
     returns:
         List of encoded values as floats
     """
-    if col_type.startswith("object") or any(isinstance(v, str) for v in values[:100] if not pd.isna(v)):
+    if col_type.startswith(ORDINAL_DTYPES) or any(isinstance(v, str) for v in values[:100] if not pd.isna(v)):
         unique_vals = pd.Series(values).dropna().unique()
         mapping = {val: float(i) for i, val in enumerate(sorted(unique_vals))}
        
@@ -748,34 +732,19 @@ def download_dataset(request, dataset_id):
         columns = request.GET.get("columns", None)
         
         compression_level = 9
-        max_rows = request.GET.get("max_rows")  # tried to add max_rows to limit the number of rows but i can do this later
-        max_rows = int(max_rows) if max_rows and max_rows.isdigit() else None
-
-        cipher = Fernet(dataset.encryption_key.encode())
-        expected_prefix = f"http://{MINIO_URL}/{BUCKET}/"
-        link = dataset.link
-        if not link.startswith(expected_prefix):
-            raise ValueError(f"Dataset link does not start with {expected_prefix}")
-        file_key = link.split(expected_prefix)[1]
-        response = minio_client.get_object(bucket_name=BUCKET, object_name=file_key)
-        encrypted_data = response.read()
-        decrypted_data = cipher.decrypt(encrypted_data)
-        parquet_buffer = io.BytesIO(decrypted_data)
-        df = pd.read_parquet(parquet_buffer, engine="pyarrow")
-        logger.info(f"Dataset {dataset_id} loaded, rows: {len(df)}, cols: {len(df.columns)}")
-        
-        if max_rows and max_rows < len(df):
-            df = df.head(max_rows)
-            
-        logger.info(f"Dataset {dataset_id} loaded, rows: {len(df)}, cols: {len(df.columns)}")
+        max_rows = request.GET.get("max_rows")
+        max_rows = int(max_rows) if max_rows and max_rows.isdigit() and int(max_rows) > 0 else None
 
-        # Filter columns
+        # only the requested columns and the row groups holding max_rows rows are fetched and decrypted
+        selected_cols = None
         if columns:
-            selected_cols = [col.strip() for col in columns.split(",") if col.strip() in df.columns]
-            if selected_cols:
-                df = df[selected_cols]
-            else:
+            selected_cols = list(dict.fromkeys(col.strip() for col in columns.split(",") if col.strip() in dataset.schema))
+            if not selected_cols:
                 logger.warning(f"No valid columns in {columns}, using all")
+                selected_cols = None
+
+        df = read_dataset_table(dataset, columns=selected_cols, max_rows=max_rows).to_pandas()
+        logger.info(f"Dataset {dataset_id} loaded, rows: {len(df)}, cols: {len(df.columns)}")
 
       
         optimized_schema = {}
@@ -793,7 +762,7 @@ def download_dataset(request, dataset_id):
         context.global_scale = 2**30  
         context.generate_galois_keys()
         def get_optimal_batch_size(col_type, values_len):
-            if col_type.startswith("object"):
+            if col_type.startswith(ORDINAL_DTYPES):
                 return min(8192, values_len)
             else:
                 return min(4096, values_len)
@@ -830,7 +799,7 @@ def download_dataset(request, dataset_id):
                 "column": column,
                 "encrypted": encrypted_batches,
                 "encoding_info": {
-                    "type": "categorical" if col_type.startswith("object") else "numeric",
+                    "type": "categorical" if col_type.startswith(ORDINAL_DTYPES) else "numeric",
                     "batch_size": batch_size,
                     "original_length": len(values),
                     "batches": len(batches)
@@ -0,0 +1,253 @@
+"""
+Node-local disk cache of stored dataset objects.
+
+Objects are cached exactly as they are stored in MinIO, still encrypted, under
+``DATASET_OBJECT_CACHE_DIR``. An entry is keyed by the object key and a version
+that changes when the object is rewritten in place (``migrate_dataset_encryption``),
+so a rewritten object is fetched again instead of being served stale: the stored
+size recorded on the part, which the migration updates, or the ETag for objects
+without one (see ``versions._open_cached``). The directory is shared by every
+worker process on the host:
+
+    * entries are written to a temporary file and renamed into place, so
+      readers never see a partial object;
+    * the modification time of an entry is its last use, and when the cache
+      grows past ``DATASET_OBJECT_CACHE_MAX_BYTES`` the least recently used
+      entries are deleted (under an exclusive lock on ``cache.lock``);
+    * hit, miss and eviction counters are kept in ``stats.json`` under the
+      same lock. Each process counts in memory and adds its counts to the file
+      at most every ``STATS_FLUSH_INTERVAL`` seconds, when ``stats`` is called
+      and at exit, so a hit does not take the lock.
+
+This tier sits below the in-memory ``DATASET_CACHE`` (``dataset_cache.py``): a dataset
+evicted from memory or lost with a process restart is reloaded from local disk.
+``versions.py`` is the only reader; ``warm_object_cache`` fills it ahead of use.
+"""
+
+import atexit
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+ENTRY_SUFFIX = ".enc"
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024 * 1024
+COUNTERS = ("hits", "misses", "evictions", "bytes_fetched")
+STATS_FLUSH_INTERVAL = 30
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def object_cache_enabled():
+    return bool(getattr(settings, 'DATASET_OBJECT_CACHE_ENABLED', True))
+
+
+def get_object_cache():
+    """The cache configured in the settings, or None if it is disabled."""
+    if not object_cache_enabled():
+        return None
+    directory = getattr(settings, 'DATASET_OBJECT_CACHE_DIR', os.path.join(tempfile.gettempdir(), "alacrity_object_cache"))
+    max_bytes = int(getattr(settings, 'DATASET_OBJECT_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES))
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None or cache.max_bytes != max_bytes:
+            if cache is not None:
+                cache.flush_stats()
+            cache = _caches[directory] = ObjectCache(directory, max_bytes)
+        return cache
+
+
+class ObjectCache:
+    """
+    A directory of encrypted objects with byte-based LRU eviction.
+    Args:
+        directory (str): Where entries are kept; created if missing.
+        max_bytes (int): Total size the entries may take up.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock_path = os.path.join(directory, "cache.lock")
+        self._stats_path = os.path.join(directory, "stats.json")
+        # counts not yet added to stats.json
+        self._pending = dict.fromkeys(COUNTERS, 0)
+        self._pending_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+        atexit.register(self._flush_at_exit)
+
+    def _key_prefix(self, key):
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def path(self, key, version):
+        """Where the entry for ``key`` at ``version`` is (or would be) stored."""
+        return os.path.join(self.directory, f"{self._key_prefix(key)}-{re.sub(r'[^A-Za-z0-9]', '', version)}{ENTRY_SUFFIX}")
+
+    @contextmanager
+    def _locked(self):
+        with open(self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_stats(self):
+        try:
+            with open(self._stats_path) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            stats = {}
+        return {name: int(stats.get(name, 0)) for name in COUNTERS}
+
+    def _count(self, **increments):
+        with self._pending_lock:
+            for name, value in increments.items():
+                self._pending[name] += value
+            if time.monotonic() - self._flushed_at < STATS_FLUSH_INTERVAL:
+                return
+        self.flush_stats()
+
+    def flush_stats(self):
+        """Add the counts of this process to ``stats.json``."""
+        with self._pending_lock:
+            pending = self._pending
+            self._pending = dict.fromkeys(COUNTERS, 0)
+            self._flushed_at = time.monotonic()
+        if not any(pending.values()):
+            return
+        with self._locked():
+            stats = self._read_stats()
+            for name, value in pending.items():
+                stats[name] += value
+            self._write_stats(stats)
+
+    def _write_stats(self, stats):
+        temporary = f"{self._stats_path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(stats, f)
+        os.replace(temporary, self._stats_path)
+
+    def _flush_at_exit(self):
+        if not os.path.isdir(self.directory):
+            return
+        try:
+            self.flush_stats()
+        except OSError as e:
+            logger.warning(f"Could not save the object cache counters: {e}")
+
+    def get(self, key, version):
+        """
+        The path of a cached object, marking it as just used.
+        Returns:
+            str | None: None on a miss.
+        """
+        path = self.path(key, version)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self._count(misses=1)
+            return None
+        self._count(hits=1)
+        return path
+
+    def put(self, key, version, chunks):
+        """
+        Store an object from an iterable of byte chunks, replacing older versions of the same key.
+        Returns:
+            str: The path of the new entry.
+        """
+        path = self.path(key, version)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        size = 0
+        try:
+            with os.fdopen(descriptor, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        prefix = self._key_prefix(key)
+        for name in os.listdir(self.directory):
+            stale = os.path.join(self.directory, name)
+            if name.startswith(prefix) and name.endswith(ENTRY_SUFFIX) and stale != path:
+                self._remove(stale)
+        self._count(bytes_fetched=size)
+        self.evict()
+        return path
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        """``(path, size, last used)`` of every entry, least recently used first."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits ``max_bytes``.
+        Returns:
+            int: Number of entries deleted.
+        """
+        with self._locked():
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            # the newest entry stays even if it alone is larger than the limit
+            for path, size, _ in entries[:-1]:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+                evicted += 1
+        if evicted:
+            self._count(evictions=evicted)
+            logger.info(f"Object cache evicted {evicted} entr{'y' if evicted == 1 else 'ies'}, {total} bytes in use")
+        return evicted
+
+    def stats(self):
+        """The shared counters plus the current number and size of entries."""
+        self.flush_stats()
+        with self._locked():
+            stats = self._read_stats()
+        entries = self.entries()
+        stats.update(entries=len(entries), bytes=sum(size for _, size, _ in entries), max_bytes=self.max_bytes)
+        return stats
+
+    def clear(self):
+        """Delete every entry and reset the counters."""
+        with self._pending_lock:
+            self._pending = dict.fromkeys(COUNTERS, 0)
+        with self._locked():
+            for path, _, _ in self.entries():
+                self._remove(path)
+            self._write_stats({name: 0 for name in COUNTERS})
@@ -0,0 +1,252 @@
+"""
+Parquet write profiles for stored datasets.
+
+Every dataset used to be written with zstd level 19, which is very slow to
+write for little gain over lower levels, and with whatever row-group layout the
+CSV batches happened to produce. A profile fixes the codec, level, row-group
+size, dictionary encoding and statistics together:
+
+    fast-ingest  snappy, large pages, no page index - for very large uploads
+    balanced     zstd 3, row groups of 122,880 rows (DuckDB's own row-group size,
+                 so every Parquet row group maps onto one DuckDB scan task)
+    archival     zstd 19, bigger row groups - best ratio for small files where
+                 the extra CPU time does not matter
+
+``select_profile`` picks one from the upload size unless ``DATASET_PARQUET_PROFILE``
+names one explicitly. ``manage.py benchmark_parquet_profiles`` compares them.
+
+The row-group size is a number of rows, so for wide rows a full row group can
+be far larger than the CSV blocks the ingest parses. ``RowGroupWriter``
+therefore also writes a row group out once it buffers ``ROW_GROUP_BUFFER_BLOCKS``
+times ``DATASET_INGEST_BLOCK_SIZE`` bytes, keeping the ingest's memory bounded
+by bytes whatever the row width.
+"""
+
+import io
+import logging
+import os
+import tempfile
+import time
+
+import duckdb
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+DUCKDB_ROW_GROUP_SIZE = 122880
+# a row group is written early once its buffered batches take this many ingest blocks
+ROW_GROUP_BUFFER_BLOCKS = 4
+
+PARQUET_PROFILES = {
+    "fast-ingest": {
+        "compression": "snappy",
+        "compression_level": None,
+        "row_group_size": DUCKDB_ROW_GROUP_SIZE,
+        "use_dictionary": True,
+        "write_statistics": True,
+        "write_page_index": False,
+        "data_page_size": 4 * 1024 * 1024,
+    },
+    "balanced": {
+        "compression": "zstd",
+        "compression_level": 3,
+        "row_group_size": DUCKDB_ROW_GROUP_SIZE,
+        "use_dictionary": True,
+        "write_statistics": True,
+        "write_page_index": True,
+        "data_page_size": 1024 * 1024,
+    },
+    "archival": {
+        "compression": "zstd",
+        "compression_level": 19,
+        "row_group_size": 4 * DUCKDB_ROW_GROUP_SIZE,
+        "use_dictionary": True,
+        "write_statistics": True,
+        "write_page_index": True,
+        "data_page_size": 1024 * 1024,
+    },
+}
+
+# (largest upload in bytes, profile); anything bigger uses fast-ingest
+DEFAULT_PROFILE_THRESHOLDS = [
+    (8 * 1024 * 1024, "archival"),
+    (1024 * 1024 * 1024, "balanced"),
+]
+
+
+def get_profile(name):
+    """
+    Look up a profile by name.
+    Raises:
+        ValueError: If there is no such profile.
+    """
+    if name not in PARQUET_PROFILES:
+        raise ValueError(f"Unknown Parquet profile '{name}'. Use one of: {sorted(PARQUET_PROFILES)}")
+    return PARQUET_PROFILES[name]
+
+
+def select_profile(file_size):
+    """
+    Choose the write profile for an upload.
+    Args:
+        file_size (int): Size of the upload in bytes (0 if unknown).
+    Returns:
+        str: The profile name.
+    """
+    configured = getattr(settings, 'DATASET_PARQUET_PROFILE', 'auto')
+    if configured != 'auto':
+        get_profile(configured)
+        return configured
+    thresholds = getattr(settings, 'DATASET_PARQUET_PROFILE_THRESHOLDS', DEFAULT_PROFILE_THRESHOLDS)
+    for limit, name in thresholds:
+        if file_size <= limit:
+            return name
+    return "fast-ingest"
+
+
+def matches_profile(metadata, profile_name):
+    """
+    Check whether an existing Parquet file is already laid out like a profile would
+    write it: the same codec for every column chunk, and row groups no bigger than
+    the profile's (and at least half that size, except for the last one).
+    Args:
+        metadata (pyarrow.parquet.FileMetaData): The file's footer.
+        profile_name (str): The profile to compare against.
+    Returns:
+        bool: True if the file can be stored as it is.
+    """
+    profile = get_profile(profile_name)
+    codec = profile["compression"].upper()
+    row_group_size = profile["row_group_size"]
+    last = metadata.num_row_groups - 1
+    for index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(index)
+        if row_group.num_rows > row_group_size:
+            return False
+        if index < last and row_group.num_rows < row_group_size // 2:
+            return False
+        for column in range(row_group.num_columns):
+            if row_group.column(column).compression.upper() != codec:
+                return False
+    return True
+
+
+def open_writer(sink, schema, profile_name):
+    """Create a ParquetWriter configured from a profile."""
+    profile = get_profile(profile_name)
+    return pq.ParquetWriter(
+        sink,
+        schema,
+        compression=profile["compression"],
+        compression_level=profile["compression_level"],
+        use_dictionary=profile["use_dictionary"],
+        write_statistics=profile["write_statistics"],
+        write_page_index=profile["write_page_index"],
+        data_page_size=profile["data_page_size"],
+    )
+
+
+def get_max_buffer_bytes():
+    return ROW_GROUP_BUFFER_BLOCKS * int(getattr(settings, 'DATASET_INGEST_BLOCK_SIZE', 8 * 1024 * 1024))
+
+
+class RowGroupWriter:
+    """
+    Collect record batches and write them out as row groups of the profile's size,
+    so the row-group layout no longer depends on how the CSV happened to be split.
+    A smaller row group is written when the buffered batches reach ``max_buffer_bytes``.
+    """
+
+    def __init__(self, sink, schema, profile_name, max_buffer_bytes=None):
+        self.writer = open_writer(sink, schema, profile_name)
+        self.row_group_size = get_profile(profile_name)["row_group_size"]
+        self.max_buffer_bytes = get_max_buffer_bytes() if max_buffer_bytes is None else max_buffer_bytes
+        self._batches = []
+        self._rows = 0
+        self._bytes = 0
+
+    def write_batch(self, batch):
+        """
+        Buffer a batch.
+        Returns:
+            bool: True if one or more row groups were written out.
+        """
+        self._batches.append(batch)
+        self._rows += batch.num_rows
+        self._bytes += batch.nbytes
+        if self._rows >= self.row_group_size:
+            table = pa.Table.from_batches(self._batches)
+            full = (self._rows // self.row_group_size) * self.row_group_size
+            self.writer.write_table(table.slice(0, full), row_group_size=self.row_group_size)
+            rest = table.slice(full)
+            self._batches = rest.to_batches() if rest.num_rows else []
+            self._rows = rest.num_rows
+            self._bytes = rest.nbytes
+            return True
+        if self._bytes >= self.max_buffer_bytes:
+            # wide rows: a short row group rather than an unbounded buffer
+            self._flush()
+            return True
+        return False
+
+    def _flush(self):
+        if self._batches:
+            self.writer.write_table(pa.Table.from_batches(self._batches), row_group_size=self.row_group_size)
+        self._batches = []
+        self._rows = 0
+        self._bytes = 0
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+
+
+def benchmark_profiles(table, profiles=None, repeat=3):
+    """
+    Write ``table`` with every profile and time a DuckDB scan over the result.
+    The scan aggregates every numeric column with a filter, which is the shape of
+    the queries the analysis endpoints run.
+    Args:
+        table (pyarrow.Table): The data to write.
+        profiles (list, optional): Profile names; defaults to all of them.
+        repeat (int): Number of scans to average.
+    Returns:
+        list: One dict per profile with ``profile``, ``write_seconds``, ``size_bytes``,
+            ``row_groups`` and ``scan_seconds``.
+    """
+    numeric = [field.name for field in table.schema if pa.types.is_integer(field.type) or pa.types.is_floating(field.type)]
+    aggregates = ", ".join(f'AVG("{name}")' for name in numeric) or "COUNT(*)"
+    where = f'WHERE "{numeric[0]}" IS NOT NULL' if numeric else ""
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in profiles or PARQUET_PROFILES:
+            path = os.path.join(directory, f"{name}.parquet")
+            started = time.perf_counter()
+            with open(path, "wb") as sink:
+                writer = RowGroupWriter(sink, table.schema, name)
+                for batch in table.to_batches():
+                    writer.write_batch(batch)
+                writer.close()
+            write_seconds = time.perf_counter() - started
+
+            con = duckdb.connect(":memory:")
+            try:
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    con.execute(f"SELECT COUNT(*), {aggregates} FROM read_parquet(?) {where}", [path]).fetchall()
+                scan_seconds = (time.perf_counter() - started) / repeat
+            finally:
+                con.close()
+
+            results.append({
+                "profile": name,
+                "write_seconds": write_seconds,
+                "size_bytes": os.path.getsize(path),
+                "row_groups": pq.ParquetFile(path).metadata.num_row_groups,
+                "scan_seconds": scan_seconds,
+            })
+    return results
@@ -0,0 +1,163 @@
+"""
+Loading datasets into the cache before a researcher's first request for them.
+
+Without this the first ``dataset_detail`` or ``analyze_dataset`` call after a
+researcher gets access pays the whole cold load: download, decryption and
+decoding. Datasets someone is likely to open soon are queued instead, and a
+background thread loads their raw copy through ``dataset_cache.get_entry``,
+which fills every tier on the way (the object cache on disk, the shared store
+and this process's cache). A dataset is queued
+
+    * when a request for it is approved (``dataset_requests.views.request_actions``),
+    * when it is bought (``payments.views.paypal_success``),
+    * when a researcher opens a dataset: the others they used most recently
+      (``DATASET_PREFETCH_RECENT``) are queued, as researchers go back and forth
+      between them.
+
+The thread only loads while the cache is quiet: no copy is being loaded and no
+request has asked for one for ``DATASET_PREFETCH_QUIET`` seconds, so prefetches
+do not compete with requests for downloads, CPU or memory. The most recently
+queued dataset is loaded first. Prefetching stays within its own memory budget
+(``DATASET_PREFETCH_MAX_BYTES``, see ``dataset_cache.py``) and never evicts a
+copy. ``DATASET_PREFETCH_ENABLED=false`` turns it off.
+
+The cache does not check access: a prefetched copy is served only through the
+views, which check it on every request.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from . import dataset_cache
+from .models import Dataset, DatasetAccessMetrics
+from .versions import get_parts
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUIET = 5
+DEFAULT_RECENT = 3
+MAX_QUEUED = 100
+POLL_INTERVAL = 1
+
+# dataset_id -> why it was queued, the most recently queued last
+PREFETCH_QUEUE = OrderedDict()
+_condition = threading.Condition()
+_worker = None
+
+
+def prefetch_enabled():
+    return bool(getattr(settings, 'DATASET_PREFETCH_ENABLED', True))
+
+
+def get_quiet_period():
+    return float(getattr(settings, 'DATASET_PREFETCH_QUIET', DEFAULT_QUIET))
+
+
+def get_recent():
+    return int(getattr(settings, 'DATASET_PREFETCH_RECENT', DEFAULT_RECENT))
+
+
+def schedule_prefetch(dataset_ids, reason):
+    """
+    Queue datasets to be loaded once the current transaction has committed.
+    Args:
+        dataset_ids (list): The datasets, the most likely to be needed last.
+        reason (str): Why they are queued, for the logs.
+    """
+    if not prefetch_enabled() or not dataset_ids:
+        return
+    dataset_ids = list(dataset_ids)
+    transaction.on_commit(lambda: enqueue(dataset_ids, reason))
+
+
+def enqueue(dataset_ids, reason):
+    global _worker
+    with _condition:
+        for dataset_id in dataset_ids:
+            PREFETCH_QUEUE.pop(dataset_id, None)
+            PREFETCH_QUEUE[dataset_id] = reason
+        while len(PREFETCH_QUEUE) > MAX_QUEUED:
+            PREFETCH_QUEUE.popitem(last=False)
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="dataset-prefetch", daemon=True)
+            _worker.start()
+        _condition.notify()
+    logger.info(f"Queued {len(dataset_ids)} dataset(s) for prefetching ({reason})")
+
+
+def warm(dataset_id, reason="manual"):
+    """
+    Load the raw copy of a dataset into the cache, unless it is cached already
+    or would not fit the prefetch budget.
+    Returns:
+        str: ``loaded``, ``cached``, ``over_budget`` or ``missing``.
+    """
+    dataset = Dataset.objects.filter(dataset_id=dataset_id, is_deleted=False).first()
+    if dataset is None:
+        return "missing"
+    if dataset_cache.is_cached(dataset):
+        return "cached"
+    # the stored size is a lower bound of the size in memory: skip what cannot fit without reading it
+    estimate = sum(part.size for part in get_parts(dataset))
+    if dataset_cache.stats()["bytes"] + estimate > dataset_cache.get_prefetch_max_bytes():
+        outcome = "over_budget"
+    else:
+        dataset_cache.get_entry(dataset, prefetch=True)
+        outcome = "loaded" if dataset_cache.is_cached(dataset) else "over_budget"
+    logger.info(f"Prefetch of dataset {dataset_id} ({reason}): {outcome}")
+    return outcome
+
+
+def _next():
+    """Wait for a queued dataset and a quiet cache, and take the dataset."""
+    with _condition:
+        while not PREFETCH_QUEUE:
+            _condition.wait()
+    quiet = get_quiet_period()
+    while not dataset_cache.is_quiet(quiet):
+        time.sleep(POLL_INTERVAL)
+    with _condition:
+        return PREFETCH_QUEUE.popitem() if PREFETCH_QUEUE else (None, None)
+
+
+def _run():
+    while True:
+        dataset_id, reason = _next()
+        if dataset_id is None:
+            continue
+        try:
+            warm(dataset_id, reason)
+        except Exception as e:
+            logger.warning(f"Could not prefetch dataset {dataset_id}: {e}", exc_info=True)
+        finally:
+            close_old_connections()
+
+
+@receiver(post_save, sender=DatasetAccessMetrics)
+def prefetch_recent_datasets(sender, instance, **kwargs):
+    """Queue the other datasets the user opened most recently and can still open."""
+    if not prefetch_enabled() or get_recent() <= 0:
+        return
+    from .new import has_access_to_dataset
+
+    recent = (
+        DatasetAccessMetrics.objects.filter(user_id=instance.user_id, dataset__is_deleted=False)
+        .exclude(dataset_id=instance.dataset_id).order_by('-access_time')
+        .values_list('dataset_id', flat=True)
+    )
+    dataset_ids = []
+    for dataset_id in recent:
+        if len(dataset_ids) >= get_recent():
+            break
+        if dataset_id not in dataset_ids and has_access_to_dataset(instance.user_id, dataset_id):
+            dataset_ids.append(dataset_id)
+    # the most recently opened is loaded first
+    schedule_prefetch(dataset_ids[::-1], "recently opened")
@@ -0,0 +1,247 @@
+"""
+Dataset profiles: the column statistics shown on the dataset detail page.
+
+They used to be computed with pandas (``pre_analysis``) on every detail request,
+over the whole table. They are now computed once with DuckDB, at ingest time
+over the Parquet file the pipeline writes, and stored as ``DatasetProfile`` rows:
+one for the raw data and one for the cleaned view (duplicates and rows with
+missing values removed), which is what ``?normalize=true`` shows.
+
+Profiles are stored per dataset version. Appending rows records a new version,
+which gets its own profile; the profiles of earlier versions stay valid.
+
+The statistics match ``pre_analysis``: row count, duplicate rows, missing values
+per column, ``describe()``-style summaries of numeric columns and value counts of
+text columns (limited to the ``DATASET_PROFILE_TOP_K`` most frequent values).
+"""
+
+import decimal
+import logging
+import math
+import os
+import tempfile
+
+import duckdb
+from django.conf import settings
+
+from .models import DatasetProfile
+from .versions import download_part, get_parts
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOP_K = 50
+NUMERIC_TYPES = {
+    'TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT',
+    'UTINYINT', 'USMALLINT', 'UINTEGER', 'UBIGINT', 'FLOAT', 'DOUBLE',
+}
+TEXT_TYPES = {'VARCHAR'}
+
+
+def get_top_k():
+    return int(getattr(settings, 'DATASET_PROFILE_TOP_K', DEFAULT_TOP_K))
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _json_value(value):
+    """Make a DuckDB result JSON safe (NaN and infinities become null)."""
+    if isinstance(value, decimal.Decimal):
+        value = float(value)
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def _is_numeric(type_name):
+    return type_name in NUMERIC_TYPES or type_name.startswith('DECIMAL')
+
+
+def _is_text(type_name):
+    return type_name in TEXT_TYPES or type_name.startswith('ENUM')
+
+
+def compute_profile(con, table="data", top_k=None):
+    """
+    Compute the profile of one table or view.
+    Args:
+        con (duckdb.DuckDBPyConnection): Connection holding the table.
+        table (str): Name of the table or view.
+        top_k (int, optional): Value counts kept per text column.
+    Returns:
+        dict: ``total_rows``, ``columns``, ``duplicate_rows``, ``missing_values``,
+            ``numeric_stats`` and ``categorical_stats``.
+    """
+    top_k = top_k or get_top_k()
+    relation = con.table(table)
+    columns = list(relation.columns)
+    types = {name: str(column_type) for name, column_type in zip(columns, relation.types)}
+    numeric = [name for name in columns if _is_numeric(types[name])]
+    text = [name for name in columns if _is_text(types[name])]
+
+    # one scan for the row count, missing values and numeric summaries
+    aggregates = ["COUNT(*)"] + [f"COUNT(*) - COUNT({_quote(name)})" for name in columns]
+    for name in numeric:
+        column = _quote(name)
+        aggregates += [
+            f"AVG({column})",
+            f"STDDEV_SAMP({column})",
+            f"MIN({column})",
+            f"QUANTILE_CONT({column}, [0.25, 0.5, 0.75])",
+            f"MAX({column})",
+        ]
+    row = con.execute(f"SELECT {', '.join(aggregates)} FROM {_quote(table)}").fetchone()
+
+    total_rows = row[0]
+    missing_values = {name: row[1 + index] for index, name in enumerate(columns)}
+    numeric_stats = {}
+    offset = 1 + len(columns)
+    for name in numeric:
+        mean, std, minimum, quartiles, maximum = row[offset:offset + 5]
+        offset += 5
+        quartiles = quartiles or [None, None, None]
+        numeric_stats[name] = {
+            "count": total_rows - missing_values[name],
+            "mean": _json_value(mean),
+            "std": _json_value(std),
+            "min": _json_value(minimum),
+            "25%": _json_value(quartiles[0]),
+            "50%": _json_value(quartiles[1]),
+            "75%": _json_value(quartiles[2]),
+            "max": _json_value(maximum),
+        }
+
+    distinct_rows = con.execute(f"SELECT COUNT(*) FROM (SELECT DISTINCT * FROM {_quote(table)})").fetchone()[0]
+
+    categorical_stats = {}
+    for name in text:
+        column = _quote(name)
+        counts = con.execute(
+            f"SELECT {column}, COUNT(*) AS n FROM {_quote(table)} WHERE {column} IS NOT NULL "
+            f"GROUP BY {column} ORDER BY n DESC, {column} LIMIT {int(top_k)}"
+        ).fetchall()
+        categorical_stats[name] = {str(value): count for value, count in counts}
+
+    return {
+        "total_rows": total_rows,
+        "columns": columns,
+        "duplicate_rows": total_rows - distinct_rows,
+        "missing_values": missing_values,
+        "numeric_stats": numeric_stats,
+        "categorical_stats": categorical_stats,
+    }
+
+
+def cleaned_query(con, table):
+    """
+    The query of the cleaned data ``load_dataset_into_cache(normalize=True)``
+    serves: no duplicates, no missing values.
+    """
+    columns = con.table(table).columns
+    condition = " AND ".join(f"{_quote(name)} IS NOT NULL" for name in columns) or "TRUE"
+    return f"SELECT DISTINCT * FROM {_quote(table)} WHERE {condition}"
+
+
+def _create_cleaned_view(con, table="data", view="cleaned"):
+    con.execute(f"CREATE OR REPLACE VIEW {_quote(view)} AS {cleaned_query(con, table)}")
+    return view
+
+
+def compute_profiles(con, table="data"):
+    """
+    Profile a table and its cleaned view.
+    Returns:
+        dict: ``{False: raw profile, True: cleaned profile}``.
+    """
+    return {
+        False: compute_profile(con, table),
+        True: compute_profile(con, _create_cleaned_view(con, table)),
+    }
+
+
+def profile_parquet_file(path):
+    """
+    Profile local Parquet files without loading them into memory.
+    Args:
+        path (str | list): One file, or the parts of a dataset version (read as
+            their union, columns matched by name).
+    """
+    con = duckdb.connect(":memory:")
+    try:
+        con.read_parquet(path, union_by_name=True).create_view("data")
+        return compute_profiles(con)
+    finally:
+        con.close()
+
+
+def profile_stored_dataset(dataset, directory=None, local=None):
+    """
+    Profile the current version of a stored dataset without loading it: its parts
+    are decrypted to local Parquet files, which DuckDB scans on disk.
+    Args:
+        dataset (Dataset): The dataset, at the version to profile.
+        directory (str, optional): Where the parts are downloaded; the temporary directory by default.
+        local (dict, optional): ``{link: path}`` of parts already on local disk.
+    """
+    downloaded = []
+    try:
+        paths = []
+        for part in get_parts(dataset):
+            if local and part.link in local:
+                paths.append(local[part.link])
+                continue
+            descriptor, path = tempfile.mkstemp(dir=directory, suffix='.parquet')
+            os.close(descriptor)
+            downloaded.append(path)
+            paths.append(download_part(part, path))
+        return profile_parquet_file(paths)
+    finally:
+        for path in downloaded:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def profile_arrow_table(table):
+    """Profile a ``pyarrow.Table`` (used for datasets stored before profiles existed)."""
+    con = duckdb.connect(":memory:")
+    try:
+        con.register("data", table)
+        return compute_profiles(con)
+    finally:
+        con.close()
+
+
+def save_profiles(dataset, profiles):
+    """
+    Store computed profiles for the current version of a dataset, replacing older ones.
+    Args:
+        dataset (Dataset): The dataset the profiles describe.
+        profiles (dict): As returned by :func:`compute_profiles`.
+    Returns:
+        dict: ``{normalized: DatasetProfile}``.
+    """
+    saved = {}
+    for normalized, profile in profiles.items():
+        saved[normalized], _ = DatasetProfile.objects.update_or_create(
+            dataset=dataset,
+            version=dataset.version,
+            normalized=normalized,
+            defaults={**profile, "source_link": dataset.link},
+        )
+    logger.info(f"Stored profile for dataset {dataset.dataset_id} version {dataset.version}")
+    return saved
+
+
+def get_current_profile(dataset, normalized=False):
+    """
+    The stored profile of the current version of a dataset, or None if there is
+    none or it was computed from an object the dataset no longer points to.
+    """
+    return DatasetProfile.objects.filter(
+        dataset=dataset,
+        version=dataset.version,
+        normalized=normalized,
+        source_link=dataset.link,
+    ).first()
@@ -0,0 +1,178 @@
+"""
+Storage reconciliation: find and delete objects nothing refers to.
+
+Objects outlive their rows in several ways: ``CreateDatasetView`` and the
+ingest workers write the encrypted object before the dataset can still be
+rejected, legacy datasets without parts leave their object behind when they
+are deleted, and a replaced profile picture or cover image keeps its original
+and variants. ``sweep`` lists the bucket in key order and deletes every object
+under one of ``MANAGED_PREFIXES`` that is
+
+* not referenced by a dataset, dataset part or stored object, a user's or an
+  organisation's image (or one of its variants), a submission image, an open
+  upload session or a queued or running ingestion job, and
+* older than the grace period (``STORAGE_ORPHAN_GRACE``), and than the oldest
+  running ingestion job, whose object is written before its row.
+
+Keys outside ``MANAGED_PREFIXES`` are never touched.
+
+The listing is incremental: a ``StorageSweep`` row keeps the last key looked
+at, so ``manage.py sweep_orphaned_objects --limit N`` looks at ``N`` keys per
+run and the next run carries on from there until the pass is finished. The
+references are reloaded before each batch of deletions, so a row saved while a
+pass is running still protects its object. Each run reports the objects and
+bytes reclaimed; a dry run only counts them.
+"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Min
+from django.utils import timezone
+
+from alacrity_backend import storage
+from organisation.models import Organization
+from research.models import AnalysisSubmission
+from users.models import User
+from .models import Dataset, DatasetPart, IngestionJob, StorageSweep, StoredObject, UploadSession
+
+
+logger = logging.getLogger(__name__)
+
+MANAGED_PREFIXES = ("encrypted/", "images/", "profile_pictures/", "submission_images/", "uploads/")
+DEFAULT_GRACE = 24 * 60 * 60
+DELETE_BATCH = 1000
+
+
+def get_grace():
+    return timedelta(seconds=int(getattr(settings, 'STORAGE_ORPHAN_GRACE', DEFAULT_GRACE)))
+
+
+def _variant_links(variants):
+    """The URLs in a ``{size: {format: url}}`` field."""
+    for formats in (variants or {}).values():
+        yield from (formats or {}).values()
+
+
+def referenced_keys():
+    """
+    The key of every object a row refers to.
+    Returns:
+        set: Object keys within ``storage.BUCKET``.
+    """
+    links = []
+    for link, analysis_link in Dataset.objects.values_list('link', 'analysis_link'):
+        links += [link, analysis_link]
+    links += DatasetPart.objects.values_list('link', flat=True)
+    links += StoredObject.objects.values_list('link', flat=True)
+    for picture, variants in User.objects.values_list('profile_picture', 'profile_picture_variants'):
+        links += [picture, *_variant_links(variants)]
+    images = Organization.objects.values_list(
+        'profile_picture', 'profile_picture_variants', 'cover_image', 'cover_image_variants',
+    )
+    for picture, picture_variants, cover, cover_variants in images:
+        links += [picture, *_variant_links(picture_variants), cover, *_variant_links(cover_variants)]
+    keys = {storage.object_key(link) for link in links if link}
+    # ImageField stores the key itself
+    keys.update(name for name in AnalysisSubmission.objects.values_list('image', flat=True) if name)
+    keys.update(UploadSession.objects.filter(status=UploadSession.STATUS_OPEN).values_list('object_key', flat=True))
+    keys.update(
+        IngestionJob.objects.filter(status__in=[IngestionJob.STATUS_QUEUED, IngestionJob.STATUS_RUNNING])
+        .exclude(staged_key='').values_list('staged_key', flat=True)
+    )
+    return keys
+
+
+def get_cutoff(grace=None):
+    """Objects modified after this time are kept whether or not they are referenced."""
+    cutoff = timezone.now() - (get_grace() if grace is None else grace)
+    oldest_job = IngestionJob.objects.filter(status=IngestionJob.STATUS_RUNNING).aggregate(start=Min('started_at'))['start']
+    return min(cutoff, oldest_job) if oldest_job else cutoff
+
+
+def is_managed(key):
+    return key.startswith(MANAGED_PREFIXES)
+
+
+def _current_sweep(dry_run):
+    sweep = StorageSweep.objects.filter(dry_run=dry_run, finished_at__isnull=True).order_by('-started_at').first()
+    return sweep or StorageSweep.objects.create(dry_run=dry_run)
+
+
+def _delete(candidates, dry_run):
+    """Delete the candidates still unreferenced; returns the number and bytes deleted."""
+    referenced = referenced_keys()
+    orphans = {key: size for key, size in candidates if key not in referenced}
+    if not dry_run and orphans:
+        failed = set(storage.remove_objects(list(orphans)))
+        for key in failed:
+            logger.warning(f"Could not delete orphaned object {key}")
+        orphans = {key: size for key, size in orphans.items() if key not in failed}
+    return len(orphans), sum(orphans.values())
+
+
+def sweep(limit=None, grace=None, dry_run=False, restart=False):
+    """
+    Look at the next ``limit`` keys of the current pass over the bucket and
+    delete the orphans among them.
+    Args:
+        limit (int, optional): Keys to look at in this run; all that are left by default.
+        grace (timedelta, optional): Overrides ``STORAGE_ORPHAN_GRACE``.
+        dry_run (bool): Only count the orphans. Dry runs keep a pass of their own.
+        restart (bool): Abandon the unfinished pass and start from the first key.
+    Returns:
+        dict: What this run scanned, found and reclaimed, and whether the pass is finished.
+    """
+    if restart:
+        StorageSweep.objects.filter(dry_run=dry_run, finished_at__isnull=True).update(finished_at=timezone.now())
+    current = _current_sweep(dry_run)
+    cutoff = get_cutoff(grace)
+    report = {"sweep": current.pk, "scanned": 0, "bytes_scanned": 0, "orphans": 0, "deleted": 0, "bytes_reclaimed": 0}
+    candidates = []
+    cursor = current.cursor
+
+    def flush():
+        deleted, reclaimed = _delete(candidates, dry_run) if candidates else (0, 0)
+        report["orphans"] += deleted
+        if not dry_run:
+            report["deleted"] += deleted
+        report["bytes_reclaimed"] += reclaimed
+        StorageSweep.objects.filter(pk=current.pk).update(
+            cursor=cursor,
+            objects_scanned=F('objects_scanned') + scanned[0],
+            bytes_scanned=F('bytes_scanned') + scanned[1],
+            orphans_found=F('orphans_found') + deleted,
+            objects_deleted=F('objects_deleted') + (0 if dry_run else deleted),
+            bytes_reclaimed=F('bytes_reclaimed') + reclaimed,
+            updated_at=timezone.now(),
+        )
+        candidates.clear()
+        scanned[:] = [0, 0]
+
+    # keys and bytes looked at since the last flush
+    scanned = [0, 0]
+    finished = True
+    for obj in storage.list_objects(start_after=current.cursor or None):
+        if limit is not None and report["scanned"] >= limit:
+            finished = False
+            break
+        cursor = obj.object_name
+        report["scanned"] += 1
+        report["bytes_scanned"] += obj.size or 0
+        scanned[0] += 1
+        scanned[1] += obj.size or 0
+        if is_managed(obj.object_name) and not obj.is_dir and obj.last_modified and obj.last_modified < cutoff:
+            candidates.append((obj.object_name, obj.size or 0))
+        if len(candidates) >= DELETE_BATCH:
+            flush()
+    flush()
+    if finished:
+        StorageSweep.objects.filter(pk=current.pk).update(finished_at=timezone.now())
+    report["finished"] = finished
+
+    logger.info(
+        f"Storage sweep {current.pk}: scanned {report['scanned']} object(s), {'found' if dry_run else 'deleted'} "
+        f"{report['orphans']} orphan(s), {report['bytes_reclaimed']} bytes{' (dry run)' if dry_run else ''}"
+    )
+    return report
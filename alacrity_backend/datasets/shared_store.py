@@ -0,0 +1,273 @@
+"""
+Node-local store of decoded dataset tables, shared by every process on the host.
+
+Each web, ASGI and worker process has its own in-memory ``DATASET_CACHE``
+(``dataset_cache.py``). Without this store a popular dataset would be
+downloaded, decrypted and decoded once per process and held once per process.
+Here the decoded table of a ``(dataset_id, version, variant)`` is written once,
+as an uncompressed Arrow IPC file under ``DATASET_SHARED_STORE_DIR`` (a tmpfs
+such as ``/dev/shm``). Every process memory-maps the file and registers the
+mapped table with DuckDB, so the rows are held in memory once per host and
+reading them copies nothing.
+
+Processes coordinate through the directory:
+
+    * an entry is written to a temporary file and renamed into place, so
+      readers never map a partial table;
+    * the process that builds an entry holds an exclusive lock on the
+      ``.lock`` file of its dataset and variant, so the others wait for it and
+      map its result instead of building the same table again. Lock files are
+      never deleted: a process holding or waiting on one must not find another
+      process locking a new file of the same name;
+    * ``index.json`` holds when each entry was last used. It is read and
+      written under an exclusive lock on ``store.lock``. When the entries take
+      more than ``DATASET_SHARED_STORE_MAX_BYTES`` the least recently used ones
+      are deleted, as are earlier versions of a variant once a new one is
+      written.
+
+Deleting a file that processes have mapped is safe: the pages stay valid until
+the last mapping goes, so eviction never has to wait for readers.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import pyarrow as pa
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+ENTRY_SUFFIX = ".arrow"
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024 * 1024
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def shared_store_enabled():
+    return bool(getattr(settings, 'DATASET_SHARED_STORE_ENABLED', True))
+
+
+def default_directory():
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(base, "alacrity_datasets")
+
+
+def get_shared_store():
+    """The store configured in the settings, or None if it is disabled."""
+    if not shared_store_enabled():
+        return None
+    directory = getattr(settings, 'DATASET_SHARED_STORE_DIR', None) or default_directory()
+    max_bytes = int(getattr(settings, 'DATASET_SHARED_STORE_MAX_BYTES', DEFAULT_MAX_BYTES))
+    with _stores_lock:
+        store = _stores.get(directory)
+        if store is None or store.max_bytes != max_bytes:
+            store = _stores[directory] = SharedTableStore(directory, max_bytes)
+        return store
+
+
+def _prefix(dataset_id, variant=None):
+    prefix = f"{re.sub(r'[^A-Za-z0-9_-]', '_', dataset_id)}."
+    return prefix if variant is None else f"{prefix}{variant}."
+
+
+def entry_name(key):
+    """The file name of ``(dataset_id, version, variant)``, without its suffix."""
+    dataset_id, version, variant = key
+    return f"{_prefix(dataset_id, variant)}v{version}"
+
+
+def map_table(path):
+    """Memory-map an Arrow IPC file as a table whose buffers point into the mapping."""
+    with pa.memory_map(path, 'r') as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+class SharedTableStore:
+    """
+    A directory of Arrow IPC tables with byte-based LRU eviction.
+    Args:
+        directory (str): Where entries are kept; created if missing.
+        max_bytes (int): Total size the entries may take up.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock_path = os.path.join(directory, "store.lock")
+        self._index_path = os.path.join(directory, "index.json")
+
+    def path(self, key):
+        return os.path.join(self.directory, entry_name(key) + ENTRY_SUFFIX)
+
+    def lock_path(self, key):
+        """The build lock of ``key``, shared by every version of its dataset and variant."""
+        return os.path.join(self.directory, _prefix(key[0], key[2]) + "lock")
+
+    @contextmanager
+    def _locked(self, path=None):
+        with open(path or self._lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self):
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        return index if isinstance(index, dict) else {}
+
+    def _write_index(self, index):
+        temporary = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(index, f)
+        os.replace(temporary, self._index_path)
+
+    def _touch(self, name):
+        with self._locked():
+            index = self._read_index()
+            index[name] = time.time()
+            self._write_index(index)
+
+    def get(self, key):
+        """
+        Map a stored table, marking it as just used.
+        Returns:
+            pyarrow.Table | None: None on a miss.
+        """
+        path = self.path(key)
+        try:
+            table = map_table(path)
+        except FileNotFoundError:
+            return None
+        self._touch(entry_name(key))
+        return table
+
+    def get_or_create(self, key, build):
+        """
+        Map a stored table, building and storing it first if no process has.
+        Args:
+            key (tuple): ``(dataset_id, version, variant)``.
+            build (callable): Returns the ``pyarrow.Table`` to store.
+        Returns:
+            pyarrow.Table: The mapped table, or the one just built if its entry was
+                evicted before it could be mapped.
+        """
+        table = self.get(key)
+        if table is not None:
+            return table
+        with self._locked(self.lock_path(key)):
+            # another process may have built it while this one waited
+            table = self.get(key)
+            if table is not None:
+                return table
+            table = build()
+            path = self.put(key, table)
+        try:
+            return map_table(path)
+        except FileNotFoundError:
+            return table
+
+    def put(self, key, table):
+        """
+        Write a table, deleting the earlier versions of the same dataset and variant.
+        Returns:
+            str: The path of the new entry.
+        """
+        path = self.path(key)
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        os.close(descriptor)
+        try:
+            with pa.OSFile(temporary, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        name = entry_name(key)
+        prefix = _prefix(key[0], key[2])
+        with self._locked():
+            index = self._read_index()
+            for other in self._names():
+                if other.startswith(prefix) and other[len(prefix) + 1:].isdigit() and int(other[len(prefix) + 1:]) < key[1]:
+                    self._remove(other, index)
+            index[name] = time.time()
+            self._write_index(index)
+        logger.info(f"Shared store wrote {name} ({os.path.getsize(path)} bytes)")
+        self.evict()
+        return path
+
+    def _names(self):
+        return [name[:-len(ENTRY_SUFFIX)] for name in os.listdir(self.directory) if name.endswith(ENTRY_SUFFIX)]
+
+    def _remove(self, name, index):
+        try:
+            os.remove(os.path.join(self.directory, name + ENTRY_SUFFIX))
+        except FileNotFoundError:
+            pass
+        index.pop(name, None)
+
+    def entries(self, index=None):
+        """``(name, size, last used)`` of every entry, least recently used first."""
+        index = self._read_index() if index is None else index
+        entries = []
+        for name in self._names():
+            try:
+                stat = os.stat(os.path.join(self.directory, name + ENTRY_SUFFIX))
+            except FileNotFoundError:
+                continue
+            # an entry missing from the index (its writer died before indexing it) counts from its mtime
+            entries.append((name, stat.st_size, index.get(name, stat.st_mtime)))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def evict(self):
+        """
+        Delete least recently used entries until the store fits ``max_bytes``.
+        Returns:
+            int: Number of entries deleted.
+        """
+        with self._locked():
+            index = self._read_index()
+            entries = self.entries(index)
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            # the newest entry stays even if it alone is larger than the limit
+            for name, size, _ in entries[:-1]:
+                if total <= self.max_bytes:
+                    break
+                self._remove(name, index)
+                total -= size
+                evicted += 1
+            if evicted:
+                self._write_index(index)
+        if evicted:
+            logger.info(f"Shared store evicted {evicted} entr{'y' if evicted == 1 else 'ies'}, {total} bytes in use")
+        return evicted
+
+    def stats(self):
+        entries = self.entries()
+        return {"entries": len(entries), "bytes": sum(size for _, size, _ in entries), "max_bytes": self.max_bytes}
+
+    def clear(self, dataset_id=None):
+        """Delete every entry, or those of one dataset."""
+        prefix = None if dataset_id is None else _prefix(dataset_id)
+        with self._locked():
+            index = self._read_index()
+            for name in self._names():
+                if prefix is None or name.startswith(prefix):
+                    self._remove(name, index)
+            self._write_index(index)
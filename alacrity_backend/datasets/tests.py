@@ -1,14 +1,32 @@
+import asyncio
+import base64
 import io
 import json
+import os
+import tempfile
 import uuid
+import gzip
+import shutil
 import hashlib
-from datetime import datetime
-from unittest.mock import MagicMock, patch
-
+import importlib.util
+import unittest
+import zipfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import duckdb
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet
 from django.contrib.auth import get_user_model
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.utils import timezone
 from rest_framework.test import APIClient
 from rest_framework_simplejwt.tokens import RefreshToken
@@ -16,19 +34,206 @@ from rest_framework_simplejwt.tokens import RefreshToken
 from organisation.models import Organization
 from dataset_requests.models import DatasetRequest
 from payments.models import DatasetPurchase
-from .models import Dataset, DatasetAccessMetrics
-from .views import CreateDatasetView, BUCKET
+from research.models import AnalysisSubmission
+from .models import (
+    CacheEviction, Dataset, DatasetAccessMetrics, DatasetPart, DatasetProfile, IngestionJob, StorageSweep, StoredObject, UploadSession,
+)
+from .dedup import claim_stored_object, release
+from .jobs import Heartbeat, claim_next_job, enqueue_ingest_job, open_token, process_next_job, requeue_stale_jobs
+from alacrity_backend import storage
+from alacrity_backend.storage import BUCKET
+from .views import CreateDatasetView
+from .charset import detect_encodings, read_samples
+from .downloads import DownloadError, RangedDownloader
+from .dtypes import dtype_name, is_numeric_dtype, logical_type, plan_schema
+from .encryption import (
+    FORMAT_SEGMENTED,
+    FRAMED_MAGIC,
+    SEGMENT_HEADER,
+    SEGMENTED_MAGIC,
+    TAG_SIZE,
+    StreamDecryptor,
+    decrypt_dataset_object,
+    encrypt_dataset_object,
+    object_format,
+)
+from .object_cache import get_object_cache
+from .uploads import ChunkError, abort_expired_sessions, get_part_size, receive_chunk
+from .pre_analysis import pre_analysis
+from .prefetch import PREFETCH_QUEUE, warm
+from .reconcile import sweep
+from .profiling import get_current_profile, profile_arrow_table, save_profiles
+from .versions import get_parts, parts_schema, read_dataset_table, read_part, read_parts
+from .parquet_profiles import PARQUET_PROFILES, RowGroupWriter, benchmark_profiles, select_profile
+from .ingest import IngestError, ingest_csv
+from .formats import detect_format, ingest_upload
+from .dataset_cache import DATASET_CACHE, cache_key, clean_data, evict_dataset, get_cursor, get_entry, is_cached, stats
+from .shared_store import SharedTableStore, get_shared_store
 from .new import (
     encode_column,
-    DATASET_CACHE,
-    CACHE_LOCK,
-    get_jwt_hash,
+    get_dataset_profile,
     has_access_to_dataset,
     load_dataset_into_cache,
 )
 
 User = get_user_model()
 
+
+def consume_upload(*args, **kwargs):
+    """Stand-in for MinIO put_object that drains the streamed upload like the real client does."""
+    kwargs['data'].read()
+    return MagicMock()
+
+
+class MemoryObjectStore:
+    """Stand-in for the MinIO client that keeps objects in a dict."""
+
+    def __init__(self):
+        self.objects = {}
+        self.modified = {}
+        self.fetched = []
+        self.bytes_served = 0
+
+    def put_object(self, bucket_name, object_name, data, length=-1, part_size=None, content_type=None, metadata=None):
+        self.objects[object_name] = data.read()
+        self.modified[object_name] = timezone.now()
+        return MagicMock()
+
+    def get_object(self, bucket_name, object_name, offset=0, length=None):
+        self.fetched.append(object_name)
+        data = self.objects[object_name]
+        data = data[offset:offset + length] if length is not None else data[offset:]
+        self.bytes_served += len(data)
+        chunks = lambda amt: [data[start:start + amt] for start in range(0, len(data), amt)]
+        return MagicMock(read=MagicMock(return_value=data), stream=MagicMock(side_effect=chunks))
+
+    def stat_object(self, bucket_name, object_name):
+        data = self.objects[object_name]
+        return MagicMock(size=len(data), etag=hashlib.md5(data).hexdigest())
+
+    def remove_object(self, bucket_name, object_name):
+        del self.objects[object_name]
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False, start_after=None):
+        for key in sorted(self.objects):
+            if key.startswith(prefix or "") and (start_after is None or key > start_after):
+                yield MagicMock(
+                    object_name=key, size=len(self.objects[key]), is_dir=False,
+                    last_modified=self.modified.get(key, timezone.now()),
+                )
+
+    def remove_objects(self, bucket_name, delete_object_list):
+        for item in delete_object_list:
+            self.objects.pop(item.name, None)
+        return iter([])
+
+    # multipart uploads whose parts are PUT by the browser
+    def _create_multipart_upload(self, bucket_name, object_name, headers):
+        upload_id = uuid.uuid4().hex
+        self.uploads = getattr(self, 'uploads', {})
+        self.uploads[upload_id] = {}
+        return upload_id
+
+    def get_presigned_url(self, method, bucket_name, object_name, expires=None, extra_query_params=None):
+        query = "&".join(f"{name}={value}" for name, value in (extra_query_params or {}).items())
+        return f"http://minio.test/{bucket_name}/{object_name}?{query}&X-Amz-Signature=test"
+
+    def upload_part(self, url):
+        """What the browser does with a presigned part URL: returns a PUT function."""
+        query = dict(item.split("=", 1) for item in url.split("?", 1)[1].split("&"))
+
+        def put(data):
+            etag = hashlib.md5(data).hexdigest()
+            self.uploads[query["uploadId"]][int(query["partNumber"])] = (etag, data)
+            return etag
+        return put
+
+    def _upload_part(self, bucket_name, object_name, data, headers, upload_id, part_number):
+        etag = hashlib.md5(data).hexdigest()
+        self.uploads[upload_id][part_number] = (etag, data)
+        return etag
+
+    def _list_parts(self, bucket_name, object_name, upload_id, part_number_marker=None):
+        parts = [
+            MagicMock(part_number=number, etag=etag, size=len(data))
+            for number, (etag, data) in sorted(self.uploads[upload_id].items())
+        ]
+        return MagicMock(parts=parts, is_truncated=False)
+
+    def _complete_multipart_upload(self, bucket_name, object_name, upload_id, parts):
+        uploaded = self.uploads.pop(upload_id)
+        for part in parts:
+            if uploaded[part.part_number][0] != part.etag:
+                raise ValueError("InvalidPart")
+        self.objects[object_name] = b"".join(uploaded[part.part_number][1] for part in parts)
+        return MagicMock()
+
+    def _abort_multipart_upload(self, bucket_name, object_name, upload_id):
+        self.uploads.pop(upload_id, None)
+
+
+class FileServer:
+    """
+    Local stand-in for Drive/Dropbox: serves one file, honours Range requests
+    (unless ``ranges`` is False) and can drop the connection part-way through
+    the first ``failures`` responses. With ``unknown_length`` partial replies
+    give no total size; with ``redirect`` every request is redirected there.
+    """
+
+    def __init__(self, content, ranges=True, failures=0, unknown_length=False, redirect=None, host="127.0.0.1"):
+        self.content = content
+        self.ranges = ranges
+        self.failures = failures
+        self.unknown_length = unknown_length
+        self.redirect = redirect
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                if server.redirect:
+                    self.send_response(302)
+                    self.send_header("Location", server.redirect)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                start, end = 0, len(server.content) - 1
+                header = self.headers.get("Range")
+                if server.ranges and header:
+                    first, last = header.split("=")[1].split("-")
+                    start, end = int(first), min(int(last), end)
+                    self.send_response(206)
+                    total = "*" if server.unknown_length else len(server.content)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{total}")
+                else:
+                    self.send_response(200)
+                body = server.content[start:end + 1]
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if server.failures > 0 and len(body) > 1:
+                    server.failures -= 1
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://{host}:{self.httpd.server_port}/file.csv"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@override_settings(DATASET_INGEST_STAGING_DIR=os.path.join(tempfile.gettempdir(), "alacrity_ingest_tests"))
 class DatasetViewTests(TestCase):
     def setUp(self):
         
@@ -95,17 +300,9 @@ class DatasetViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         return response.data['access_token']
 
-    @patch('datasets.views.minio_client.put_object')
-    @patch('pandas.read_csv')
-    @patch('pandas.DataFrame.to_parquet')
-    def test_create_dataset_local_file_success(self, mock_to_parquet, mock_read_csv, mock_minio_put):
+    @patch('alacrity_backend.storage.client', new_callable=MemoryObjectStore)
+    def test_create_dataset_local_file_success(self, store):
         """Test successful dataset creation with local file."""
-        mock_df = MagicMock()
-        mock_df.__len__.return_value = 2
-        mock_df.dtypes.items.return_value = [('name', 'object'), ('age', 'int64')]
-        mock_read_csv.return_value = mock_df
-        mock_to_parquet.return_value = None
-
         self.authenticate_user(self.admin_user)
 
         response = self.client.post(
@@ -114,32 +311,35 @@ class DatasetViewTests(TestCase):
             format='multipart'
         )
 
-        self.assertEqual(response.status_code, 201)
-        self.assertEqual(response.data['message'], 'Dataset created successfully')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['message'], 'Dataset upload accepted')
+        self.assertFalse(Dataset.objects.filter(title='Test Dataset').exists())
+        staged_key = IngestionJob.objects.get(job_id=response.data['job_id']).staged_key
+        self.assertTrue(staged_key.startswith('uploads/'))
+        self.assertIn(staged_key, store.objects)
+
+        job = process_next_job()
+        self.assertEqual(job.job_id, response.data['job_id'])
+        self.assertEqual(job.status, IngestionJob.STATUS_COMPLETED)
+        self.assertEqual(job.progress, 100)
         self.assertTrue(Dataset.objects.filter(title='Test Dataset').exists())
 
         dataset = Dataset.objects.get(title='Test Dataset')
         self.assertEqual(dataset.number_of_rows, 2)
+        self.assertEqual(dataset.schema, {'name': 'object', 'age': 'int64'})
         self.assertEqual(dataset.size, 0.0)  # Based on convert_to_mbs
         self.assertEqual(dataset.contributor_id, self.admin_user)
-        mock_minio_put.assert_called_once()
-
-    @patch('datasets.views.minio_client.put_object')
-    @patch('pandas.read_csv')
-    @patch('pandas.DataFrame.to_parquet')
-    @patch('requests.get')
-    def test_create_dataset_google_drive_success(self, mock_requests_get, mock_to_parquet, mock_read_csv, mock_minio_put):
+        # the staging object is gone; only the encrypted dataset is left
+        self.assertEqual(list(store.objects), [storage.object_key(dataset.link)])
+        profile = get_current_profile(dataset)
+        self.assertEqual(profile.total_rows, 2)
+        self.assertEqual(profile.numeric_stats['age']['max'], 30)
+        self.assertEqual(profile.categorical_stats['name'], {'Jane': 1, 'John': 1})
+
+    @patch('alacrity_backend.storage.client.put_object')
+    def test_create_dataset_google_drive_success(self, mock_minio_put):
         """Test successful dataset creation with Google Drive URL."""
-        mock_response = MagicMock()
-        mock_response.iter_content.return_value = [self.csv_content]
-        mock_response.raise_for_status.return_value = None
-        mock_requests_get.return_value = mock_response
-
-        mock_df = MagicMock()
-        mock_df.__len__.return_value = 2
-        mock_df.dtypes.items.return_value = [('name', 'object'), ('age', 'int64')]
-        mock_read_csv.return_value = mock_df
-        mock_to_parquet.return_value = None
+        mock_minio_put.side_effect = consume_upload
 
         self.authenticate_user(self.admin_user)
 
@@ -160,27 +360,18 @@ class DatasetViewTests(TestCase):
             format='multipart'
         )
 
-        self.assertEqual(response.status_code, 201)
-        self.assertEqual(response.data['message'], 'Dataset created successfully')
+        self.assertEqual(response.status_code, 202)
+        with FileServer(self.csv_content) as server:
+            with patch('datasets.downloads.google_drive_download_url', return_value=server.url):
+                self.assertEqual(process_next_job().status, IngestionJob.STATUS_COMPLETED)
+        self.assertTrue(all(headers.get('Authorization') == 'Bearer fake-token' for headers in server.requests))
         self.assertTrue(Dataset.objects.filter(title='Google Drive Dataset').exists())
         mock_minio_put.assert_called_once()
 
-    @patch('datasets.views.minio_client.put_object')
-    @patch('pandas.read_csv')
-    @patch('pandas.DataFrame.to_parquet')
-    @patch('requests.get')
-    def test_create_dataset_dropbox_success(self, mock_requests_get, mock_to_parquet, mock_read_csv, mock_minio_put):
+    @patch('alacrity_backend.storage.client.put_object')
+    def test_create_dataset_dropbox_success(self, mock_minio_put):
         """Test successful dataset creation with Dropbox URL."""
-        mock_response = MagicMock()
-        mock_response.iter_content.return_value = [self.csv_content]
-        mock_response.raise_for_status.return_value = None
-        mock_requests_get.return_value = mock_response
-
-        mock_df = MagicMock()
-        mock_df.__len__.return_value = 2
-        mock_df.dtypes.items.return_value = [('name', 'object'), ('age', 'int64')]
-        mock_read_csv.return_value = mock_df
-        mock_to_parquet.return_value = None
+        mock_minio_put.side_effect = consume_upload
 
         self.authenticate_user(self.admin_user)
 
@@ -200,11 +391,108 @@ class DatasetViewTests(TestCase):
             format='multipart'
         )
 
-        self.assertEqual(response.status_code, 201)
-        self.assertEqual(response.data['message'], 'Dataset created successfully')
+        self.assertEqual(response.status_code, 202)
+        with FileServer(self.csv_content) as server:
+            with patch('datasets.downloads.dropbox_download_url', return_value=server.url):
+                self.assertEqual(process_next_job().status, IngestionJob.STATUS_COMPLETED)
         self.assertTrue(Dataset.objects.filter(title='Dropbox Dataset').exists())
         mock_minio_put.assert_called_once()
 
+    @patch('datasets.jobs.get_channel_layer')
+    @patch('alacrity_backend.storage.client', new_callable=MemoryObjectStore)
+    def test_ingestion_job_progress_and_status(self, store, mock_get_channel_layer):
+        """Progress is pushed to the uploader's group and exposed by the status endpoint."""
+        channel_layer = MagicMock()
+        channel_layer.group_send = AsyncMock()
+        mock_get_channel_layer.return_value = channel_layer
+        self.authenticate_user(self.admin_user)
+
+        response = self.client.post('/datasets/create_dataset/', self.valid_dataset_data, format='multipart')
+        job_id = response.data['job_id']
+        status_response = self.client.get(f'/datasets/ingest_jobs/{job_id}/')
+        self.assertEqual(status_response.status_code, 200)
+        self.assertEqual(status_response.data['status'], IngestionJob.STATUS_QUEUED)
+
+        process_next_job()
+
+        group, event = channel_layer.group_send.call_args.args
+        self.assertEqual(group, f"user_{self.admin_user.id}")
+        self.assertEqual(event['type'], 'user_message')
+        self.assertEqual(event['message']['status'], IngestionJob.STATUS_COMPLETED)
+        status_response = self.client.get(f'/datasets/ingest_jobs/{job_id}/')
+        self.assertEqual(status_response.data['status'], IngestionJob.STATUS_COMPLETED)
+        self.assertIsNotNone(status_response.data['dataset_id'])
+
+        # other users cannot see the job
+        self.authenticate_user(self.contributor_user)
+        self.assertEqual(self.client.get(f'/datasets/ingest_jobs/{job_id}/').status_code, 404)
+
+    @patch('alacrity_backend.storage.client', new_callable=MemoryObjectStore)
+    def test_ingestion_job_invalid_csv_fails(self, store):
+        """A malformed CSV marks the job as failed without creating a dataset."""
+        self.authenticate_user(self.admin_user)
+        data = dict(self.valid_dataset_data)
+        data['file'] = SimpleUploadedFile("bad.csv", b"a,b\n1,2,3\n", content_type="text/csv")
+
+        self.client.post('/datasets/create_dataset/', data, format='multipart')
+        job = process_next_job()
+
+        self.assertEqual(job.status, IngestionJob.STATUS_FAILED)
+        self.assertEqual(job.error, 'Invalid CSV file format')
+        self.assertFalse(Dataset.objects.filter(title='Test Dataset').exists())
+
+    def test_ingestion_job_claimed_once_and_stale_requeued(self):
+        """A queued job is handed to a single worker, and comes back if that worker dies."""
+        job = IngestionJob.objects.create(user=self.admin_user, metadata={}, source_url='https://www.dropbox.com/s/x/a.csv')
+
+        self.assertEqual(claim_next_job("worker-a").job_id, job.job_id)
+        self.assertIsNone(claim_next_job("worker-b"))
+
+        IngestionJob.objects.filter(job_id=job.job_id).update(heartbeat_at=timezone.now() - timezone.timedelta(hours=1))
+        self.assertEqual(requeue_stale_jobs(), 1)
+        self.assertEqual(claim_next_job("worker-b").worker, "worker-b")
+
+    @override_settings(DATASET_INGEST_MAX_ATTEMPTS=2)
+    def test_job_that_keeps_stopping_its_worker_is_failed(self):
+        """A stale job claimed as often as the cap allows is failed and its staged file removed."""
+        staged = tempfile.NamedTemporaryFile(suffix='.upload', delete=False)
+        staged.close()
+        job = IngestionJob.objects.create(user=self.admin_user, metadata={}, staged_path=staged.name, file_name='a.csv')
+        long_ago = timezone.now() - timezone.timedelta(hours=1)
+
+        claim_next_job("worker-a")
+        IngestionJob.objects.filter(job_id=job.job_id).update(heartbeat_at=long_ago)
+        self.assertEqual(requeue_stale_jobs(), 1)
+        claim_next_job("worker-b")
+        IngestionJob.objects.filter(job_id=job.job_id).update(heartbeat_at=long_ago)
+        with patch('datasets.jobs.notify_job') as notify:
+            self.assertEqual(requeue_stale_jobs(), 0)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, IngestionJob.STATUS_FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertIn("stopped repeatedly", job.error)
+        self.assertFalse(os.path.exists(staged.name))
+        notify.assert_called_once()
+        self.assertIsNone(claim_next_job("worker-c"))
+
+    def test_running_job_sends_heartbeats_without_progress(self):
+        """Heartbeats come from a timer, so a long download does not make the job look stale."""
+        job = IngestionJob.objects.create(user=self.admin_user, metadata={}, source_url='https://www.dropbox.com/s/x/a.csv')
+        with patch('datasets.jobs.IngestionJob.objects') as objects:
+            with Heartbeat(job, interval=0.01):
+                time.sleep(0.1)
+        objects.filter.assert_called_with(job_id=job.job_id, status=IngestionJob.STATUS_RUNNING)
+        self.assertGreater(objects.filter.return_value.update.call_count, 1)
+
+    def test_drive_token_is_stored_encrypted(self):
+        job = enqueue_ingest_job(
+            self.admin_user, {}, file_url='https://drive.google.com/file/d/abc/view', access_token='ya29.secret',
+        )
+        job.refresh_from_db()
+        self.assertNotIn('ya29.secret', job.access_token)
+        self.assertEqual(open_token(job.access_token), 'ya29.secret')
+
     def test_create_dataset_unauthorized(self):
         """Test dataset creation without proper role."""
         self.authenticate_user(self.researcher_user)
@@ -239,17 +527,9 @@ class DatasetViewTests(TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.data['error'], 'Title is required and must be under 100 characters')
 
-    @patch('datasets.views.minio_client.put_object')
-    @patch('pandas.read_csv')
-    @patch('pandas.DataFrame.to_parquet')
-    def test_update_dataset_success(self, mock_to_parquet, mock_read_csv, mock_minio_put):
+    @patch('alacrity_backend.storage.client', new_callable=MemoryObjectStore)
+    def test_update_dataset_success(self, store):
         """Test successful dataset update."""
-        mock_df = MagicMock()
-        mock_df.__len__.return_value = 2
-        mock_df.dtypes.items.return_value = [('name', 'object'), ('age', 'int64')]
-        mock_read_csv.return_value = mock_df
-        mock_to_parquet.return_value = None
-
         self.authenticate_user(self.admin_user)
 
         # Create dataset
@@ -258,7 +538,7 @@ class DatasetViewTests(TestCase):
             self.valid_dataset_data,
             format='multipart'
         )
-        dataset_id = response.data['dataset_id']
+        dataset_id = process_next_job().dataset_id
 
         # Update dataset
         update_data = {
@@ -447,7 +727,7 @@ class DatasetCoreTests(TestCase):
         self.assertFalse(has_access_to_dataset(self.researcher_user.id, self.dataset.dataset_id))
 
 
-    @patch('datasets.new.minio_client.get_object')
+    @patch('alacrity_backend.storage.client.get_object')
     def test_load_dataset_into_cache_no_access(self, mock_minio_get):
         """Test load_dataset_into_cache with no access."""
         request = MagicMock()
@@ -472,35 +752,102 @@ class DatasetCoreTests(TestCase):
 
   
 
-    @patch('datasets.new.load_dataset_into_cache')
-    def test_clear_dataset_cache_success(self, mock_load_dataset):
-        """Test clear_dataset_cache success."""
-        mock_con = MagicMock()
-        mock_load_dataset.return_value = mock_con
+    def test_clear_dataset_cache_success(self):
+        """Test clear_dataset_cache success: the shared copy is only dropped by the contributor."""
+        key = cache_key(self.dataset)
+        DATASET_CACHE[key] = {"data": pd.DataFrame(), "parts": [], "schema": None, "bytes": 0, "hits": 0,
+                              "loaded_at": time.monotonic(), "last_used": time.monotonic()}
+        self.addCleanup(DATASET_CACHE.pop, key, None)
 
-        DatasetRequest.objects.create(
-            dataset_id=self.dataset,
-            researcher_id=self.researcher_user,
-            request_status='approved'
-        )
         self.authenticate_user(self.researcher_user)
+        response = self.client.post(f"/datasets/clear_cache/{self.dataset.dataset_id}/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(key, DATASET_CACHE)
 
-        request = MagicMock()
-        request.user.id = self.researcher_user.id
-        request.headers = {"Authorization": "Bearer fake-token"}
-        load_dataset_into_cache(request, self.dataset.dataset_id)
-
+        self.authenticate_user(self.dataset.contributor_id)
         response = self.client.post(f"/datasets/clear_cache/{self.dataset.dataset_id}/")
         self.assertEqual(response.status_code, 200)
-       
-        cache_key = f"{self.dataset.dataset_id}:{hashlib.sha256('fake-token'.encode()).hexdigest()}"
-        self.assertNotIn(cache_key, DATASET_CACHE)
+        self.assertEqual(response.data["message"], "Cache cleared")
+        self.assertNotIn(key, DATASET_CACHE)
 
 
 
 
  
 
+    @patch('alacrity_backend.storage.client.get_object')
+    @patch('datasets.new.schedule_prefetch')
+    def test_dataset_detail_reads_stored_profile(self, mock_prefetch, mock_minio_get):
+        """The detail overview comes from the stored profile, without reading the data."""
+        self.dataset.price = 0
+        self.dataset.save()
+        DatasetRequest.objects.create(dataset_id=self.dataset, researcher_id=self.researcher_user, request_status='approved')
+        save_profiles(self.dataset, profile_arrow_table(pa.Table.from_pandas(pd.read_parquet(self.parquet_data))))
+        self.authenticate_user(self.researcher_user)
+        response = self.client.get(f"/datasets/details/{self.dataset.dataset_id}/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["overview"]["total_rows"], 2)
+        self.assertEqual(response.data["overview"]["categorical_stats"]["name"], {"Alice": 1, "Bob": 1})
+        self.assertFalse(response.data["is_loaded"])
+        mock_minio_get.assert_not_called()
+        mock_prefetch.assert_called_once_with([self.dataset.dataset_id], "opened")
+        self.assertNotIn(cache_key(self.dataset), DATASET_CACHE)
+
+    @patch('datasets.new.load_dataset_into_cache')
+    def test_analyze_accepts_narrow_numeric_types(self, mock_load_dataset):
+        """Columns stored as int16/float32 pass the numeric checks; category columns do not."""
+        self.dataset.schema = {"name": "object", "age": "int64", "score": "float64"}
+        self.dataset.logical_schema = {"name": "category", "age": "int16", "score": "float32"}
+        self.dataset.save()
+        self.authenticate_user(self.researcher_user)
+        df = pd.DataFrame({
+            "name": pd.Categorical(["Alice", "Bob"]),
+            "age": pd.Series([30, 20], dtype="int16"),
+            "score": pd.Series([1.5, 2.5], dtype="float32"),
+        })
+
+        def load(request, dataset_id, normalize=False):
+            con = duckdb.connect(":memory:")
+            con.register("temp", df)
+            return con
+
+        mock_load_dataset.side_effect = load
+        url = f"/datasets/datasets/analyze/{self.dataset.dataset_id}/"
+        mean = self.client.get(url, {"operation": "mean", "column": "age", "filter_column": "score",
+                                     "filter_operator": ">", "filter_value": "2"})
+        correlation = self.client.get(url, {"operation": "pearson", "column1": "age", "column2": "score"})
+        rejected = self.client.get(url, {"operation": "mean", "column": "name"})
+
+        self.assertEqual(mean.status_code, 200)
+        self.assertEqual(mean.data["value"], 20.0)
+        self.assertEqual(correlation.status_code, 200)
+        self.assertEqual(rejected.status_code, 400)
+
+    @patch('datasets.new.load_dataset_into_cache')
+    def test_chi_square_fetches_counts_only(self, mock_load_dataset):
+        """The contingency table is counted in DuckDB over the Arrow copy; null groups are left out."""
+        self.dataset.schema = {"name": "object", "cohort": "object"}
+        self.dataset.save()
+        self.authenticate_user(self.researcher_user)
+        table = pa.table({
+            "name": pa.array(["a", "a", "b", "b", "b", None]).dictionary_encode(),
+            "cohort": ["x", "y", "x", "y", "y", "y"],
+        })
+
+        def load(request, dataset_id, normalize=False):
+            con = duckdb.connect(":memory:")
+            con.register("temp", table)
+            return con
+
+        mock_load_dataset.side_effect = load
+        response = self.client.get(f"/datasets/datasets/analyze/{self.dataset.dataset_id}/",
+                                   {"operation": "chi_square", "column1": "name", "column2": "cohort"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["contingency_table"], {"x": {"a": 1, "b": 1}, "y": {"a": 1, "b": 2}})
+        self.assertEqual(response.data["degrees_of_freedom"], 1)
+
     def test_all_datasets_view(self):
         """Test all_datasets_view."""
         self.client.credentials()  
@@ -537,4 +884,1582 @@ class DatasetCoreTests(TestCase):
         self.authenticate_user(self.researcher_user)
         response = self.client.get(f"/datasets/download/{self.dataset.dataset_id}/")
         self.assertEqual(response.status_code, 403)
-        self.assertEqual(json.loads(response.content.decode())["error"], "You do not have access to this dataset")
\ No newline at end of file
+        self.assertEqual(json.loads(response.content.decode())["error"], "You do not have access to this dataset")
+
+class IngestPipelineTests(TestCase):
+    """Tests for the streaming CSV -> encrypted Parquet pipeline."""
+
+    def run_ingest(self, csv_bytes):
+        uploaded = io.BytesIO()
+
+        def upload(stream, part_size):
+            while True:
+                part = stream.read(part_size)
+                if not part:
+                    break
+                uploaded.write(part)
+
+        result = ingest_csv(io.BytesIO(csv_bytes), upload)
+        plaintext = decrypt_dataset_object(result["encryption_key"], uploaded.getvalue())
+        return result, pd.read_parquet(io.BytesIO(plaintext), engine="pyarrow")
+
+    def test_ingest_round_trip(self):
+        """The stored object decrypts back to the uploaded rows."""
+        result, df = self.run_ingest(b"name,age\nJohn,30\nJane,25\n")
+        self.assertEqual(result["rows"], 2)
+        self.assertEqual(result["schema"], {"name": "object", "age": "int64"})
+        self.assertEqual(df["name"].tolist(), ["John", "Jane"])
+        self.assertEqual(df["age"].tolist(), [30, 25])
+
+    @patch('datasets.charset.detect', return_value={'encoding': 'utf-8', 'confidence': 0.99})
+    def test_ingest_falls_back_to_latin1(self, mock_detect):
+        """Bytes that are not valid UTF-8 are read with the fallback encodings."""
+        result, df = self.run_ingest("city\nS\xe3o Paulo\nZ\xfcrich\n".encode("latin1"))
+        self.assertEqual(result["encoding"], "iso8859-1")
+        self.assertEqual(df["city"].tolist(), ["S\xe3o Paulo", "Z\xfcrich"])
+
+    @override_settings(DATASET_INGEST_BLOCK_SIZE=64, DATASET_ENCRYPTION_SEGMENT_SIZE=128)
+    def test_ingest_widens_types_across_batches(self):
+        """A column inferred as int from the first batch is widened when a later batch has floats."""
+        rows = "".join(f"{i},label{i}\n" for i in range(50))
+        result, df = self.run_ingest(f"value,label\n{rows}2.5,last\n".encode())
+        self.assertEqual(result["rows"], 51)
+        self.assertEqual(result["schema"]["value"], "float64")
+        self.assertEqual(df["value"].iloc[-1], 2.5)
+
+    def test_ingest_rejects_empty_file(self):
+        """An empty upload is reported as an ingest error."""
+        with self.assertRaises(IngestError):
+            self.run_ingest(b"")
+
+    def test_decrypt_legacy_fernet_object(self):
+        """Objects written as a single Fernet token remain readable."""
+        key = Fernet.generate_key()
+        token = Fernet(key).encrypt(b"legacy parquet bytes")
+        self.assertEqual(decrypt_dataset_object(key.decode(), token), b"legacy parquet bytes")
+
+
+class SegmentedEncryptionTests(TestCase):
+    """Tests for the segmented AES-GCM object format."""
+
+    def setUp(self):
+        self.key = Fernet.generate_key()
+        self.plaintext = os.urandom(1000)
+
+    def test_round_trip_in_any_chunking(self):
+        for size in (0, 1, 128, 129, 1000):
+            encrypted = encrypt_dataset_object(self.key, self.plaintext[:size], segment_size=128)
+            self.assertEqual(object_format(encrypted), FORMAT_SEGMENTED)
+            self.assertEqual(decrypt_dataset_object(self.key.decode(), encrypted), self.plaintext[:size])
+            decryptor = StreamDecryptor(self.key)
+            streamed = b"".join(decryptor.update(encrypted[i:i + 7]) for i in range(0, len(encrypted), 7))
+            self.assertEqual(streamed + decryptor.finalize(), self.plaintext[:size])
+
+    def test_overhead_is_one_tag_per_segment(self):
+        encrypted = encrypt_dataset_object(self.key, self.plaintext, segment_size=128)
+        self.assertEqual(len(encrypted) - len(self.plaintext), len(SEGMENTED_MAGIC) + SEGMENT_HEADER.size + 8 * TAG_SIZE)
+
+    @override_settings(DATASET_ENCRYPTION_WORKERS=4)
+    def test_parallel_segments_match_serial_decryption(self):
+        encrypted = encrypt_dataset_object(self.key, self.plaintext, segment_size=64)
+        with override_settings(DATASET_ENCRYPTION_WORKERS=1):
+            self.assertEqual(decrypt_dataset_object(self.key, encrypted), self.plaintext)
+        self.assertEqual(decrypt_dataset_object(self.key, encrypted), self.plaintext)
+
+    def test_tampering_and_truncation_are_detected(self):
+        encrypted = encrypt_dataset_object(self.key, self.plaintext, segment_size=128)
+        tampered = bytearray(encrypted)
+        tampered[100] ^= 1
+        with self.assertRaises(InvalidTag):
+            decrypt_dataset_object(self.key, bytes(tampered))
+        # dropping whole segments leaves a non-final segment at the end
+        with self.assertRaises(InvalidTag):
+            decrypt_dataset_object(self.key, encrypted[:len(encrypted) - (1000 % 128 + TAG_SIZE)])
+        with self.assertRaises(ValueError):
+            decrypt_dataset_object(self.key, encrypted[:12])
+
+    def test_framed_fernet_objects_stream(self):
+        cipher = Fernet(self.key)
+        frames = [cipher.encrypt(self.plaintext[:600]), cipher.encrypt(self.plaintext[600:])]
+        encrypted = FRAMED_MAGIC + b"".join(len(frame).to_bytes(4, "big") + frame for frame in frames)
+        first_frame_end = len(FRAMED_MAGIC) + 4 + len(frames[0])
+        decryptor = StreamDecryptor(self.key)
+        self.assertEqual(decryptor.update(encrypted[:first_frame_end]), self.plaintext[:600])
+        self.assertEqual(decryptor.update(encrypted[first_frame_end:]) + decryptor.finalize(), self.plaintext[600:])
+
+
+@override_settings(
+    DATASET_INGEST_STAGING_DIR=os.path.join(tempfile.gettempdir(), "alacrity_ingest_tests"),
+    DATASET_UPLOAD_PART_SIZE=5 * 1024 * 1024,
+)
+class UploadSessionTests(TestCase):
+    """Tests for uploads sent straight to storage through presigned multipart URLs."""
+
+    def setUp(self):
+        self.organization = Organization.objects.create(name="Upload Org", Organization_id=str(uuid.uuid4()))
+        self.admin_user = User.objects.create_user(
+            username='upload_admin', email='upload_admin@example.com', password='password123',
+            role='organization_admin', organization=self.organization,
+        )
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.admin_user).access_token}')
+        self.store = MemoryObjectStore()
+        patcher = patch('alacrity_backend.storage.client', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # 6MB of CSV: two parts of 5MB and 1MB
+        self.csv = b"name,age\n" + b"".join(f"person{i:09d},{i % 90}\n".encode() for i in range(6 * 1024 * 1024 // 19))
+
+    def start(self, **data):
+        payload = {
+            'fileName': 'people.csv', 'fileSize': len(self.csv), 'title': 'Direct',
+            'category': 'Test', 'description': 'Uploaded straight to storage.', 'price': '0',
+        }
+        payload.update(data)
+        return self.client.post('/datasets/uploads/', payload, format='json')
+
+    def send_parts(self, session):
+        etags = []
+        for part in session["parts"]:
+            start = (part["part_number"] - 1) * session["part_size"]
+            etag = self.store.upload_part(part["url"])(self.csv[start:start + session["part_size"]])
+            etags.append({"part_number": part["part_number"], "etag": etag})
+        return etags
+
+    def test_upload_session_ingests_from_storage(self):
+        """The file never passes through Django: the job reads the joined staging object."""
+        response = self.start()
+        self.assertEqual(response.status_code, 201)
+        session = response.data
+        self.assertEqual(session["part_count"], 2)
+        self.assertIn("partNumber=2", session["parts"][1]["url"])
+
+        response = self.client.post(session["complete_url"], {"parts": self.send_parts(session)}, format='json')
+        self.assertEqual(response.status_code, 202)
+        job = IngestionJob.objects.get(job_id=response.data["job_id"])
+        self.assertTrue(job.staged_key.startswith(f"uploads/{session['session_id']}/"))
+        self.assertEqual(job.staged_path, '')
+
+        job = process_next_job()
+        self.assertEqual(job.status, IngestionJob.STATUS_COMPLETED)
+        self.assertEqual(job.content_hash, hashlib.sha256(self.csv).hexdigest())
+        self.assertEqual(job.dataset.number_of_rows, self.csv.count(b"\n") - 1)
+        # only the encrypted dataset is left; the staging object is gone
+        self.assertEqual(list(self.store.objects), [storage.object_key(job.dataset.link)])
+        self.assertEqual(UploadSession.objects.get(pk=session["session_id"]).job_id, job.job_id)
+
+    def test_complete_lists_parts_without_etags(self):
+        """Browsers that cannot read the ETag header complete with the parts MinIO lists."""
+        session = self.start().data
+        self.send_parts(session)
+        response = self.client.post(session["complete_url"], {}, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(process_next_job().status, IngestionJob.STATUS_COMPLETED)
+
+    def test_complete_rejects_missing_parts(self):
+        session = self.start().data
+        put = self.store.upload_part(session["parts"][0]["url"])
+        put(self.csv[:session["part_size"]])
+        response = self.client.post(session["complete_url"], {}, format='json')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(IngestionJob.objects.exists())
+        self.assertEqual(UploadSession.objects.get(pk=session["session_id"]).status, UploadSession.STATUS_OPEN)
+
+    def test_invalid_metadata_starts_no_upload(self):
+        self.assertEqual(self.start(title='').status_code, 400)
+        self.assertEqual(self.start(fileSize='lots').status_code, 400)
+        self.assertEqual(self.start(fileSize=0).status_code, 400)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(getattr(self.store, 'uploads', {}))
+
+    def test_abort_and_expiry_discard_parts(self):
+        session = self.start().data
+        self.send_parts(session)
+        response = self.client.delete(f"/datasets/uploads/{session['session_id']}/")
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.store.uploads, {})
+        response = self.client.post(session["complete_url"], {}, format='json')
+        self.assertEqual(response.status_code, 409)
+
+        expired = self.start().data
+        UploadSession.objects.filter(pk=expired["session_id"]).update(expires_at=timezone.now())
+        self.assertEqual(abort_expired_sessions(), 1)
+        self.assertEqual(UploadSession.objects.get(pk=expired["session_id"]).status, UploadSession.STATUS_ABORTED)
+
+    def test_part_size_grows_for_huge_files(self):
+        self.assertEqual(get_part_size(10), 5 * 1024 * 1024)
+        self.assertEqual(get_part_size(100 * 1024 ** 3), -(-100 * 1024 ** 3 // 10000))
+
+
+@override_settings(
+    DATASET_INGEST_STAGING_DIR=os.path.join(tempfile.gettempdir(), "alacrity_ingest_tests"),
+    DATASET_RESUMABLE_CHUNK_SIZE=5 * 1024 * 1024,
+)
+class ResumableUploadTests(TestCase):
+    """Tests for the tus-style resumable uploads sent through the API."""
+
+    def setUp(self):
+        self.organization = Organization.objects.create(name="Resumable Org", Organization_id=str(uuid.uuid4()))
+        self.admin_user = User.objects.create_user(
+            username='resumable_admin', email='resumable_admin@example.com', password='password123',
+            role='organization_admin', organization=self.organization,
+        )
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.admin_user).access_token}')
+        self.store = MemoryObjectStore()
+        patcher = patch('alacrity_backend.storage.client', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # a little over two chunks of CSV
+        self.csv = b"name,age\n" + b"".join(f"person{i:09d},{i % 90}\n".encode() for i in range(11 * 1024 * 1024 // 19))
+
+    def create(self):
+        metadata = {
+            'filename': 'people.csv', 'title': 'Resumable', 'category': 'Test',
+            'description': 'Sent in resumable chunks.', 'price': '0',
+        }
+        header = ",".join(f"{key} {base64.b64encode(value.encode()).decode()}" for key, value in metadata.items())
+        response = self.client.post(
+            '/datasets/resumable/', HTTP_UPLOAD_LENGTH=str(len(self.csv)), HTTP_UPLOAD_METADATA=header,
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response["Tus-Resumable"], "1.0.0")
+        return response.data
+
+    def send(self, session, number, data=None, checksum=None):
+        offset = (number - 1) * session["part_size"]
+        data = self.csv[offset:offset + session["part_size"]] if data is None else data
+        headers = {'HTTP_UPLOAD_OFFSET': str(offset)}
+        if checksum is not None:
+            headers['HTTP_UPLOAD_CHECKSUM'] = checksum
+        return self.client.generic(
+            'PATCH', session["location"], data, content_type='application/offset+octet-stream', **headers,
+        )
+
+    def offset(self, session):
+        return int(self.client.head(session["location"])["Upload-Offset"])
+
+    def test_chunks_in_any_order_complete_the_upload(self):
+        """Chunks may arrive out of order; the offset only covers chunks received without a gap."""
+        session = self.create()
+        self.assertEqual(session["part_count"], 3)
+        self.assertEqual(self.offset(session), 0)
+
+        response = self.send(session, 2)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(int(response["Upload-Offset"]), 0)
+        self.assertEqual(self.client.get(session["location"]).data["received_chunks"], [2])
+
+        checksum = "sha256 " + base64.b64encode(hashlib.sha256(self.csv[:session["part_size"]]).digest()).decode()
+        response = self.send(session, 1, checksum=checksum)
+        self.assertEqual(int(response["Upload-Offset"]), 2 * session["part_size"])
+        self.assertNotIn("Upload-Job-Id", response)
+
+        response = self.send(session, 3)
+        self.assertEqual(int(response["Upload-Offset"]), len(self.csv))
+        job = process_next_job()
+        self.assertEqual(job.job_id, response["Upload-Job-Id"])
+        self.assertEqual(job.status, IngestionJob.STATUS_COMPLETED)
+        self.assertEqual(job.content_hash, hashlib.sha256(self.csv).hexdigest())
+        self.assertEqual(job.dataset.title, 'Resumable')
+        self.assertEqual(self.offset(session), len(self.csv))
+
+    def test_a_cut_off_chunk_is_resent(self):
+        """A chunk whose connection drops is not stored; the client resumes from the offset."""
+        session = self.create()
+        self.send(session, 1)
+        upload = UploadSession.objects.get(pk=session["session_id"])
+        part = self.csv[upload.part_size:2 * upload.part_size]
+        with self.assertRaises(ChunkError):
+            receive_chunk(upload, upload.part_size, io.BytesIO(part[:1000]), len(part))
+        self.assertEqual(self.offset(session), upload.part_size)
+        self.assertEqual(self.send(session, 2).status_code, 204)
+        self.assertEqual(self.offset(session), 2 * upload.part_size)
+
+    def test_bad_chunks_are_rejected(self):
+        session = self.create()
+        wrong = "md5 " + base64.b64encode(hashlib.md5(b"other").digest()).decode()
+        self.assertEqual(self.send(session, 1, checksum=wrong).status_code, 460)
+        self.assertEqual(self.send(session, 1, data=b"too short").status_code, 409)
+        self.assertEqual(self.send(session, 1, checksum="crc32 AAAA").status_code, 409)
+        response = self.client.generic('PATCH', session["location"], b"x", content_type='text/plain', HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(self.offset(session), 0)
+
+        self.assertEqual(self.client.delete(session["location"]).status_code, 204)
+        self.assertEqual(self.send(session, 1).status_code, 409)
+
+
+class StorageSweepTests(TestCase):
+    """Tests for the orphaned object sweeper."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='sweeper', email='sweeper@example.com', password='password123')
+        self.store = MemoryObjectStore()
+        patcher = patch('alacrity_backend.storage.client', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.old = timezone.now() - timedelta(days=2)
+
+    def put(self, key, size=10, old=True):
+        self.store.objects[key] = b"x" * size
+        self.store.modified[key] = self.old if old else timezone.now()
+        return storage.object_url(key)
+
+    def test_sweep_deletes_old_unreferenced_objects(self):
+        """Referenced, recent and unmanaged objects are kept; the space of the rest is reported."""
+        link = self.put("encrypted/kept.parquet.enc")
+        Dataset.objects.create(
+            contributor_id=self.user, title='Kept', category='Test', description='A kept dataset.',
+            link=link, encryption_key='key', schema={},
+        )
+        picture = self.put("profile_pictures/1/current.png")
+        thumb = self.put("images/abc/thumb.webp")
+        User.objects.filter(pk=self.user.pk).update(
+            profile_picture=picture, profile_picture_variants={"thumb": {"webp": thumb}},
+        )
+        self.put("submission_images/chart.png")
+        AnalysisSubmission.objects.create(researcher=self.user, image="submission_images/chart.png")
+        self.put("encrypted/rejected.parquet.enc", size=100)
+        self.put("profile_pictures/1/replaced.png", size=20)
+        self.put("encrypted/just-written.parquet.enc", old=False)
+        self.put("backups/dump.sql")
+
+        report = sweep()
+        self.assertEqual(report["orphans"], 2)
+        self.assertEqual(report["bytes_reclaimed"], 120)
+        self.assertTrue(report["finished"])
+        self.assertEqual(sorted(self.store.objects), [
+            "backups/dump.sql", "encrypted/just-written.parquet.enc", "encrypted/kept.parquet.enc",
+            "images/abc/thumb.webp", "profile_pictures/1/current.png", "submission_images/chart.png",
+        ])
+        self.assertEqual(StorageSweep.objects.get(pk=report["sweep"]).bytes_reclaimed, 120)
+
+    def test_sweep_is_incremental_and_dry_run_deletes_nothing(self):
+        for number in range(5):
+            self.put(f"encrypted/orphan-{number}.parquet.enc")
+
+        report = sweep(dry_run=True)
+        self.assertEqual(report["orphans"], 5)
+        self.assertEqual(report["deleted"], 0)
+        self.assertEqual(len(self.store.objects), 5)
+
+        first = sweep(limit=2)
+        self.assertFalse(first["finished"])
+        self.assertEqual(len(self.store.objects), 3)
+        second = sweep(limit=10)
+        self.assertEqual(second["sweep"], first["sweep"])
+        self.assertTrue(second["finished"])
+        self.assertEqual(self.store.objects, {})
+        sweep_row = StorageSweep.objects.get(pk=first["sweep"])
+        self.assertEqual((sweep_row.objects_scanned, sweep_row.objects_deleted), (5, 5))
+
+    def test_sweep_keeps_objects_of_running_jobs_and_open_uploads(self):
+        self.put("uploads/session/people.csv")
+        UploadSession.objects.create(
+            user=self.user, file_name='people.csv', file_size=10, part_size=10,
+            object_key="uploads/session/people.csv", upload_id="upload", expires_at=timezone.now(),
+        )
+        self.put("encrypted/in-progress.parquet.enc")
+        IngestionJob.objects.create(
+            user=self.user, status=IngestionJob.STATUS_RUNNING, started_at=self.old - timedelta(hours=1),
+        )
+        out = io.StringIO()
+        call_command('sweep_orphaned_objects', stdout=out)
+        self.assertEqual(len(self.store.objects), 2)
+        self.assertIn("0 orphan(s) found", out.getvalue())
+
+
+@override_settings(DATASET_INGEST_STAGING_DIR=os.path.join(tempfile.gettempdir(), "alacrity_ingest_tests"))
+class DatasetVersionTests(TestCase):
+    """Tests for append uploads and versioned manifests."""
+
+    def setUp(self):
+        self.organization = Organization.objects.create(name="Versions Org", Organization_id=str(uuid.uuid4()))
+        self.admin_user = User.objects.create_user(
+            username='versions_admin', email='versions_admin@example.com', password='password123',
+            role='organization_admin', organization=self.organization,
+        )
+        self.researcher_user = User.objects.create_user(
+            username='versions_researcher', email='versions_researcher@example.com', password='password123',
+            role='researcher', organization=self.organization,
+        )
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.admin_user).access_token}')
+        self.store = MemoryObjectStore()
+        patcher = patch('alacrity_backend.storage.client', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_dataset(self, csv_content=b"name,age\nJohn,30\nJane,25\n", title='People'):
+        response = self.client.post('/datasets/create_dataset/', {
+            'file': SimpleUploadedFile("people.csv", csv_content, content_type="text/csv"),
+            'title': title,
+            'category': 'Test',
+            'description': 'A dataset that grows by appends.',
+            'price': '0',
+        }, format='multipart')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(process_next_job().status, IngestionJob.STATUS_COMPLETED)
+        return Dataset.objects.get(title=title)
+
+    def append(self, dataset, csv_content):
+        response = self.client.post(f'/datasets/append/{dataset.dataset_id}/', {
+            'file': SimpleUploadedFile("more.csv", csv_content, content_type="text/csv"),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 202)
+        return process_next_job()
+
+    def test_append_adds_a_part_and_a_version(self):
+        """An append stores only the new rows and readers see the union of the parts."""
+        dataset = self.create_dataset()
+        self.assertEqual(len(self.store.objects), 1)
+
+        job = self.append(dataset, b"name,age\nBob,1000\n")
+        self.assertEqual(job.status, IngestionJob.STATUS_COMPLETED)
+        self.assertEqual(job.dataset_id, dataset.dataset_id)
+        dataset.refresh_from_db()
+        self.assertEqual(dataset.version, 2)
+        self.assertEqual(dataset.number_of_rows, 3)
+        # the parts were stored as int8 and int16; the version reads both as int16
+        self.assertEqual(dataset.schema, {"name": "object", "age": "int64"})
+        self.assertEqual(dataset.logical_schema, {"name": "object", "age": "int16"})
+        self.assertEqual(len(self.store.objects), 2)
+        self.assertEqual([part.sequence for part in get_parts(dataset)], [0, 1])
+
+        self.assertEqual(read_dataset_table(dataset).column("age").to_pylist(), [30, 25, 1000])
+        self.assertEqual(read_dataset_table(dataset, 1).column("age").to_pylist(), [30, 25])
+        self.assertEqual(get_current_profile(dataset).total_rows, 3)
+        self.assertEqual(DatasetProfile.objects.get(dataset=dataset, version=1, normalized=False).total_rows, 2)
+
+        response = self.client.get(f'/datasets/versions/{dataset.dataset_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["current_version"], 2)
+        self.assertEqual([version["version"] for version in response.data["versions"]], [2, 1])
+        self.assertEqual([part["rows"] for part in response.data["versions"][0]["parts"]], [2, 1])
+        self.assertNotIn("link", response.data["versions"][0]["parts"][0])
+
+    def test_detail_reports_wide_type_names(self):
+        """Narrowed columns are listed under the names clients filter on (int64, float64, object)."""
+        rows = "".join(f"{['Paris', 'Rome'][i % 2]},{i},{i + 0.5}\n" for i in range(20))
+        dataset = self.create_dataset(f"city,count,score\n{rows}".encode())
+        self.assertEqual(parts_schema(get_parts(dataset)).field("count").type, pa.int8())
+        DatasetRequest.objects.create(dataset_id=dataset, researcher_id=self.researcher_user, request_status='approved')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(self.researcher_user).access_token}')
+
+        response = self.client.get(f"/datasets/details/{dataset.dataset_id}/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["schema"], {"city": "object", "count": "int64", "score": "float64"})
+        dataset.refresh_from_db()
+        self.assertEqual(dataset.logical_schema, {"city": "category", "count": "int8", "score": "float32"})
+
+    def test_append_with_other_columns_is_rejected(self):
+        dataset = self.create_dataset()
+        job = self.append(dataset, b"city\nParis\n")
+        self.assertEqual(job.status, IngestionJob.STATUS_FAILED)
+        self.assertIn("columns", job.error)
+        dataset.refresh_from_db()
+        self.assertEqual(dataset.version, 1)
+        self.assertEqual(len(self.store.objects), 1)
+
+    def test_append_to_legacy_dataset(self):
+        """A dataset stored before manifests existed gets one on its first append."""
+        key = Fernet.generate_key()
+        parquet = io.BytesIO()
+        pd.DataFrame({"name": ["Old"], "age": [70]}).to_parquet(parquet)
+        self.store.objects["encrypted/legacy.parquet.enc"] = Fernet(key).encrypt(parquet.getvalue())
+        dataset = Dataset.objects.create(
+            contributor_id=self.admin_user, title="Legacy", category="Test",
+            link="http://localhost:9000/alacrity/encrypted/legacy.parquet.enc",
+            encryption_key=key.decode(), description="Stored without a manifest.",
+            schema={"name": "object", "age": "int64"}, number_of_rows=1,
+        )
+        self.assertEqual(read_dataset_table(dataset).num_rows, 1)
+
+        self.assertEqual(self.append(dataset, b"name,age\nNew,7\n").status, IngestionJob.STATUS_COMPLETED)
+        dataset.refresh_from_db()
+        self.assertEqual(dataset.version, 2)
+        self.assertEqual(read_dataset_table(dataset).column("name").to_pylist(), ["Old", "New"])
+        self.assertEqual(dataset.schema, {"name": "object", "age": "int64"})
+
+    def test_migrate_dataset_encryption(self):
+        """Fernet objects are rewritten in the segmented format, once, with the same key."""
+        dataset = self.create_dataset()
+        key = Fernet.generate_key()
+        parquet = io.BytesIO()
+        pd.DataFrame({"name": ["Old"], "age": [70]}).to_parquet(parquet)
+        self.store.objects["encrypted/legacy.parquet.enc"] = Fernet(key).encrypt(parquet.getvalue())
+        legacy = Dataset.objects.create(
+            contributor_id=self.admin_user, title="Legacy", category="Test",
+            link="http://localhost:9000/alacrity/encrypted/legacy.parquet.enc",
+            encryption_key=key.decode(), description="Stored as one Fernet token.",
+            schema={"name": "object", "age": "int64"}, number_of_rows=1,
+        )
+
+        out = io.StringIO()
+        call_command('migrate_dataset_encryption', stdout=out)
+        self.assertIn("rewrote 1 object(s), 1 already segmented", out.getvalue())
+        self.assertEqual(object_format(self.store.objects["encrypted/legacy.parquet.enc"]), FORMAT_SEGMENTED)
+        self.assertEqual(read_dataset_table(legacy).column("name").to_pylist(), ["Old"])
+        self.assertEqual(read_dataset_table(dataset).num_rows, 2)
+
+        out = io.StringIO()
+        call_command('migrate_dataset_encryption', stdout=out)
+        self.assertIn("rewrote 0 object(s), 2 already segmented", out.getvalue())
+
+    def test_cache_reads_only_new_parts(self):
+        """A cached copy of an earlier version is extended with the appended part only."""
+        dataset = self.create_dataset()
+        DatasetRequest.objects.create(dataset_id=dataset, researcher_id=self.researcher_user, request_status='approved')
+        request = MagicMock()
+        request.user.id = self.researcher_user.id
+        self.addCleanup(evict_dataset, dataset.dataset_id)
+
+        con = load_dataset_into_cache(request, dataset.dataset_id)
+        self.assertEqual(con.execute("SELECT COUNT(*) FROM temp").fetchone()[0], 2)
+        self.append(dataset, b"name,age\nBob,40\n")
+        self.store.fetched.clear()
+
+        con = load_dataset_into_cache(request, dataset.dataset_id)
+        self.assertEqual(con.execute("SELECT SUM(age) FROM temp").fetchone()[0], 95)
+        self.assertEqual(set(self.store.fetched), {get_parts(Dataset.objects.get(pk=dataset.pk))[1].link.split("/alacrity/")[1]})
+        self.assertEqual(list(DATASET_CACHE), [cache_key(Dataset.objects.get(pk=dataset.pk))])
+
+        self.store.fetched.clear()
+        load_dataset_into_cache(request, dataset.dataset_id)
+        self.assertEqual(self.store.fetched, [])
+
+    def test_normalized_copy_is_computed_from_raw_copy(self):
+        """Switching to the cleaned data reads nothing from storage and cleans once."""
+        dataset = self.create_dataset()
+        self.append(dataset, b"name,age\nBob,40\nBob,40\nCarol,\n")
+        DatasetRequest.objects.create(dataset_id=dataset, researcher_id=self.researcher_user, request_status='approved')
+        request = MagicMock()
+        request.user.id = self.researcher_user.id
+        self.addCleanup(evict_dataset, dataset.dataset_id)
+
+        con = load_dataset_into_cache(request, dataset.dataset_id)
+        self.assertEqual(con.execute("SELECT COUNT(*) FROM temp").fetchone()[0], 5)
+        self.store.fetched.clear()
+
+        with patch('datasets.dataset_cache.clean_data', wraps=clean_data) as cleaning:
+            con = load_dataset_into_cache(request, dataset.dataset_id, normalize=True)
+            self.assertEqual(con.execute("SELECT COUNT(*), SUM(age) FROM temp").fetchone(), (3, 95))
+            con = load_dataset_into_cache(request, dataset.dataset_id, normalize=False)
+            self.assertEqual(con.execute("SELECT COUNT(*) FROM temp").fetchone()[0], 5)
+            load_dataset_into_cache(request, dataset.dataset_id, normalize=True)
+        self.assertEqual(cleaning.call_count, 1)
+        self.assertEqual(self.store.fetched, [])
+
+    def test_missing_profile_is_computed_without_loading_the_dataset(self):
+        dataset = self.create_dataset()
+        self.append(dataset, b"name,age\nBob,40\n")
+        dataset.refresh_from_db()
+        DatasetProfile.objects.filter(dataset=dataset).delete()
+        self.addCleanup(evict_dataset, dataset.dataset_id)
+
+        self.assertEqual(get_dataset_profile(dataset).total_rows, 3)
+        self.assertEqual(get_dataset_profile(dataset, normalize=True).total_rows, 3)
+        self.assertFalse(is_cached(dataset))
+
+    def test_cache_is_shared_by_users(self):
+        """Users with access share one copy per version and variant, each with a cursor of its own."""
+        dataset = self.create_dataset()
+        other = User.objects.create_user(
+            username='versions_other', email='versions_other@example.com', password='password123',
+            role='researcher', organization=self.organization,
+        )
+        self.addCleanup(evict_dataset, dataset.dataset_id)
+        requests = []
+        for user in (self.researcher_user, other):
+            DatasetRequest.objects.create(dataset_id=dataset, researcher_id=user, request_status='approved')
+            request = MagicMock()
+            request.user.id = user.id
+            requests.append(request)
+
+        first = load_dataset_into_cache(requests[0], dataset.dataset_id)
+        self.store.fetched.clear()
+        second = load_dataset_into_cache(requests[1], dataset.dataset_id)
+        self.assertEqual(self.store.fetched, [])
+        first.close()
+        self.assertEqual(second.execute("SELECT COUNT(*) FROM temp").fetchone()[0], 2)
+
+        load_dataset_into_cache(requests[1], dataset.dataset_id, normalize=True)
+        self.assertEqual(sorted(key[2] for key in DATASET_CACHE), ["normalized", "raw"])
+
+        outsider = MagicMock()
+        outsider.user.id = self.admin_user.id
+        self.assertEqual(load_dataset_into_cache(outsider, dataset.dataset_id).status_code, 403)
+
+
+    def test_identical_uploads_share_one_object(self):
+        """A second upload of the same bytes reuses the stored object and its profile."""
+        first = self.create_dataset()
+        second = self.create_dataset(title='People again')
+        self.assertEqual(len(self.store.objects), 1)
+        self.assertEqual(second.link, first.link)
+        stored_object = StoredObject.objects.get()
+        self.assertEqual(stored_object.ref_count, 2)
+        self.assertEqual(IngestionJob.objects.get(dataset=second).content_hash, stored_object.content_hash)
+        self.assertEqual(get_current_profile(second).total_rows, 2)
+        self.assertEqual(read_dataset_table(second).column("age").to_pylist(), [30, 25])
+
+        first.delete()
+        stored_object.refresh_from_db()
+        self.assertEqual(stored_object.ref_count, 1)
+        self.assertEqual(len(self.store.objects), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(StoredObject.objects.exists())
+        self.assertEqual(self.store.objects, {})
+
+    def test_identical_uploads_are_not_shared_across_organisations(self):
+        """Another organisation can store the same file under the same title, without learning it exists."""
+        first = self.create_dataset()
+        organization = Organization.objects.create(
+            name="Other Org", email="other@example.com", Organization_id=str(uuid.uuid4()),
+        )
+        other = User.objects.create_user(
+            username='other_contributor', email='other_contributor@example.com', password='password123',
+            role='contributor', organization=organization,
+        )
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {RefreshToken.for_user(other).access_token}')
+        response = self.client.post('/datasets/create_dataset/', {
+            'file': SimpleUploadedFile("people.csv", b"name,age\nJohn,30\nJane,25\n", content_type="text/csv"),
+            'title': 'People', 'category': 'Test', 'description': 'The same file.', 'price': '0',
+        }, format='multipart')
+        self.assertEqual(response.status_code, 202)
+        job = process_next_job()
+
+        self.assertEqual(job.status, IngestionJob.STATUS_COMPLETED)
+        self.assertNotEqual(job.stage, 'deduplicated')
+        second = job.dataset
+        self.assertEqual(second.contributor_id, other)
+        self.assertNotEqual(second.link, first.link)
+        self.assertEqual(StoredObject.objects.count(), 2)
+        self.assertEqual(len(self.store.objects), 2)
+
+    def test_append_of_identical_file_reuses_its_part_object(self):
+        dataset = self.create_dataset()
+        self.append(dataset, b"name,age\nBob,40\n")
+        job = self.append(dataset, b"name,age\nBob,40\n")
+        self.assertEqual(job.status, IngestionJob.STATUS_COMPLETED)
+        dataset.refresh_from_db()
+        self.assertEqual(dataset.version, 3)
+        self.assertEqual(len(self.store.objects), 2)
+        self.assertEqual(read_dataset_table(dataset).column("age").to_pylist(), [30, 25, 40, 40])
+        self.assertEqual(get_current_profile(dataset).total_rows, 4)
+
+    def test_identical_upload_with_other_columns_is_rejected_without_removing_the_object(self):
+        dataset = self.create_dataset()
+        self.create_dataset(b"city\nParis\nRome\n", title='Cities')
+        job = self.append(dataset, b"city\nParis\nRome\n")
+        self.assertEqual(job.status, IngestionJob.STATUS_FAILED)
+        self.assertEqual(len(self.store.objects), 2)
+
+    def test_failed_dataset_creation_releases_its_object(self):
+        """A job that cannot record its dataset leaves neither a dataset nor a stored object behind."""
+        response = self.client.post('/datasets/create_dataset/', {
+            'file': SimpleUploadedFile("people.csv", b"name,age\nJohn,30\n", content_type="text/csv"),
+            'title': 'Doomed', 'category': 'Test', 'description': 'Never recorded.', 'price': '0',
+        }, format='multipart')
+        self.assertEqual(response.status_code, 202)
+
+        with patch('datasets.jobs.record_initial_version', side_effect=RuntimeError("database went away")):
+            with self.captureOnCommitCallbacks(execute=True):
+                job = process_next_job()
+
+        self.assertEqual(job.status, IngestionJob.STATUS_FAILED)
+        self.assertFalse(Dataset.objects.filter(title='Doomed').exists())
+        self.assertFalse(StoredObject.objects.exists())
+        self.assertEqual(self.store.objects, {})
+
+    def test_claimed_object_outlives_its_last_part(self):
+        """An object a job has claimed is kept when the last dataset using it is deleted."""
+        dataset = self.create_dataset()
+        stored_object = StoredObject.objects.get()
+        claimed = claim_stored_object(stored_object.content_hash, stored_object.variant, stored_object.owner)
+        self.assertEqual(claimed.ref_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            dataset.delete()
+        self.assertTrue(StoredObject.objects.filter(pk=claimed.pk).exists())
+        self.assertEqual(len(self.store.objects), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            release(claimed.pk)
+        self.assertFalse(StoredObject.objects.exists())
+        self.assertEqual(self.store.objects, {})
+
+
+class DatasetCacheTests(TestCase):
+    """Tests for the byte budget, idle TTL and pinning of the in-memory dataset cache."""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='cache_owner', email='cache_owner@example.com', password='password123')
+        self.store = MemoryObjectStore()
+        patcher = patch('alacrity_backend.storage.client', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(DATASET_CACHE.clear)
+        self.key = Fernet.generate_key()
+
+    def create_dataset(self, name, rows=1000):
+        parquet = io.BytesIO()
+        pd.DataFrame({"label": [f"{name}-{i}" for i in range(rows)], "value": range(rows)}).to_parquet(parquet)
+        self.store.objects[f"encrypted/{name}.parquet.enc"] = Fernet(self.key).encrypt(parquet.getvalue())
+        return Dataset.objects.create(
+            contributor_id=self.user, title=name, category="Test", description="Cached in memory.",
+            link=f"http://localhost:9000/alacrity/encrypted/{name}.parquet.enc", encryption_key=self.key.decode(),
+            schema={"label": "object", "value": "int64"}, number_of_rows=rows,
+        )
+
+    def test_copies_are_evicted_beyond_the_byte_budget(self):
+        first, second = self.create_dataset("first"), self.create_dataset("second")
+        evictions = stats()["evictions"]["budget"]
+        size = get_entry(first)["bytes"]
+        self.assertGreater(size, 1000 * 8)
+        with override_settings(DATASET_CACHE_MAX_BYTES=int(size * 1.5)):
+            get_entry(second)
+        self.assertEqual(list(DATASET_CACHE), [cache_key(second)])
+        eviction = CacheEviction.objects.get()
+        self.assertEqual((eviction.dataset_id, eviction.reason, eviction.size), (first.dataset_id, 'budget', size))
+        self.assertEqual(stats()["evictions"]["budget"], evictions + 1)
+
+    def test_pinned_copies_stay_and_idle_ones_expire(self):
+        first, second, third = self.create_dataset("first"), self.create_dataset("second"), self.create_dataset("third")
+        size = get_entry(first)["bytes"]
+        get_entry(second)
+        with override_settings(DATASET_CACHE_MAX_BYTES=int(size * 1.5), DATASET_CACHE_PINNED=[first.dataset_id]):
+            DATASET_CACHE[cache_key(first)]["last_used"] -= 7200
+            get_entry(third)
+        self.assertEqual(list(DATASET_CACHE), [cache_key(first), cache_key(third)])
+        self.assertEqual(CacheEviction.objects.get().reason, 'budget')
+
+        DATASET_CACHE[cache_key(first)]["last_used"] -= 7200
+        with override_settings(DATASET_CACHE_IDLE_TTL=3600):
+            get_entry(third)
+        self.assertEqual(list(DATASET_CACHE), [cache_key(third)])
+        self.assertEqual(CacheEviction.objects.filter(reason='idle').get().dataset_id, first.dataset_id)
+
+    @override_settings(DATASET_CACHE_MAX_BYTES=1000)
+    def test_copy_larger_than_the_budget_is_served_but_not_kept(self):
+        dataset = self.create_dataset("huge")
+        self.assertEqual(len(get_entry(dataset)["data"]), 1000)
+        self.assertEqual(DATASET_CACHE, {})
+        self.assertEqual(CacheEviction.objects.get().reason, 'too_large')
+
+    def test_prefetch_stays_within_its_budget(self):
+        first, second = self.create_dataset("first"), self.create_dataset("second")
+        before = stats()
+        self.assertEqual(warm(first.dataset_id), "loaded")
+        self.assertEqual(warm(first.dataset_id), "cached")
+        size = DATASET_CACHE[cache_key(first)]["bytes"]
+        self.assertEqual(DATASET_CACHE[cache_key(first)]["hits"], 0)
+
+        with override_settings(DATASET_PREFETCH_MAX_BYTES=int(size * 1.5)):
+            self.assertEqual(warm(second.dataset_id), "over_budget")
+        self.assertEqual(list(DATASET_CACHE), [cache_key(first)])
+        self.assertEqual(CacheEviction.objects.get().dataset_id, second.dataset_id)
+
+        get_entry(first)
+        get_entry(first)
+        after = stats()
+        self.assertEqual(after["prefetches"] - before["prefetches"], 2)
+        self.assertEqual(after["misses"], before["misses"])
+        self.assertEqual(after["prefetch_hits"] - before["prefetch_hits"], 1)
+
+    @override_settings(DATASET_PREFETCH_ENABLED=True)
+    def test_opening_a_dataset_queues_the_users_recent_ones(self):
+        researcher = User.objects.create_user(
+            username='cache_researcher', email='cache_researcher@example.com', password='password123', role='researcher',
+        )
+        datasets = [self.create_dataset(name, rows=10) for name in ("old", "recent", "revoked", "current")]
+        for dataset in datasets:
+            status = 'revoked' if dataset.title == 'revoked' else 'approved'
+            DatasetRequest.objects.create(dataset_id=dataset, researcher_id=researcher, request_status=status)
+        self.addCleanup(PREFETCH_QUEUE.clear)
+
+        with patch('datasets.prefetch.enqueue') as enqueue, self.captureOnCommitCallbacks(execute=True):
+            for minutes, dataset in enumerate(datasets):
+                DatasetAccessMetrics.objects.create(dataset=dataset, user=researcher)
+                DatasetAccessMetrics.objects.filter(dataset=dataset).update(
+                    access_time=timezone.now() - timedelta(minutes=10 - minutes),
+                )
+        dataset_ids, reason = enqueue.call_args.args
+        self.assertEqual(dataset_ids, [datasets[0].dataset_id, datasets[1].dataset_id])
+        self.assertEqual(reason, "recently opened")
+
+
+class SingleFlightLoadTests(unittest.TestCase):
+    """Concurrency tests for per-key loading of the in-memory dataset cache (no database is used)."""
+
+    def setUp(self):
+        self.addCleanup(DATASET_CACHE.clear)
+        patchers = [
+            patch('datasets.dataset_cache.get_parts', side_effect=lambda dataset: [MagicMock(pk=dataset.dataset_id)]),
+            patch('datasets.dataset_cache.parts_schema', return_value=None),
+            patch('datasets.dataset_cache.get_shared_store', return_value=None),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def load_all(self, datasets):
+        results, errors = [], []
+
+        def load(dataset):
+            try:
+                results.append(get_entry(dataset))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=load, args=(dataset,)) for dataset in datasets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        return results, errors
+
+    def test_unrelated_loads_run_in_parallel(self):
+        """Each load waits for the other to start: with one lock around loading, the barrier would time out."""
+        barrier = threading.Barrier(2, timeout=5)
+
+        def read_parts(parts, schema=None):
+            barrier.wait()
+            return pa.table({"value": [1, 2, 3]})
+
+        with patch('datasets.dataset_cache.read_parts', side_effect=read_parts):
+            results, errors = self.load_all([Dataset(dataset_id="first", version=1), Dataset(dataset_id="second", version=1)])
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(DATASET_CACHE), 2)
+
+    def test_cached_copies_are_served_during_a_slow_load(self):
+        cached = Dataset(dataset_id="cached", version=1)
+        with patch('datasets.dataset_cache.read_parts', return_value=pa.table({"value": [1]})):
+            get_entry(cached)
+        loading, release = threading.Event(), threading.Event()
+
+        def slow_read(parts, schema=None):
+            loading.set()
+            release.wait(5)
+            return pa.table({"value": [1]})
+
+        with patch('datasets.dataset_cache.read_parts', side_effect=slow_read):
+            thread = threading.Thread(target=get_entry, args=(Dataset(dataset_id="slow", version=1),))
+            thread.start()
+            self.assertTrue(loading.wait(5))
+            started = time.monotonic()
+            self.assertEqual(len(get_entry(cached)["data"]), 1)
+            self.assertLess(time.monotonic() - started, 1)
+            release.set()
+            thread.join(5)
+
+    def test_concurrent_requests_for_one_copy_share_one_load(self):
+        calls = []
+
+        def read_parts(parts, schema=None):
+            calls.append(1)
+            time.sleep(0.3)
+            return pa.table({"value": [1, 2]})
+
+        with patch('datasets.dataset_cache.read_parts', side_effect=read_parts):
+            results, errors = self.load_all([Dataset(dataset_id="popular", version=1) for _ in range(5)])
+        self.assertEqual((len(calls), len(results), errors), (1, 5, []))
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_waiters_get_the_error_of_a_failed_load(self):
+        def read_parts(parts, schema=None):
+            time.sleep(0.3)
+            raise IOError("storage unavailable")
+
+        with patch('datasets.dataset_cache.read_parts', side_effect=read_parts):
+            results, errors = self.load_all([Dataset(dataset_id="broken", version=1) for _ in range(3)])
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(DATASET_CACHE, {})
+        # nothing is left in flight: the next request loads again
+        with patch('datasets.dataset_cache.read_parts', return_value=pa.table({"value": [1]})):
+            self.assertEqual(len(get_entry(Dataset(dataset_id="broken", version=1))["data"]), 1)
+
+
+class SharedStoreTests(TestCase):
+    """Tests for the Arrow IPC store shared by the processes of a host."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.table = pa.table({"id": pa.array(range(1000), pa.int64()), "label": [f"row-{i}" for i in range(1000)]})
+
+    def test_one_process_builds_an_entry_the_others_map(self):
+        store = SharedTableStore(self.directory, 10 ** 9)
+        builds = []
+
+        def build():
+            builds.append(1)
+            time.sleep(0.2)
+            return self.table
+
+        # flock excludes separate opens of the lock file, whether from threads or processes
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(store.get_or_create(("ds", 1, "raw"), build))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(builds), 1)
+        self.assertTrue(all(result.equals(self.table) for result in results))
+        con = duckdb.connect()
+        con.register("temp", results[0])
+        self.assertEqual(con.execute("SELECT SUM(id) FROM temp").fetchone()[0], sum(range(1000)))
+
+    def test_new_versions_replace_old_ones_and_the_budget_evicts(self):
+        store = SharedTableStore(self.directory, 10 ** 9)
+        store.put(("ds", 1, "raw"), self.table)
+        store.put(("ds", 1, "normalized"), self.table)
+        store.put(("ds", 2, "raw"), self.table)
+        self.assertIsNone(store.get(("ds", 1, "raw")))
+        self.assertIsNotNone(store.get(("ds", 1, "normalized")))
+
+        store.max_bytes = os.path.getsize(store.path(("ds", 2, "raw"))) + 1
+        store.get(("ds", 2, "raw"))
+        store.put(("other", 1, "raw"), self.table)
+        self.assertEqual(sorted(name for name, _, _ in store.entries()), ["other.raw.v1"])
+
+    def test_build_locks_survive_eviction(self):
+        """Removing entries leaves the build lock a waiting process may hold."""
+        store = SharedTableStore(self.directory, 10 ** 9)
+        store.get_or_create(("ds", 1, "raw"), lambda: self.table)
+        store.put(("ds", 2, "raw"), self.table)
+        store.clear()
+        self.assertEqual(store.entries(), [])
+        self.assertTrue(os.path.exists(store.lock_path(("ds", 2, "raw"))))
+        self.assertEqual(store.lock_path(("ds", 1, "raw")), store.lock_path(("ds", 2, "raw")))
+
+    def test_built_table_is_returned_when_its_entry_is_evicted_at_once(self):
+        store = SharedTableStore(self.directory, 10 ** 9)
+        put = store.put
+
+        def put_then_evict(key, table):
+            path = put(key, table)
+            os.remove(path)
+            return path
+
+        with patch.object(store, 'put', side_effect=put_then_evict):
+            table = store.get_or_create(("ds", 1, "raw"), lambda: self.table)
+        self.assertTrue(table.equals(self.table))
+
+    def test_dataset_cache_maps_the_shared_copy(self):
+        """A process that finds the table in the store neither downloads nor decodes it."""
+        user = User.objects.create_user(username='shared_owner', email='shared_owner@example.com', password='password123')
+        store = MemoryObjectStore()
+        key = Fernet.generate_key()
+        parquet = io.BytesIO()
+        pd.DataFrame({"name": ["Alice", "Bob"], "age": [30, 25]}).to_parquet(parquet)
+        store.objects["encrypted/shared.parquet.enc"] = Fernet(key).encrypt(parquet.getvalue())
+        dataset = Dataset.objects.create(
+            contributor_id=user, title="Shared", category="Test", description="Mapped from the store.",
+            link="http://localhost:9000/alacrity/encrypted/shared.parquet.enc", encryption_key=key.decode(),
+            schema={"name": "object", "age": "int64"}, number_of_rows=2,
+        )
+        self.addCleanup(DATASET_CACHE.clear)
+        with patch('alacrity_backend.storage.client', store), \
+                override_settings(DATASET_SHARED_STORE_ENABLED=True, DATASET_SHARED_STORE_DIR=self.directory):
+            cursor = get_cursor(dataset)
+            self.assertEqual(cursor.execute("SELECT SUM(age) FROM temp").fetchone()[0], 55)
+            # another process: its own empty in-memory cache, the same store
+            DATASET_CACHE.clear()
+            store.fetched.clear()
+            cursor = get_cursor(dataset, normalize=False)
+            self.assertEqual(cursor.execute("SELECT MAX(name) FROM temp").fetchone()[0], "Bob")
+            self.assertEqual(store.fetched, [])
+            self.assertIsInstance(DATASET_CACHE[cache_key(dataset)]["data"], pa.Table)
+
+            evict_dataset(dataset.dataset_id)
+            self.assertEqual(get_shared_store().entries(), [])
+
+
+class SelectiveReadTests(TestCase):
+    """Tests for column- and row-group-selective reads of stored parts."""
+
+    def setUp(self):
+        self.store = MemoryObjectStore()
+        patcher = patch('alacrity_backend.storage.client', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.key = Fernet.generate_key()
+        rows = 100000
+        self.table = pa.table({
+            "id": pa.array(range(rows), pa.int64()),
+            "score": pa.array([i / 7 for i in range(rows)], pa.float64()),
+            "label": pa.array([f"label-{i}" for i in range(rows)]),
+        })
+        parquet = io.BytesIO()
+        pq.write_table(self.table, parquet, row_group_size=10000, compression="none")
+        self.parquet = parquet.getvalue()
+
+    def store_part(self, encrypted):
+        self.store.objects["encrypted/part.parquet.enc"] = encrypted
+        return DatasetPart(
+            link="http://localhost:9000/alacrity/encrypted/part.parquet.enc",
+            encryption_key=self.key.decode(), size=len(encrypted),
+        )
+
+    def test_full_read(self):
+        part = self.store_part(encrypt_dataset_object(self.key, self.parquet, segment_size=16384))
+        self.assertTrue(read_part(part).equals(self.table))
+
+    def test_projection_and_row_limit_fetch_only_what_is_used(self):
+        encrypted = encrypt_dataset_object(self.key, self.parquet, segment_size=16384)
+        part = self.store_part(encrypted)
+        table = read_part(part, columns=["id"], max_rows=50)
+        self.assertEqual(table.column_names, ["id"])
+        self.assertEqual(table.column("id").to_pylist(), list(range(50)))
+        self.assertLess(self.store.bytes_served, len(encrypted) / 10)
+
+    def test_row_limit_spans_parts(self):
+        part = self.store_part(encrypt_dataset_object(self.key, self.parquet, segment_size=16384))
+        table = read_parts([part, part], columns=["label"], max_rows=100010)
+        self.assertEqual(table.num_rows, 100010)
+        self.assertEqual(table.column("label")[-1].as_py(), "label-9")
+
+    def test_legacy_objects_are_filtered_in_memory(self):
+        part = self.store_part(Fernet(self.key).encrypt(self.parquet))
+        table = read_part(part, columns=["score", "id"], max_rows=3)
+        self.assertEqual(table.column("id").to_pylist(), [0, 1, 2])
+        self.assertEqual(table.column_names, ["score", "id"])
+
+
+class ObjectCacheTests(TestCase):
+    """Tests for the node-local encrypted object cache."""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        settings_override = override_settings(
+            DATASET_OBJECT_CACHE_ENABLED=True, DATASET_OBJECT_CACHE_DIR=directory, DATASET_OBJECT_CACHE_MAX_BYTES=250,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.cache = get_object_cache()
+        self.store = MemoryObjectStore()
+        patcher = patch('alacrity_backend.storage.client', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for number, key in enumerate(["a", "b", "c"]):
+            os.utime(self.cache.put(key, "etag", [b"x" * 100]), (number, number))
+        self.assertIsNone(self.cache.get("a", "etag"))
+        self.assertIsNotNone(self.cache.get("b", "etag"))
+        os.utime(self.cache.path("b", "etag"), (10, 10))  # b is now the most recently used
+        self.cache.put("d", "etag", [b"x" * 100])
+        self.assertIsNone(self.cache.get("c", "etag"))
+        self.assertIsNotNone(self.cache.get("b", "etag"))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"]), (2, 2, 2))
+        self.assertEqual((stats["entries"], stats["bytes"]), (2, 200))
+
+    def test_new_etag_replaces_the_entry(self):
+        self.cache.put("a", "v1", [b"old"])
+        self.cache.put("a", "v2", [b"new"])
+        self.assertIsNone(self.cache.get("a", "v1"))
+        with open(self.cache.get("a", "v2"), 'rb') as f:
+            self.assertEqual(f.read(), b"new")
+
+    @override_settings(DATASET_OBJECT_CACHE_MAX_BYTES=10 * 1024 * 1024)
+    def test_parts_are_read_from_disk_after_the_first_load(self):
+        key = Fernet.generate_key()
+        parquet = io.BytesIO()
+        pd.DataFrame({"id": range(100)}).to_parquet(parquet)
+        self.store.objects["encrypted/cached.parquet.enc"] = encrypt_dataset_object(key, parquet.getvalue())
+        part = DatasetPart(link="http://localhost:9000/alacrity/encrypted/cached.parquet.enc", encryption_key=key.decode())
+
+        self.assertEqual(read_part(part).num_rows, 100)
+        self.assertEqual(self.store.fetched, ["encrypted/cached.parquet.enc"])
+        self.assertEqual(read_part(part).num_rows, 100)
+        self.assertEqual(read_part(part, columns=["id"], max_rows=5).column("id").to_pylist(), [0, 1, 2, 3, 4])
+        self.assertEqual(len(self.store.fetched), 1)
+
+        # an object rewritten in place has a new ETag and is fetched again
+        self.store.objects["encrypted/cached.parquet.enc"] = encrypt_dataset_object(key, parquet.getvalue())
+        self.assertEqual(read_part(part).num_rows, 100)
+        self.assertEqual(len(self.store.fetched), 2)
+        self.assertEqual(self.cache.stats()["entries"], 1)
+
+    def test_counters_are_written_in_batches(self):
+        """Hits and misses are counted in memory and added to stats.json when the stats are read."""
+        self.cache.put("a", "v1", [b"x"])
+        self.cache.get("a", "v1")
+        self.cache.get("b", "v1")
+        self.assertEqual(self.cache._read_stats()["hits"], 0)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["bytes_fetched"]), (1, 1, 1))
+        self.assertEqual(self.cache._read_stats()["hits"], 1)
+
+    @override_settings(DATASET_OBJECT_CACHE_MAX_BYTES=10 * 1024 * 1024)
+    def test_parts_with_a_recorded_size_are_opened_without_a_stat(self):
+        key = Fernet.generate_key()
+        parquet = io.BytesIO()
+        pd.DataFrame({"id": range(10)}).to_parquet(parquet)
+        stored = encrypt_dataset_object(key, parquet.getvalue())
+        self.store.objects["encrypted/sized.parquet.enc"] = stored
+        part = DatasetPart(
+            link="http://localhost:9000/alacrity/encrypted/sized.parquet.enc", encryption_key=key.decode(), size=len(stored),
+        )
+
+        with patch.object(self.store, 'stat_object', wraps=self.store.stat_object) as stat_object:
+            self.assertEqual(read_part(part).num_rows, 10)
+            self.assertEqual(read_part(part, columns=["id"], max_rows=5).num_rows, 5)
+        stat_object.assert_not_called()
+        self.assertEqual(self.store.fetched, ["encrypted/sized.parquet.enc"])
+
+        # a rewrite records the new size on the part, which names a new entry
+        parquet = io.BytesIO()
+        pd.DataFrame({"id": range(20)}).to_parquet(parquet)
+        stored = encrypt_dataset_object(key, parquet.getvalue())
+        self.store.objects["encrypted/sized.parquet.enc"] = stored
+        part.size = len(stored)
+        self.assertEqual(read_part(part).num_rows, 20)
+        self.assertEqual(len(self.store.fetched), 2)
+        self.assertEqual(self.cache.stats()["entries"], 1)
+
+    @override_settings(DATASET_OBJECT_CACHE_MAX_BYTES=10 * 1024 * 1024)
+    def test_warm_object_cache_command(self):
+        user = User.objects.create_user(username='warm', email='warm@example.com', password='password123', role='contributor')
+        key = Fernet.generate_key()
+        self.store.objects["encrypted/warm.parquet.enc"] = encrypt_dataset_object(key, b"parquet bytes")
+        dataset = Dataset.objects.create(
+            contributor_id=user, title="Warm", category="Test", description="Cached ahead of use.",
+            link="http://localhost:9000/alacrity/encrypted/warm.parquet.enc", encryption_key=key.decode(),
+            schema={}, number_of_rows=0,
+        )
+        DatasetAccessMetrics.objects.create(dataset=dataset, user=user)
+        out = io.StringIO()
+        call_command('warm_object_cache', stdout=out)
+        self.assertIn("Cached 1 object(s)", out.getvalue())
+        self.assertIsNotNone(self.cache.get("encrypted/warm.parquet.enc", self.store.stat_object(BUCKET, "encrypted/warm.parquet.enc").etag))
+
+
+class StorageClientTests(TestCase):
+    """Tests for the shared object storage module."""
+
+    def test_object_key_is_independent_of_the_link_scheme(self):
+        for link in (
+            "http://10.72.98.50:9000/alacrity/encrypted/a%20b.parquet.enc",
+            "https://minio.example.com/alacrity/encrypted/a b.parquet.enc",
+            "s3://alacrity/encrypted/a b.parquet.enc",
+            "10.72.98.50:9000/alacrity/encrypted/a b.parquet.enc",
+            "encrypted/a b.parquet.enc",
+        ):
+            self.assertEqual(storage.object_key(link), "encrypted/a b.parquet.enc", link)
+        self.assertEqual(storage.object_key(storage.object_url("profile_pictures/1/p.png")), "profile_pictures/1/p.png")
+
+    @override_settings(STORAGE_POOL_SIZE=7, STORAGE_RETRIES=2, STORAGE_READ_TIMEOUT=9)
+    def test_http_client_is_pooled_with_retries_and_timeouts(self):
+        http = storage.create_http_client()
+        self.assertEqual(http.connection_pool_kw["maxsize"], 7)
+        self.assertEqual(http.connection_pool_kw["retries"].total, 2)
+        self.assertEqual(http.connection_pool_kw["timeout"].read_timeout, 9)
+
+    def test_async_api(self):
+        store = MemoryObjectStore()
+        store.objects["encrypted/async.bin"] = b"0123456789"
+
+        async def use_storage():
+            await storage.aput_object("encrypted/copy.bin", io.BytesIO(b"abc"), length=3)
+            chunks = [chunk async for chunk in storage.astream_object("encrypted/async.bin", chunk_size=4)]
+            return (
+                await storage.aget_object("encrypted/async.bin", offset=2, length=3),
+                chunks,
+                (await storage.astat_object("encrypted/copy.bin")).size,
+            )
+
+        with patch('alacrity_backend.storage.client', store):
+            ranged, chunks, size = asyncio.run(use_storage())
+        self.assertEqual(ranged, b"234")
+        self.assertEqual(chunks, [b"0123", b"4567", b"89"])
+        self.assertEqual(size, 3)
+
+
+class DtypeOptimisationTests(TestCase):
+    """Tests for the column type optimisation applied at ingest."""
+
+    def run_ingest(self, csv_bytes):
+        uploaded = io.BytesIO()
+
+        def upload(stream, part_size):
+            uploaded.write(stream.read())
+
+        result = ingest_csv(io.BytesIO(csv_bytes), upload)
+        plaintext = decrypt_dataset_object(result["encryption_key"], uploaded.getvalue())
+        return result, pq.read_table(io.BytesIO(plaintext))
+
+    def test_plan_schema_picks_tightest_types(self):
+        """Integers, floats, timestamps and repetitive text get the narrowest type that holds them."""
+        batch = pa.RecordBatch.from_pydict({
+            "small": pa.array([1, 2, 30, -5], pa.int64()),
+            "large": pa.array([1, 2, 100000, 0], pa.int64()),
+            "halves": pa.array([0.5, 1.25, None, 2.0], pa.float64()),
+            "tenths": pa.array([0.1, 0.2, 0.3, 0.4], pa.float64()),
+            "day": pa.array([datetime(2024, 1, 1), datetime(2024, 1, 2), None, datetime(2024, 1, 3)], pa.timestamp("s")),
+            "moment": pa.array([datetime(2024, 1, 1, 12, 30)] * 4, pa.timestamp("s")),
+            "city": pa.array(["Paris", "Paris", "Rome", "Rome"]),
+            "name": pa.array(["Ann", "Bob", "Cy", "Di"]),
+        })
+        schema = plan_schema(batch, fixed_types={"large": pa.int64()})
+        self.assertEqual(schema.field("small").type, pa.int8())
+        self.assertEqual(schema.field("large").type, pa.int64())
+        self.assertEqual(schema.field("halves").type, pa.float32())
+        self.assertEqual(schema.field("tenths").type, pa.float64())
+        self.assertEqual(schema.field("day").type, pa.date32())
+        self.assertEqual(schema.field("moment").type, pa.timestamp("s"))
+        self.assertEqual(schema.field("city").type, pa.dictionary(pa.int32(), pa.string()))
+        self.assertEqual(schema.field("name").type, pa.string())
+        self.assertEqual(
+            {field.name: dtype_name(field.type) for field in schema},
+            {"small": "int64", "large": "int64", "halves": "float64", "tenths": "float64",
+             "day": "datetime64[ms]", "moment": "datetime64[s]", "city": "object", "name": "object"},
+        )
+        self.assertEqual(
+            {field.name: logical_type(field.type) for field in schema},
+            {"small": "int8", "large": "int64", "halves": "float32", "tenths": "float64",
+             "day": "date", "moment": "datetime", "city": "category", "name": "object"},
+        )
+
+    def test_ingest_stores_optimised_types(self):
+        """The stored Parquet file uses the optimised types; Dataset.schema keeps the wide names."""
+        rows = "".join(f"{['Paris', 'Rome'][i % 2]},{i},2024-01-{i + 1:02d},true\n" for i in range(20))
+        result, table = self.run_ingest(f"city,count,day,active\n{rows}".encode())
+        self.assertEqual(result["schema"], {"city": "object", "count": "int64", "day": "datetime64[ms]", "active": "bool"})
+        self.assertEqual(table.schema.field("count").type, pa.int8())
+        self.assertEqual(str(table.to_pandas()["city"].dtype), "category")
+        self.assertEqual(table.column("city").to_pylist()[:2], ["Paris", "Rome"])
+
+    @override_settings(DATASET_INGEST_BLOCK_SIZE=64, DATASET_ENCRYPTION_SEGMENT_SIZE=128)
+    def test_ingest_restarts_when_a_later_batch_overflows(self):
+        """A value beyond the planned integer type restarts the ingest with the type the reader inferred."""
+        rows = "".join(f"{i}\n" for i in range(50))
+        result, table = self.run_ingest(f"value\n{rows}5000000000\n".encode())
+        self.assertEqual(result["schema"], {"value": "int64"})
+        self.assertEqual(table.column("value").to_pylist()[-1], 5000000000)
+
+    @override_settings(DATASET_OPTIMIZE_TYPES=False)
+    def test_optimisation_can_be_disabled(self):
+        result, table = self.run_ingest(b"city,count\nParis,1\nParis,2\nParis,3\n")
+        self.assertEqual(result["schema"], {"city": "object", "count": "int64"})
+
+    def test_is_numeric_dtype(self):
+        for name in ["int8", "int16", "int32", "int64", "uint8", "float32", "float64"]:
+            self.assertTrue(is_numeric_dtype(name))
+        for name in ["object", "category", "date", "datetime", "bool", "datetime64[ms]"]:
+            self.assertFalse(is_numeric_dtype(name))
+
+
+@patch.object(RangedDownloader, '_backoff')
+class RangedDownloadTests(TestCase):
+    """Tests for the parallel ranged downloader, against a local HTTP server."""
+
+    content = b"".join(f"{i},row{i}\n".encode() for i in range(2000))
+
+    def download(self, server, **kwargs):
+        downloader = RangedDownloader(chunk_size=1000, workers=4, max_retries=2, **kwargs)
+        destination, size = downloader.download(server.url, headers={"Authorization": "Bearer token"})
+        with destination:
+            return destination.read(), size
+
+    def test_parallel_ranges(self, mock_backoff):
+        """The file is split into Range requests and reassembled in order."""
+        with FileServer(self.content) as server:
+            data, size = self.download(server)
+        self.assertEqual(data, self.content)
+        self.assertEqual(size, len(self.content))
+        self.assertEqual(len(server.requests), -(-len(self.content) // 1000))
+        self.assertTrue(all(headers["Authorization"] == "Bearer token" for headers in server.requests))
+
+    @patch('datasets.downloads.READ_SIZE', 100)
+    def test_interrupted_range_resumes(self, mock_backoff):
+        """A dropped connection resumes from the last byte received rather than from zero."""
+        with FileServer(self.content, failures=2) as server:
+            data, size = self.download(server)
+        self.assertEqual(data, self.content)
+        starts = [int(headers["Range"].split("=")[1].split("-")[0]) for headers in server.requests]
+        self.assertEqual(len(starts), -(-len(self.content) // 1000) + 2)
+        self.assertEqual(len([start for start in starts if start % 1000]), 2)
+
+    def test_server_without_ranges(self, mock_backoff):
+        """Servers that ignore Range are downloaded in one sequential stream."""
+        with FileServer(self.content, ranges=False, failures=1) as server:
+            data, size = self.download(server)
+        self.assertEqual(data, self.content)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_partial_reply_of_unknown_length_is_fetched_whole(self, mock_backoff):
+        """A 206 without a total size is not taken for the whole file."""
+        with FileServer(self.content, unknown_length=True) as server:
+            data, size = self.download(server)
+        self.assertEqual(data, self.content)
+        self.assertEqual(size, len(self.content))
+        self.assertNotIn("Range", server.requests[-1])
+
+    def test_token_is_not_sent_to_another_host(self, mock_backoff):
+        """Ranges after a cross-host redirect do not carry the Authorization header."""
+        with FileServer(self.content, host="localhost") as target:
+            with FileServer(b"", redirect=target.url) as origin:
+                data, size = self.download(origin)
+        self.assertEqual(data, self.content)
+        self.assertEqual(len(target.requests), -(-len(self.content) // 1000))
+        self.assertTrue(all("Authorization" not in headers for headers in target.requests))
+        self.assertTrue(all(headers["Authorization"] == "Bearer token" for headers in origin.requests))
+
+    def test_gives_up_after_retries(self, mock_backoff):
+        """A range that keeps failing raises a DownloadError."""
+        with FileServer(self.content, failures=100) as server:
+            with self.assertRaises(DownloadError):
+                self.download(server)
+
+
+@override_settings(DATASET_CHARSET_SAMPLE_SIZE=64, DATASET_CHARSET_MAX_SCAN=512)
+class CharsetDetectionTests(TestCase):
+    """Tests for the sampled charset detection used by the ingest pipeline."""
+
+    def build_file(self, tail_line):
+        return io.BytesIO(("id,name\n" + "".join(f"{i},row{i}\n" for i in range(200)) + tail_line).encode("latin1"))
+
+    def test_samples_cover_head_middle_and_tail(self):
+        """Only three bounded windows are read, and the last one reaches the end of the file."""
+        source = self.build_file("999,Z\xfcrich\n")
+        samples = read_samples(source, windows=3)
+        self.assertEqual(len(samples), 3)
+        self.assertTrue(samples[0].startswith(b"id,name"))
+        self.assertTrue(samples[-1].endswith("Z\xfcrich\n".encode("latin1")))
+        self.assertTrue(all(len(sample) <= 64 for sample in samples))
+        self.assertEqual(source.tell(), 0)
+
+    @patch('datasets.charset.detect', return_value={'encoding': 'utf-8', 'confidence': 0.99})
+    def test_candidates_that_cannot_decode_samples_are_dropped(self, mock_detect):
+        """A non UTF-8 byte in the tail removes utf-8 before the pipeline reads the file."""
+        encodings = detect_encodings(self.build_file("999,Z\xfcrich\n"))
+        self.assertNotIn("utf-8", encodings)
+        self.assertEqual(encodings[0], "iso8859-1")
+        mock_detect.assert_called_once()
+
+    @patch('datasets.charset.detect', return_value={'encoding': 'ascii', 'confidence': 1.0})
+    def test_ascii_is_read_as_utf8(self, mock_detect):
+        """ASCII detections are widened to UTF-8 since later rows may not be ASCII."""
+        self.assertEqual(detect_encodings(self.build_file("999,end\n"))[0], "utf-8")
+
+    @patch('datasets.charset.detect', return_value={'encoding': None, 'confidence': 0.1})
+    def test_low_confidence_escalates_to_wider_scan(self, mock_detect):
+        """A low-confidence result triggers one wider scan, then falls back to common encodings."""
+        encodings = detect_encodings(self.build_file("999,end\n"))
+        self.assertEqual(mock_detect.call_count, 2)
+        self.assertGreater(len(mock_detect.call_args_list[1].args[0]), len(mock_detect.call_args_list[0].args[0]))
+        self.assertEqual(encodings, ["utf-8", "iso8859-1", "cp1252"])
+
+
+class ParquetProfileTests(TestCase):
+    """Tests for the Parquet write profiles."""
+
+    def test_select_profile_by_size(self):
+        """Small uploads are archived, large ones favour ingest speed."""
+        self.assertEqual(select_profile(1024), "archival")
+        self.assertEqual(select_profile(100 * 1024 * 1024), "balanced")
+        self.assertEqual(select_profile(5 * 1024 * 1024 * 1024), "fast-ingest")
+        with override_settings(DATASET_PARQUET_PROFILE="fast-ingest"):
+            self.assertEqual(select_profile(1024), "fast-ingest")
+
+    @patch.dict(PARQUET_PROFILES["balanced"], {"row_group_size": 10})
+    def test_row_groups_follow_profile(self):
+        """Batches are regrouped into row groups of the profile's size with its codec."""
+        sink = io.BytesIO()
+        writer = RowGroupWriter(sink, pa.schema([("value", pa.int64())]), "balanced")
+        for start in range(0, 25, 7):
+            writer.write_batch(pa.record_batch([pa.array(range(start, min(start + 7, 25)))], names=["value"]))
+        writer.close()
+
+        metadata = pq.ParquetFile(io.BytesIO(sink.getvalue())).metadata
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], [10, 10, 5])
+        self.assertEqual(metadata.row_group(0).column(0).compression, "ZSTD")
+        self.assertTrue(metadata.row_group(0).column(0).is_stats_set)
+
+    def test_wide_rows_flush_before_the_row_count(self):
+        """The buffered row group is written out once it reaches its byte cap."""
+        sink = io.BytesIO()
+        writer = RowGroupWriter(sink, pa.schema([("text", pa.string())]), "balanced", max_buffer_bytes=20000)
+        flushed = [writer.write_batch(pa.record_batch([pa.array(["x" * 1000] * 10)], names=["text"])) for _ in range(5)]
+        writer.close()
+
+        self.assertEqual(flushed, [False, True, False, True, False])
+        metadata = pq.ParquetFile(io.BytesIO(sink.getvalue())).metadata
+        self.assertEqual([metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)], [20, 20, 10])
+
+    def test_benchmark_reports_every_profile(self):
+        """The benchmark reports write time, size and scan time for each profile."""
+        table = pa.table({"a": list(range(1000)), "b": [str(i % 3) for i in range(1000)]})
+        results = benchmark_profiles(table, repeat=1)
+        self.assertEqual([result["profile"] for result in results], list(PARQUET_PROFILES))
+        for result in results:
+            self.assertGreater(result["size_bytes"], 0)
+            self.assertGreaterEqual(result["scan_seconds"], 0)
+
+
+class DatasetProfileTests(TestCase):
+    """Tests for the dataset profiles computed at ingest."""
+
+    def setUp(self):
+        self.df = pd.DataFrame({
+            "city": ["Cardiff", "Bristol", "Cardiff", None, "Cardiff"],
+            "age": [30, 25, 30, 41, None],
+            "score": [1.5, 2.0, 1.5, 3.25, 4.0],
+        })
+        user = User.objects.create_user(username='profiler', email='profiler@example.com', password='password123')
+        self.dataset = Dataset.objects.create(
+            contributor_id=user, title="Profiled", category="Test", description="Profiled dataset",
+            link="http://minio/alacrity/encrypted/a.parquet.enc", encryption_key="key", schema={},
+        )
+
+    def test_profile_matches_pre_analysis(self):
+        """The DuckDB profile gives the same numbers pre_analysis computed with pandas."""
+        profile = profile_arrow_table(pa.Table.from_pandas(self.df, preserve_index=False))[False]
+        expected = pre_analysis(self.df)
+        self.assertEqual(profile["total_rows"], expected["total_rows"])
+        self.assertEqual(profile["columns"], expected["columns"])
+        self.assertEqual(profile["duplicate_rows"], expected["duplicate_rows"])
+        self.assertEqual(profile["missing_values"], expected["missing_values"])
+        self.assertEqual(profile["categorical_stats"], expected["categorical_stats"])
+        for column, stats in expected["numeric_stats"].items():
+            for name, value in stats.items():
+                self.assertAlmostEqual(profile["numeric_stats"][column][name], value)
+
+    def test_normalized_profile_and_top_k(self):
+        """The cleaned profile drops duplicates and missing values; text columns keep the top K values."""
+        with override_settings(DATASET_PROFILE_TOP_K=1):
+            profiles = profile_arrow_table(pa.Table.from_pandas(self.df, preserve_index=False))
+        self.assertEqual(profiles[False]["categorical_stats"]["city"], {"Cardiff": 3})
+        self.assertEqual(profiles[True]["total_rows"], len(self.df.drop_duplicates().dropna()))
+        self.assertEqual(profiles[True]["duplicate_rows"], 0)
+
+    def test_profile_is_stale_when_link_changes(self):
+        """A profile computed from another stored object is not used."""
+        save_profiles(self.dataset, profile_arrow_table(pa.Table.from_pandas(self.df, preserve_index=False)))
+        self.assertIsNotNone(get_current_profile(self.dataset, normalized=True))
+        self.dataset.link = "http://minio/alacrity/encrypted/b.parquet.enc"
+        self.dataset.save()
+        self.assertIsNone(get_current_profile(self.dataset))
+        self.assertEqual(DatasetProfile.objects.filter(dataset=self.dataset).count(), 2)
+
+
+class UploadFormatTests(TestCase):
+    """Tests for the format readers used by ingest_upload."""
+
+    def run_ingest(self, data, file_name="", **kwargs):
+        uploaded = io.BytesIO()
+
+        def upload(stream, part_size):
+            while True:
+                part = stream.read(part_size)
+                if not part:
+                    break
+                uploaded.write(part)
+
+        result = ingest_upload(io.BytesIO(data), upload, file_name=file_name, **kwargs)
+        plaintext = decrypt_dataset_object(result["encryption_key"], uploaded.getvalue())
+        return result, plaintext
+
+    def parquet_bytes(self, df, profile):
+        sink = io.BytesIO()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        writer = RowGroupWriter(sink, table.schema, profile)
+        for batch in table.to_batches():
+            writer.write_batch(batch)
+        writer.close()
+        return sink.getvalue()
+
+    def test_detect_format(self):
+        """Magic bytes win over the file name; the name only separates text formats."""
+        self.assertEqual(detect_format(io.BytesIO(b"PAR1...."), "data.csv"), ("parquet", None))
+        self.assertEqual(detect_format(io.BytesIO(gzip.compress(b"a\n1\n")), "data.csv.gz"), ("csv", "gzip"))
+        self.assertEqual(detect_format(io.BytesIO(gzip.compress(b"{}")), "data.jsonl.gz"), ("jsonl", "gzip"))
+        self.assertEqual(detect_format(self.zip_of({"xl/workbook.xml": b"<workbook/>"}), "book.xlsx"), ("excel", None))
+        self.assertEqual(detect_format(io.BytesIO(b'{"a": 1}\n'), "upload"), ("jsonl", None))
+        self.assertEqual(detect_format(io.BytesIO(b"a,b\n1,2\n"), "upload"), ("csv", None))
+        with self.assertRaises(IngestError):
+            detect_format(io.BytesIO(b"\xd0\xcf\x11\xe0rest"), "book.xls")
+
+    def zip_of(self, files):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as writer:
+            for name, data in files.items():
+                writer.writestr(name, data)
+        archive.seek(0)
+        return archive
+
+    def test_unsupported_containers_are_named(self):
+        """A ZIP of CSVs and a JSON array are rejected with a message saying what is expected."""
+        with self.assertRaisesRegex(IngestError, "ZIP archives are not supported"):
+            detect_format(self.zip_of({"a.csv": b"a\n1\n"}), "data.zip")
+        with self.assertRaisesRegex(IngestError, "JSON Lines expected"):
+            detect_format(io.BytesIO(b' [{"a": 1}]'), "data.json")
+        with self.assertRaisesRegex(IngestError, "JSON Lines expected"):
+            detect_format(io.BytesIO(gzip.compress(b'[{"a": 1}]')), "data.json.gz")
+
+    def test_gzip_csv(self):
+        """Gzipped CSV is decompressed on the fly and gets the same schema as plain CSV."""
+        csv_bytes = b"name,age\nJohn,30\nJane,25\n"
+        result, plaintext = self.run_ingest(gzip.compress(csv_bytes), "people.csv.gz")
+        self.assertEqual(result["format"], "csv.gz")
+        self.assertEqual(result["schema"], self.run_ingest(csv_bytes)[0]["schema"])
+        self.assertEqual(pd.read_parquet(io.BytesIO(plaintext))["age"].tolist(), [30, 25])
+
+    @override_settings(DATASET_INGEST_BLOCK_SIZE=256)
+    def test_json_lines_widen_integers(self):
+        """JSON Lines are read in blocks; an integer column that later holds a float is widened."""
+        lines = "".join(f'{{"id": {i}, "name": "row{i}"}}\n' for i in range(100)) + '{"id": 2.5, "name": "last"}\n'
+        result, plaintext = self.run_ingest(lines.encode(), "rows.jsonl")
+        self.assertEqual(result["rows"], 101)
+        self.assertEqual(result["schema"], {"id": "float64", "name": "object"})
+        self.assertEqual(pd.read_parquet(io.BytesIO(plaintext))["id"].iloc[-1], 2.5)
+
+    @unittest.skipUnless(importlib.util.find_spec("openpyxl"), "openpyxl is not installed")
+    @patch('datasets.formats.EXCEL_BATCH_ROWS', 2)
+    def test_excel_first_sheet(self):
+        """The first sheet is read in row batches; a column with text in a later batch becomes text."""
+        import openpyxl
+        workbook = openpyxl.Workbook()
+        sheet = workbook.active
+        for row in [["name", "score", None], ["a", 1, 1.5], ["b", 2, 2.5], ["c", "n/a", 3.5]]:
+            sheet.append(row)
+        data = io.BytesIO()
+        workbook.save(data)
+
+        result, plaintext = self.run_ingest(data.getvalue(), "scores.xlsx")
+        df = pd.read_parquet(io.BytesIO(plaintext))
+        self.assertEqual(result["format"], "excel")
+        self.assertEqual(result["schema"], {"name": "object", "score": "object", "column_3": "float64"})
+        self.assertEqual(df["score"].tolist(), ["1", "2", "n/a"])
+
+    def test_parquet_passthrough(self):
+        """A Parquet file already written with the profile is stored byte for byte."""
+        original = self.parquet_bytes(pd.DataFrame({"name": ["John", "Jane"], "age": [30, 25]}), "balanced")
+        result, plaintext = self.run_ingest(original, "people.parquet", profile="balanced")
+        self.assertTrue(result["passthrough"])
+        self.assertEqual(plaintext, original)
+        self.assertEqual(result["rows"], 2)
+        self.assertEqual(result["schema"], {"name": "object", "age": "int64"})
+
+    def test_parquet_rewritten_when_profile_differs(self):
+        """A Parquet file with another codec is re-encoded with the profile."""
+        original = self.parquet_bytes(pd.DataFrame({"name": ["John", "Jane"], "age": [30, 25]}), "fast-ingest")
+        result, plaintext = self.run_ingest(original, "people.parquet", profile="balanced")
+        self.assertFalse(result["passthrough"])
+        metadata = pq.ParquetFile(io.BytesIO(plaintext)).metadata
+        self.assertEqual(metadata.row_group(0).column(0).compression, "ZSTD")
+        self.assertEqual(pd.read_parquet(io.BytesIO(plaintext))["age"].tolist(), [30, 25])
+
+    def test_invalid_parquet_rejected(self):
+        """A file with the Parquet magic but no valid footer is rejected."""
+        with self.assertRaises(IngestError):
+            self.run_ingest(b"PAR1 not really parquet", "broken.parquet")
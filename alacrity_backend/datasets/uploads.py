@@ -0,0 +1,317 @@
+"""
+Direct-to-storage dataset uploads.
+
+Files sent through ``CreateDatasetView`` pass through a Django worker, which
+buffers and stages every byte. An upload session moves that traffic to MinIO
+instead:
+
+    1. ``POST /datasets/uploads/`` validates the metadata, starts a multipart
+       upload of a staging object (``uploads/<session id>/<file name>``) and
+       returns one presigned ``PUT`` URL per part;
+    2. the browser PUTs the parts straight to MinIO, in parallel if it likes;
+    3. ``POST /datasets/uploads/<session id>/complete/`` joins the parts and
+       queues an ``IngestionJob`` that reads the staging object (see ``jobs.py``).
+
+Clients that cannot reach MinIO use the resumable protocol instead, modelled
+on tus (https://tus.io): ``POST /datasets/resumable/`` opens the same kind of
+session, ``HEAD`` reports the ``Upload-Offset`` received so far and each
+``PATCH`` sends one chunk, optionally with an ``Upload-Checksum``. Django
+forwards every chunk to MinIO as one part of the multipart upload
+(``receive_chunk``), so the chunks received live in MinIO rather than on the
+web worker that took them: after a dropped connection the client asks for the
+offset and carries on from there, with any web worker. Unlike tus, chunks are
+``part_size`` slices at fixed offsets and may arrive in any order and several
+at once; ``Upload-Offset`` is the end of the chunks received without a gap.
+The last chunk completes the session and queues it for ingestion.
+
+The job deletes the staging object once it has run. Sessions that are never
+completed are aborted by the ingest worker pool once ``expires_at`` has passed,
+which also discards their parts.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from alacrity_backend import storage
+from .jobs import STAGING_PREFIX, enqueue_ingest_job
+from .models import UploadSession
+
+
+logger = logging.getLogger(__name__)
+
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+MAX_OBJECT_SIZE = 5 * 1024 ** 4
+DEFAULT_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_EXPIRY = 6 * 60 * 60
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+READ_SIZE = 64 * 1024
+CHECKSUM_ALGORITHMS = {"md5": hashlib.md5, "sha1": hashlib.sha1, "sha256": hashlib.sha256}
+
+
+class UploadSessionError(Exception):
+    """Raised when an upload session cannot be started or completed."""
+
+
+class ChunkError(UploadSessionError):
+    """Raised when a resumable chunk has the wrong offset or length, or was cut off."""
+
+
+class ChecksumMismatch(UploadSessionError):
+    """Raised when a resumable chunk does not match its ``Upload-Checksum``."""
+
+
+def get_part_size(file_size, setting='DATASET_UPLOAD_PART_SIZE', default=DEFAULT_PART_SIZE):
+    """
+    The part size for a file: the ``setting``, raised when the file would
+    otherwise need more parts than S3 allows.
+    """
+    part_size = max(MIN_PART_SIZE, int(getattr(settings, setting, default)))
+    return max(part_size, -(-file_size // MAX_PARTS))
+
+
+def get_chunk_size(file_size):
+    """The chunk size of a resumable upload; each chunk is held in memory while it is forwarded."""
+    return get_part_size(file_size, 'DATASET_RESUMABLE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def get_expiry():
+    return timedelta(seconds=int(getattr(settings, 'DATASET_UPLOAD_EXPIRY', DEFAULT_EXPIRY)))
+
+
+def start_upload_session(user, metadata, file_name, file_size, dataset=None, resumable=False):
+    """
+    Start a multipart upload of a staging object for the client to send parts to.
+    Args:
+        user (User): The uploader.
+        metadata (dict): Stored on the ingestion job for the Dataset row.
+        file_name (str): Name of the file; its extension tells text formats apart.
+        file_size (int): Size of the file in bytes.
+        dataset (Dataset, optional): Append the upload to this dataset.
+        resumable (bool): The parts are resumable chunks sent through the API.
+    Returns:
+        UploadSession: The open session.
+    Raises:
+        UploadSessionError: If the size is out of range.
+    """
+    if file_size <= 0:
+        raise UploadSessionError("File size must be positive")
+    if file_size > MAX_OBJECT_SIZE:
+        raise UploadSessionError("File is too large")
+    session = UploadSession(
+        user=user,
+        dataset=dataset,
+        metadata=metadata,
+        file_name=file_name,
+        file_size=file_size,
+        part_size=get_chunk_size(file_size) if resumable else get_part_size(file_size),
+        expires_at=timezone.now() + get_expiry(),
+    )
+    session.object_key = f"{STAGING_PREFIX}/{session.session_id}/{os.path.basename(file_name) or 'upload'}"
+    session.upload_id = storage.create_multipart_upload(session.object_key)
+    session.save()
+    logger.info(f"Started upload session {session.session_id} for user {user.id}: {file_size} bytes in {session.part_count} parts")
+    return session
+
+
+def part_urls(session):
+    """The presigned ``PUT`` URL of every part of a session."""
+    expires = max(session.expires_at - timezone.now(), timedelta(seconds=1))
+    return [
+        {
+            "part_number": number,
+            "url": storage.presigned_part_url(session.object_key, session.upload_id, number, expires=expires),
+        }
+        for number in range(1, session.part_count + 1)
+    ]
+
+
+def session_payload(session):
+    """The session fields returned to the browser."""
+    return {
+        "session_id": session.session_id,
+        "status": session.status,
+        "file_name": session.file_name,
+        "file_size": session.file_size,
+        "part_size": session.part_size,
+        "part_count": session.part_count,
+        "expires_at": session.expires_at.isoformat(),
+        "job_id": session.job_id,
+    }
+
+
+def _uploaded_parts(session, parts):
+    """
+    The ``(part number, etag)`` list to complete a session with. ETags the browser
+    reports are used as given; without them (a bucket whose CORS rules hide the
+    ``ETag`` header) the parts are listed from MinIO.
+    """
+    if parts:
+        try:
+            uploaded = sorted((int(part["part_number"]), str(part["etag"])) for part in parts)
+        except (KeyError, TypeError, ValueError):
+            raise UploadSessionError("Each part needs a part_number and an etag")
+    else:
+        uploaded = [(number, etag) for number, etag, _ in storage.list_parts(session.object_key, session.upload_id)]
+    numbers = [number for number, _ in uploaded]
+    if numbers != list(range(1, session.part_count + 1)):
+        raise UploadSessionError(f"Expected parts 1 to {session.part_count}, got {len(numbers)}")
+    return uploaded
+
+
+def complete_upload_session(session, parts=None):
+    """
+    Join the uploaded parts into the staging object and queue it for ingestion.
+    Args:
+        session (UploadSession): An open session.
+        parts (list, optional): ``{"part_number", "etag"}`` for every part.
+    Returns:
+        IngestionJob: The queued job.
+    Raises:
+        UploadSessionError: If the session is not open, has expired or parts are missing.
+    """
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(pk=session.pk)
+        if session.status != UploadSession.STATUS_OPEN:
+            raise UploadSessionError(f"Upload session is {session.status}")
+        if session.expires_at <= timezone.now():
+            raise UploadSessionError("Upload session has expired")
+        storage.complete_multipart_upload(session.object_key, session.upload_id, _uploaded_parts(session, parts))
+        size = storage.stat_object(session.object_key).size
+        if size != session.file_size:
+            storage.remove_object(session.object_key)
+            session.status = UploadSession.STATUS_ABORTED
+            session.save(update_fields=['status'])
+            raise UploadSessionError(f"Uploaded {size} bytes, expected {session.file_size}")
+        job = enqueue_ingest_job(
+            session.user, session.metadata, staged_key=session.object_key, file_name=session.file_name,
+            file_size=size, dataset=session.dataset,
+        )
+        session.status = UploadSession.STATUS_COMPLETED
+        session.job = job
+        session.save(update_fields=['status', 'job'])
+    logger.info(f"Completed upload session {session.session_id} as ingestion job {job.job_id}")
+    return job
+
+
+def received_chunks(session):
+    """The numbers (from 1) of the parts MinIO holds for a session."""
+    return [number for number, _, _ in storage.list_parts(session.object_key, session.upload_id)]
+
+
+def upload_offset(session, received):
+    """The end of the chunks received without a gap, the tus ``Upload-Offset``."""
+    received = set(received)
+    count = 0
+    while count + 1 in received:
+        count += 1
+    return min(count * session.part_size, session.file_size)
+
+
+def parse_checksum(header):
+    """
+    Parse an ``Upload-Checksum`` header: the algorithm and the base64 digest.
+    Returns:
+        tuple: The algorithm name and the digest bytes.
+    Raises:
+        UploadSessionError: For an unsupported algorithm or a malformed digest.
+    """
+    try:
+        algorithm, digest = header.strip().split(" ", 1)
+        digest = base64.b64decode(digest, validate=True)
+    except ValueError:
+        raise UploadSessionError("Upload-Checksum must be '<algorithm> <base64 digest>'")
+    if algorithm.lower() not in CHECKSUM_ALGORITHMS:
+        raise UploadSessionError(f"Unsupported checksum algorithm {algorithm}")
+    return algorithm.lower(), digest
+
+
+def receive_chunk(session, offset, stream, length, checksum=None):
+    """
+    Read one chunk of a resumable upload from the request and store it as a part.
+    The last chunk to arrive completes the session.
+    Args:
+        session (UploadSession): An open session.
+        offset (int): Where the chunk starts in the file, a multiple of ``part_size``.
+        stream: The request body, read ``length`` bytes at most.
+        length (int): The chunk's ``Content-Length``.
+        checksum (str, optional): The ``Upload-Checksum`` header.
+    Returns:
+        tuple: The new ``Upload-Offset`` and the queued IngestionJob, or None
+        while chunks are missing.
+    Raises:
+        ChunkError: If the offset or length do not fit the session, or the body was cut off.
+        ChecksumMismatch: If the chunk does not match ``checksum``.
+        UploadSessionError: If the session is not open or has expired.
+    """
+    if session.status != UploadSession.STATUS_OPEN:
+        raise UploadSessionError(f"Upload session is {session.status}")
+    if session.expires_at <= timezone.now():
+        raise UploadSessionError("Upload session has expired")
+    if offset < 0 or offset >= session.file_size or offset % session.part_size:
+        raise ChunkError(f"Upload-Offset must be a multiple of {session.part_size} below {session.file_size}")
+    expected = min(session.part_size, session.file_size - offset)
+    if length != expected:
+        raise ChunkError(f"The chunk at offset {offset} must be {expected} bytes")
+    algorithm, digest = parse_checksum(checksum) if checksum else (None, None)
+
+    hasher = CHECKSUM_ALGORITHMS[algorithm]() if algorithm else None
+    data = bytearray()
+    while len(data) < length:
+        piece = stream.read(min(READ_SIZE, length - len(data)))
+        if not piece:
+            raise ChunkError(f"The chunk at offset {offset} was cut off after {len(data)} bytes")
+        data += piece
+        if hasher is not None:
+            hasher.update(piece)
+    if hasher is not None and hasher.digest() != digest:
+        raise ChecksumMismatch(f"The chunk at offset {offset} does not match its {algorithm} checksum")
+
+    storage.upload_part(session.object_key, session.upload_id, offset // session.part_size + 1, bytes(data))
+    received = received_chunks(session)
+    if len(received) < session.part_count:
+        return upload_offset(session, received), None
+    try:
+        job = complete_upload_session(session)
+    except UploadSessionError:
+        # a chunk sent at the same time completed the session first
+        session.refresh_from_db()
+        if session.status != UploadSession.STATUS_COMPLETED:
+            raise
+        job = session.job
+    return session.file_size, job
+
+
+def abort_upload_session(session):
+    """Discard an open session and the parts uploaded for it."""
+    if session.status != UploadSession.STATUS_OPEN:
+        return False
+    try:
+        storage.abort_multipart_upload(session.object_key, session.upload_id)
+    except Exception as e:
+        logger.warning(f"Could not abort multipart upload of session {session.session_id}: {e}")
+    session.status = UploadSession.STATUS_ABORTED
+    session.save(update_fields=['status'])
+    return True
+
+
+def abort_expired_sessions():
+    """
+    Abort open sessions past their expiry.
+    Returns:
+        int: Number of sessions aborted.
+    """
+    aborted = sum(
+        abort_upload_session(session)
+        for session in UploadSession.objects.filter(status=UploadSession.STATUS_OPEN, expires_at__lte=timezone.now())
+    )
+    if aborted:
+        logger.info(f"Aborted {aborted} expired upload session(s)")
+    return aborted
@@ -3,7 +3,8 @@ from django.urls import include
 from rest_framework.routers import DefaultRouter
 from .views import ( ToggleBookmarkDatasetView, UserBookmarkedDatasetsView, descriptive_statistics, FeedbackView, TrendingDatasetsView,
 filter_and_clean_dataset, 
-get_datasets, get_filter_options, CreateDatasetView, DatasetListView, get_datasets,  get_datasets,
+get_datasets, get_filter_options, CreateDatasetView, AppendDatasetView, DatasetVersionsView, IngestionJobStatusView, DatasetListView, get_datasets,  get_datasets,
+UploadSessionView, UploadSessionDetailView, UploadSessionCompleteView, ResumableUploadView, ResumableUploadDetailView,
 
  pre_analysis)
 from .metric import DatasetMetricsView, DatasetAnalyticsCardView
@@ -14,6 +15,14 @@ from .chat_view import ChatListView, SendMessageView, MessageListView,DatasetDet
 urlpatterns = [
 
     path('create_dataset/', CreateDatasetView.as_view(), name='create_dataset'),
+    path('uploads/', UploadSessionView.as_view(), name='upload_sessions'),
+    path('uploads/<str:session_id>/', UploadSessionDetailView.as_view(), name='upload_session'),
+    path('uploads/<str:session_id>/complete/', UploadSessionCompleteView.as_view(), name='complete_upload_session'),
+    path('resumable/', ResumableUploadView.as_view(), name='resumable_uploads'),
+    path('resumable/<str:session_id>/', ResumableUploadDetailView.as_view(), name='resumable_upload'),
+    path('ingest_jobs/<str:job_id>/', IngestionJobStatusView.as_view(), name='ingest_job_status'),
+    path('append/<str:dataset_id>/', AppendDatasetView.as_view(), name='append_dataset'),
+    path('versions/<str:dataset_id>/', DatasetVersionsView.as_view(), name='dataset_versions'),
     path('clear_cache/<str:dataset_id>/', clear_dataset_cache, name='clear_dataset_cache'),
     path('testget/',get_datasets, name='testget'),
     path('download/<str:dataset_id>/', download_dataset, name='download_dataset'),
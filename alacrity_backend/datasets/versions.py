@@ -0,0 +1,529 @@
+"""
+Dataset versions and their manifests.
+
+A dataset is stored as immutable encrypted Parquet parts (``DatasetPart``), each
+with its own key. A ``DatasetVersion`` lists the parts that make up the data at
+that version. Appending rows uploads one new part and records a new version
+listing the old parts plus the new one, so nothing already stored is
+re-encrypted or uploaded again. ``Dataset.version`` is the version readers load,
+as the union of its parts.
+
+Datasets stored before versions existed have no manifest: their single object
+(``Dataset.link``) is read as the only part until the first append records it.
+
+Everything derived from the data is keyed by version. The dataset cache extends
+a cached copy with just the parts it has not seen (``dataset_cache.get_entry``)
+and profiles are stored per version.
+
+Parts in the segmented encryption format are read selectively: ``SegmentedObjectFile``
+fetches (with ranged requests) and decrypts only the segments Parquet asks for,
+so reading the footer and then a few columns or the first row groups costs
+about what those column chunks weigh, not the whole object. Parts in the older
+formats are downloaded whole and filtered in memory.
+"""
+
+import io
+import logging
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.db import transaction
+
+from alacrity_backend import storage
+from alacrity_backend.storage import object_key
+from .dtypes import conform_table, decode_schema, encode_schema, unify_schemas
+from .encryption import (
+    FORMAT_SEGMENTED,
+    HEADER_SIZE,
+    MAGIC_SIZE,
+    SegmentIndex,
+    StreamDecryptor,
+    StreamEncryptor,
+    decrypt_dataset_object,
+    object_format,
+)
+from .ingest import IngestError, arrow_schema_to_dtypes, arrow_schema_to_logical_types
+from .models import Dataset, DatasetPart, DatasetVersion
+from .object_cache import get_object_cache
+
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def remove_object(link):
+    """Delete a stored object from MinIO; failures are logged, not raised."""
+    try:
+        storage.remove_object(object_key(link))
+    except Exception as e:
+        logger.warning(f"Could not remove stored object {link}: {e}")
+
+
+def legacy_part(dataset):
+    """An unsaved part standing for the single object of a dataset without a manifest."""
+    return DatasetPart(
+        dataset=dataset,
+        sequence=0,
+        link=dataset.link,
+        encryption_key=dataset.encryption_key,
+        rows=dataset.number_of_rows,
+        schema=dataset.schema,
+    )
+
+
+def get_version(dataset, number=None):
+    """The ``DatasetVersion`` for ``number`` (default: the current version), or None."""
+    return dataset.versions.filter(number=number or dataset.version).first()
+
+
+def get_parts(dataset, number=None):
+    """
+    The parts a dataset version is made of.
+    Args:
+        dataset (Dataset): The dataset.
+        number (int, optional): The version, by default ``dataset.version``.
+    Returns:
+        list: ``DatasetPart`` objects in append order.
+    """
+    version = get_version(dataset, number)
+    if version is None:
+        return [legacy_part(dataset)]
+    return list(version.parts.order_by('sequence'))
+
+
+def _remote_stream(link):
+    return storage.stream_object(object_key(link), READ_CHUNK_SIZE)
+
+
+def _get_range(link, offset, length):
+    return storage.get_object(object_key(link), offset, length)
+
+
+def _open_cached(part, fetch=True):
+    """
+    Open the node-local cached copy of a part's stored object (see ``object_cache.py``),
+    downloading it into the cache first on a miss when ``fetch`` is set.
+    Objects are only rewritten by ``migrate_dataset_encryption``, which records
+    the new size on the part, so a part with a recorded size names its entry by
+    that size and is opened without asking MinIO; the ETag is used otherwise.
+    Returns:
+        tuple: The open file (None when the object is not cached or the cache is
+            disabled) and the object's size (None when the cache is disabled and
+            the part has no recorded size).
+    """
+    cache = get_object_cache()
+    if cache is None:
+        return None, part.size or None
+    key = object_key(part.link)
+    if part.size:
+        version, size = f"size{part.size}", part.size
+    else:
+        stat = storage.stat_object(key)
+        version, size = stat.etag, stat.size
+    for _ in range(2):
+        path = cache.get(key, version)
+        if path is None:
+            if not fetch:
+                return None, size
+            path = cache.put(key, version, _remote_stream(part.link))
+        try:
+            return open(path, 'rb'), size
+        except FileNotFoundError:
+            # evicted by another process in between: fetch it again
+            continue
+    return None, size
+
+
+def _fetch(part):
+    cached, _ = _open_cached(part)
+    if cached is not None:
+        with cached:
+            return cached.read()
+    return storage.get_object(object_key(part.link))
+
+
+def _stream(part):
+    cached, _ = _open_cached(part)
+    if cached is None:
+        yield from _remote_stream(part.link)
+        return
+    with cached:
+        while True:
+            chunk = cached.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def cache_object(part):
+    """
+    Make sure a part's stored object is in the node-local object cache.
+    Returns:
+        bool: False if the cache is disabled.
+    """
+    cached, _ = _open_cached(part)
+    if cached is None:
+        return False
+    cached.close()
+    return True
+
+
+def _file_range(file):
+    def read_range(offset, length):
+        file.seek(offset)
+        return file.read(length)
+    return read_range
+
+
+class SegmentedObjectFile(io.RawIOBase):
+    """
+    A seekable, read-only file over the plaintext of a stored segmented object.
+    Reads fetch the segments they cover with one ranged read per run of
+    missing segments; decrypted segments are kept for later reads.
+    Args:
+        read_range (callable): ``(offset, length) -> bytes`` of the encrypted
+            object, from MinIO or from its cached copy.
+        index (encryption.SegmentIndex): Where the object's segments are.
+        source (file, optional): A file to close with this one.
+    """
+
+    def __init__(self, read_range, index, source=None):
+        super().__init__()
+        self.read_range = read_range
+        self.index = index
+        self.source = source
+        self.bytes_fetched = 0
+        self._position = 0
+        self._segments = {}
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        if self.source is not None:
+            self.source.close()
+        super().close()
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.index.plaintext_size
+        self._position = max(0, offset)
+        return self._position
+
+    def _fetch_segments(self, first, last):
+        missing = [number for number in range(first, last + 1) if number not in self._segments]
+        while missing:
+            run_end = 0
+            while run_end + 1 < len(missing) and missing[run_end + 1] == missing[run_end] + 1:
+                run_end += 1
+            offset, length = self.index.byte_range(missing[0], missing[run_end])
+            data = self.read_range(offset, length)
+            self.bytes_fetched += len(data)
+            for number, plaintext in enumerate(self.index.decrypt(missing[0], data), start=missing[0]):
+                self._segments[number] = plaintext
+            missing = missing[run_end + 1:]
+
+    def readinto(self, buffer):
+        end = min(self._position + len(buffer), self.index.plaintext_size)
+        if end <= self._position:
+            return 0
+        first, last = self.index.segments_for(self._position, end)
+        self._fetch_segments(first, last)
+        segment_size = self.index.segment_size
+        data = b"".join(self._segments[number] for number in range(first, last + 1))
+        start = self._position - first * segment_size
+        count = end - self._position
+        buffer[:count] = data[start:start + count]
+        self._position = end
+        return count
+
+
+def open_part(part, whole=True):
+    """
+    Open a part for reading as a ``pyarrow.parquet.ParquetFile``. Segmented parts
+    are read segment by segment (see ``SegmentedObjectFile``); older ones are
+    decrypted whole.
+    Args:
+        part (DatasetPart): The part.
+        whole (bool): Whether all of the part will be read. Whole reads go through
+            the node-local object cache, filling it on a miss; selective reads use
+            the cached copy if there is one and ranged requests to MinIO otherwise.
+    """
+    cached, size = _open_cached(part, fetch=whole)
+    if cached is not None:
+        header = cached.read(HEADER_SIZE)
+        if object_format(header) != FORMAT_SEGMENTED:
+            with cached:
+                cached.seek(0)
+                return pq.ParquetFile(io.BytesIO(decrypt_dataset_object(part.encryption_key, cached.read())))
+        source = SegmentedObjectFile(
+            _file_range(cached), SegmentIndex(part.encryption_key, header, size), source=cached
+        )
+        return pq.ParquetFile(source, pre_buffer=True)
+
+    header = _get_range(part.link, 0, HEADER_SIZE)
+    if object_format(header) != FORMAT_SEGMENTED:
+        return pq.ParquetFile(io.BytesIO(decrypt_dataset_object(part.encryption_key, _fetch(part))))
+    if size is None:
+        size = storage.stat_object(object_key(part.link)).size
+    source = SegmentedObjectFile(
+        lambda offset, length: _get_range(part.link, offset, length), SegmentIndex(part.encryption_key, header, size)
+    )
+    # pre-buffering coalesces the column chunks of a read into few ranged requests
+    return pq.ParquetFile(source, pre_buffer=True)
+
+
+def read_part(part, columns=None, max_rows=None):
+    """
+    Download and decrypt one part, or just some of it.
+    Args:
+        part (DatasetPart): The part.
+        columns (list, optional): Only read these columns.
+        max_rows (int, optional): Only read the row groups holding the first ``max_rows`` rows.
+    Returns:
+        pyarrow.Table: The rows read, at most ``max_rows`` of them.
+    """
+    parquet_file = open_part(part, whole=columns is None and max_rows is None)
+    metadata = parquet_file.metadata
+    row_groups = list(range(metadata.num_row_groups))
+    if max_rows is not None:
+        rows = 0
+        for count, index in enumerate(row_groups, start=1):
+            rows += metadata.row_group(index).num_rows
+            if rows >= max_rows:
+                row_groups = row_groups[:count]
+                break
+    table = parquet_file.read_row_groups(row_groups, columns=columns)
+    return table.slice(0, max_rows) if max_rows is not None else table
+
+
+def download_part(part, path):
+    """
+    Download and decrypt one part to a local Parquet file. Segments are decrypted
+    and written as they arrive, so the part is never held in memory as a whole.
+    """
+    decryptor = StreamDecryptor(part.encryption_key)
+    with open(path, 'wb') as destination:
+        for chunk in _stream(part):
+            destination.write(decryptor.update(chunk))
+        destination.write(decryptor.finalize())
+    return path
+
+
+def stored_format(link):
+    """The encryption format of a stored object (``encryption.FORMAT_*``), from its first bytes."""
+    return object_format(_get_range(link, 0, MAGIC_SIZE))
+
+
+def reencrypt_object(link, encryption_key, segment_size, staging_dir=None):
+    """
+    Rewrite a stored object in the segmented format, in place and with the same key.
+    The plaintext and the new ciphertext go through temporary files, so memory use
+    stays at about one segment.
+    Returns:
+        int: Size of the rewritten object in bytes.
+    """
+    with tempfile.TemporaryFile(dir=staging_dir) as plaintext, tempfile.TemporaryFile(dir=staging_dir) as ciphertext:
+        decryptor = StreamDecryptor(encryption_key)
+        for chunk in _remote_stream(link):
+            plaintext.write(decryptor.update(chunk))
+        plaintext.write(decryptor.finalize())
+        plaintext.seek(0)
+        encryptor = StreamEncryptor(encryption_key, segment_size=segment_size)
+        while True:
+            data = plaintext.read(segment_size)
+            if not data:
+                break
+            ciphertext.write(encryptor.update(data))
+        ciphertext.write(encryptor.finalize())
+        size = ciphertext.tell()
+        ciphertext.seek(0)
+        storage.put_object(object_key(link), ciphertext, length=size)
+    return size
+
+
+def parts_schema(parts):
+    """
+    The unified schema of some parts, from the schemas recorded at ingest.
+    Returns:
+        pyarrow.Schema | None: None if a part has no recorded schema (a legacy object).
+    """
+    if not parts or any(not part.arrow_schema for part in parts):
+        return None
+    return unify_schemas([decode_schema(part.arrow_schema) for part in parts])
+
+
+def read_parts(parts, schema=None, columns=None, max_rows=None):
+    """
+    Read parts as one table.
+    Args:
+        parts (list): ``DatasetPart`` objects.
+        schema (pyarrow.Schema, optional): The schema to read them as; by default
+            the unified schema of ``parts``.
+        columns (list, optional): Only read these columns.
+        max_rows (int, optional): Stop after this many rows; later parts are not read.
+    Returns:
+        pyarrow.Table: The rows of every part, in order.
+    """
+    tables = []
+    for part in parts:
+        remaining = None if max_rows is None else max_rows - sum(table.num_rows for table in tables)
+        if tables and remaining is not None and remaining <= 0:
+            break
+        tables.append(read_part(part, columns=columns, max_rows=remaining))
+    schema = schema or unify_schemas([table.schema for table in tables])
+    if columns is not None:
+        schema = pa.schema([schema.field(name) for name in columns])
+    return pa.concat_tables([conform_table(table, schema) for table in tables])
+
+
+def read_dataset_table(dataset, number=None, columns=None, max_rows=None):
+    """
+    Read a dataset version (default: the current one) as a ``pyarrow.Table``;
+    ``columns`` and ``max_rows`` are as for :func:`read_parts`.
+    """
+    parts = get_parts(dataset, number)
+    return read_parts(parts, parts_schema(parts), columns=columns, max_rows=max_rows)
+
+
+def record_initial_version(dataset, link, encryption_key, result, size, user=None, stored_object=None):
+    """
+    Record the manifest of a new dataset: its first part and version 1.
+    Args:
+        dataset (Dataset): The dataset just created from ``result``.
+        link (str): URL of the stored object.
+        encryption_key (str): The object's key.
+        result (dict): The ingest result (``rows``, ``schema``, ``arrow_schema``).
+        size (int): Size of the stored object in bytes.
+        user (User, optional): The uploader.
+        stored_object (StoredObject, optional): The deduplication record of the object;
+            the part takes over the reference the caller claimed (see ``dedup.py``).
+    Returns:
+        DatasetVersion: The new version.
+    """
+    with transaction.atomic():
+        part = DatasetPart.objects.create(
+            dataset=dataset,
+            stored_object=stored_object,
+            sequence=0,
+            link=link,
+            encryption_key=encryption_key,
+            rows=result["rows"],
+            size=size,
+            schema=result["schema"],
+            arrow_schema=encode_schema(result["arrow_schema"]),
+        )
+        version = DatasetVersion.objects.create(
+            dataset=dataset,
+            number=dataset.version,
+            rows=result["rows"],
+            schema=result["schema"],
+            created_by=user,
+        )
+        version.parts.add(part)
+    return version
+
+
+def ensure_manifest(dataset):
+    """
+    Make sure a dataset has a manifest, recording its legacy single object as
+    part 0 of the current version. The object is read once for its schema.
+    Returns:
+        DatasetVersion: The current version.
+    """
+    version = get_version(dataset)
+    if version is not None:
+        return version
+    part = legacy_part(dataset)
+    encrypted = _fetch(part)
+    schema = pq.read_schema(io.BytesIO(decrypt_dataset_object(part.encryption_key, encrypted)))
+    logger.info(f"Recording the manifest of legacy dataset {dataset.dataset_id}")
+    return record_initial_version(
+        dataset,
+        dataset.link,
+        dataset.encryption_key,
+        {"rows": dataset.number_of_rows, "schema": dataset.schema, "arrow_schema": schema},
+        len(encrypted),
+        dataset.contributor_id,
+    )
+
+
+def check_append_columns(dataset, schema):
+    """
+    Raises:
+        IngestError: If an appended file does not have the dataset's columns.
+    """
+    expected = list(dataset.schema)
+    if set(schema.names) != set(expected):
+        raise IngestError(
+            f"Appended file has columns {', '.join(schema.names)}, the dataset has {', '.join(expected)}"
+        )
+
+
+def append_part(dataset, link, encryption_key, result, size, user=None, stored_object=None):
+    """
+    Add an ingested part to a dataset as a new version.
+    Args:
+        dataset (Dataset): The dataset to extend; it must have a manifest (``ensure_manifest``).
+        link, encryption_key, result, size, user, stored_object: As for :func:`record_initial_version`.
+    Returns:
+        DatasetVersion: The new current version.
+    """
+    with transaction.atomic():
+        # appends to one dataset are serialised so version numbers and part sequences stay dense
+        dataset = Dataset.objects.select_for_update().get(pk=dataset.pk)
+        current = get_version(dataset)
+        parts = list(current.parts.order_by('sequence'))
+        part = DatasetPart.objects.create(
+            dataset=dataset,
+            stored_object=stored_object,
+            sequence=parts[-1].sequence + 1,
+            link=link,
+            encryption_key=encryption_key,
+            rows=result["rows"],
+            size=size,
+            schema=result["schema"],
+            arrow_schema=encode_schema(result["arrow_schema"]),
+        )
+        parts.append(part)
+        unified = parts_schema(parts)
+        schema = arrow_schema_to_dtypes(unified)
+        version = DatasetVersion.objects.create(
+            dataset=dataset,
+            number=current.number + 1,
+            rows=current.rows + result["rows"],
+            schema=schema,
+            created_by=user,
+        )
+        version.parts.set(parts)
+        dataset.version = version.number
+        dataset.number_of_rows = version.rows
+        dataset.schema = schema
+        dataset.logical_schema = arrow_schema_to_logical_types(unified)
+        dataset.save(update_fields=['version', 'number_of_rows', 'schema', 'logical_schema', 'updated_at'])
+    logger.info(f"Dataset {dataset.dataset_id} is now at version {version.number} ({len(parts)} parts)")
+    return version
+
+
+def manifest(version):
+    """The API representation of a version (object links and keys are not exposed)."""
+    return {
+        "version": version.number,
+        "rows": version.rows,
+        "schema": version.schema,
+        "created_at": version.created_at.isoformat() if version.created_at else None,
+        "parts": [
+            {"sequence": part.sequence, "rows": part.rows, "size": part.size}
+            for part in version.parts.order_by('sequence')
+        ],
+    }
@@ -1,3 +1,4 @@
+import base64
 import io
 import json
 import logging
@@ -20,7 +21,6 @@ import pandas as pd
 import requests
 from charset_normalizer import detect
 from cryptography.fernet import Fernet
-from minio import Minio
 from nanoid import generate
 from scipy.stats import mode
 from storages.backends.s3boto3 import S3Boto3Storage
@@ -47,21 +47,32 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from alacrity_backend.settings import (
-    MINIO_ACCESS_KEY,
-    MINIO_BUCKET_NAME,
-    MINIO_SECRET_KEY,
-    MINIO_URL,
-    MINIO_SECURE,
-)
+from alacrity_backend import storage
 from dataset_requests.models import DatasetRequest
 from payments.models import DatasetPurchase
 from research.models import AnalysisSubmission, PublishedResearch
 from users.decorators import role_required
 
 from .new import has_access_to_dataset
+from .downloads import is_dropbox_url, is_google_drive_url
+from .jobs import enqueue_ingest_job, job_payload
+from .uploads import (
+    CHECKSUM_ALGORITHMS,
+    MAX_OBJECT_SIZE,
+    ChecksumMismatch,
+    UploadSessionError,
+    abort_upload_session,
+    complete_upload_session,
+    part_urls,
+    received_chunks,
+    receive_chunk,
+    session_payload,
+    start_upload_session,
+    upload_offset,
+)
+from .versions import manifest
 
-from .models import Dataset , Feedback ,  ViewHistory
+from .models import Dataset , Feedback ,  ViewHistory, IngestionJob, UploadSession
 from organisation.models import FollowerHistory
 from .serializer import DatasetSerializer , randomSerializer
 from rest_framework.permissions import IsAuthenticated, AllowAny
@@ -90,17 +101,6 @@ def is_valid_url(url):
     except:
         return False
 
-minio_client = Minio(
-    endpoint= MINIO_URL,
-    access_key=MINIO_ACCESS_KEY,
-    secret_key= MINIO_SECRET_KEY,
-    secure= MINIO_SECURE
-    )
-
-
-BUCKET = MINIO_BUCKET_NAME
-
-
 
 def generate_id():
     """Generate a unique ID for the dataset."""
@@ -114,15 +114,110 @@ def convert_to_mbs(size_in_bytes):
     """
     return round(size_in_bytes / (1024 * 1024), 2)
 
+def queue_upload(request, metadata, dataset=None):
+    """
+    Queue the file or cloud URL of an upload request for the ingest workers.
+    Args:
+        request (Request): Carries ``file``, or ``fileUrl`` with ``fileName`` and ``accessToken``.
+        metadata (dict): Stored on the job for the Dataset row.
+        dataset (Dataset, optional): Append the upload to this dataset.
+    Returns:
+        Response: 202 with the job id and status URL, or an error.
+    """
+    local_file = request.FILES.get('file')
+    file_url = request.POST.get('fileUrl')
+    file_name = request.POST.get('fileName', 'uploaded_file')
+    access_token = request.POST.get('accessToken')
+    try:
+        if local_file:
+            logger.info(f"Queueing local file: {local_file.name}")
+            job = enqueue_ingest_job(request.user, metadata, local_file=local_file, dataset=dataset)
+        elif file_url:
+            logger.info(f"Queueing cloud URL: {file_url}")
+            if is_google_drive_url(file_url):
+                if not access_token:
+                    logger.error("Google Drive access token is missing")
+                    return Response({"error": "Google Drive access token required"}, status=400)
+            elif not is_dropbox_url(file_url):
+                logger.error("Unsupported cloud provider")
+                return Response({"error": "Unsupported cloud provider"}, status=400)
+            job = enqueue_ingest_job(
+                request.user, metadata, file_url=file_url, access_token=access_token, file_name=file_name,
+                dataset=dataset,
+            )
+        else:
+            logger.error("No file or URL provided")
+            return Response({"error": "No file or URL provided"}, status=400)
+
+        return Response({
+            "message": "Dataset upload accepted",
+            "job_id": job.job_id,
+            "status_url": f"/datasets/ingest_jobs/{job.job_id}/",
+        }, status=202)
+
+    except Exception as e:
+        logger.error(f"Upload failed: {str(e)}", exc_info=True)
+        return Response({"error": f"Upload failed: {str(e)}"}, status=500)
+
+
+def dataset_metadata(data):
+    """
+    Validate the metadata of a new dataset.
+    Args:
+        data (QueryDict | dict): ``title``, ``category``, ``tags``, ``description`` and ``price``.
+    Returns:
+        tuple: The metadata stored on the ingestion job and None, or None and an error Response.
+    """
+    title = data.get('title')
+    category = data.get('category')
+    tags = data.get('tags', '')
+    description = data.get('description')
+    price = data.get('price', '0.00')
+
+    if not title or len(title) > 100:
+        logger.error("Invalid title")
+        return None, Response({"error": "Title is required and must be under 100 characters"}, status=400)
+    if not description or not (10 <= len(description) <= 100000):
+        logger.error("Invalid description")
+        return None, Response({"error": "Description must be 10-100,000 characters"}, status=400)
+
+    try:
+        price = float(price)
+        if price < 0:
+            logger.error("Price cannot be negative")
+            return None, Response({"error": "Price cannot be negative"}, status=400)
+    except (TypeError, ValueError):
+        logger.error("Invalid price format")
+        return None, Response({"error": "Price must be a valid number"}, status=400)
+    return {
+        "title": title,
+        "category": category,
+        "tags": tags,
+        "description": description,
+        "price": price,
+    }, None
+
+
+def can_edit_dataset(user, dataset):
+    """Contributors and organisation admins may change the datasets of their own organisation."""
+    return (
+        user.role in ['organization_admin', 'contributor']
+        and user.organization is not None
+        and str(user.organization.Organization_id) == str(dataset.contributor_id.organization.Organization_id)
+    )
+
+
 @method_decorator(csrf_exempt, name='dispatch')
 class CreateDatasetView(APIView):
     """
     Handle the dataset creation and upload process.
     This view supports uploading files from local storage or cloud storage (Google Drive, Dropbox).
 
-    It also handles the encryption of the dataset and uploads it to MinIO.
-
-    The dataset is then saved in the database with relevant metadata.
+    Uploads are queued as an IngestionJob and processed by the ingest worker pool
+    (see ``jobs.py``), which encrypts the dataset, uploads it to MinIO and saves
+    the Dataset row. Progress is pushed to the uploader over the ``user_{id}`` websocket group.
+    Large files should be sent straight to MinIO through an upload session instead
+    (``UploadSessionView``), which keeps the bytes off the Django workers.
     
         """
     renderer_classes = [JSONRenderer]
@@ -131,234 +226,31 @@ class CreateDatasetView(APIView):
     @role_required(['organization_admin', 'contributor'])
     def post(self, request, *args, **kwargs):
 
-        """Handle the dataset upload and processing.
+        """Validate the upload and queue it for ingestion.
 
-        This method processes the uploaded file, detects its encoding, and converts it to Parquet format.
-        It also encrypts the dataset and uploads it to MinIO.
+        The file is staged (or the cloud URL recorded) and an ingestion job is queued.
+        The worker streams it through the ingest pipeline (see ``ingest.py`` and ``formats.py``):
+        the CSV, gzipped CSV, JSON Lines, Excel or Parquet file is read in batches, written to Parquet row groups, encrypted chunk by chunk and sent
+        to MinIO as a multipart upload, so memory use stays bounded.
         Args:
             request (Request): The HTTP request containing the file and metadata.
         Returns:
-            Response: A JSON response indicating success or failure of the upload.
+            Response: 202 with the job id and status URL, or an error.
         Raises:
-            Exception: If there is an error during the upload process.
+            Exception: If there is an error while queueing the upload.
 
             
         """
         
-        file_size = 0
-        number_of_rows = 0
-        
-        start_time = datetime.now()
-        logger.info(f"Processing upload request at {start_time}")
-        local_file = request.FILES.get('file')
-        file_url = request.POST.get('fileUrl')
-        file_name = request.POST.get('fileName', 'uploaded_file')
-        access_token = request.POST.get('accessToken')
-        try:
-            if local_file:
-                logger.info(f"Processing local file: {local_file.name}")
-                file_buffer = io.BytesIO(local_file.read())
-                base_name = local_file.name.split('.')[0]
-                file_size = convert_to_mbs(local_file.size)
-                
-                
-                logger.info(f"Local file size: {file_size} bytes")
-            elif file_url:
-                logger.info(f"Processing cloud URL: {file_url}")
-                if "drive.google.com" in file_url:
-                    logger.info("Downloading from Google Drive")
-                    if not access_token:
-                        logger.error("Google Drive access token is missing")
-                        return Response({"error": "Google Drive access token required"}, status=400)
-                    file_buffer = self._download_from_google_drive(file_url, access_token)
-                    file_size = convert_to_mbs(file_buffer.getbuffer().nbytes)
-
-                    logger.info(f"Google Drive file size: {file_size} bytes")
-                elif "dropbox.com" in file_url or "dl.dropboxusercontent.com" in file_url:
-                    logger.info("Downloading from Dropbox")
-                    file_buffer = self._download_from_dropbox(file_url)
-                    file_size = convert_to_mbs(file_buffer.getbuffer().nbytes)
-                    logger.info(f"Dropbox file size: {file_size} bytes")
-                else:
-                    logger.error("Unsupported cloud provider")
-                    return Response({"error": "Unsupported cloud provider"}, status=400)
-                base_name = file_name.split('.')[0] if '.' in file_name else file_name
-            else:
-                logger.error("No file or URL provided")
-                return Response({"error": "No file or URL provided"}, status=400)
-            file_buffer.seek(0)
-            raw_data = file_buffer.read()
-            if not raw_data:
-                logger.error("Uploaded file is empty")
-                return Response({"error": "Uploaded file is empty"}, status=400)
-            detection = detect(raw_data)
-            detected_encoding = detection.get('encoding', 'utf-8')
-            confidence = detection.get('confidence', 0)
-            logger.info(f"Detected encoding: {detected_encoding} with confidence: {confidence}")
-
-            if detected_encoding is None or confidence < 0.8:
-                logger.warning("Low confidence in encoding detection, attempting common encodings")
-                encodings_to_try = ['utf-8', 'latin1', 'windows-1252']
-            else:
-                encodings_to_try = [detected_encoding, 'latin1', 'windows-1252']
-            df = None
-            file_buffer.seek(0)
-            for encoding in encodings_to_try:
-                try:
-                    logger.info(f"Attempting to read CSV with encoding: {encoding}")
-                    file_buffer.seek(0)
-                    df = pd.read_csv(file_buffer, encoding=encoding)
-                    number_of_rows = len(df)
-                    logger.info(f"Number of rows in CSV: {number_of_rows}")
-                    logger.info(f"Successfully read CSV with encoding: {encoding}")
-                    break
-                except UnicodeDecodeError as e:
-                    logger.warning(f"Failed to read CSV with encoding {encoding}: {str(e)}")
-                    continue
-                except pd.errors.ParserError as e:
-                    logger.error(f"Invalid CSV format: {str(e)}")
-                    return Response({"error": "Invalid CSV file format"}, status=400)
-
-            if df is None:
-                logger.error("Unable to read CSV with any supported encoding")
-                return Response({"error": "Unable to read the file: unsupported or invalid encoding"}, status=400)
-            parquet_buffer = io.BytesIO()
-            df.to_parquet(parquet_buffer, compression="zstd", compression_level=19, engine="pyarrow")
-            parquet_buffer.seek(0)
-            encryption_key = Fernet.generate_key()
-            cipher = Fernet(encryption_key)
-            encrypted_data = cipher.encrypt(parquet_buffer.getvalue())
-            unique_filename = f"{uuid.uuid4()}_{base_name}.parquet.enc"
-            minio_key = f"encrypted/{unique_filename}"
-            logger.info(f"Uploading to MinIO: {minio_key}")
-            minio_client.put_object(
-                bucket_name=BUCKET,
-                object_name=minio_key,
-                data=io.BytesIO(encrypted_data),
-                length=len(encrypted_data)
-            )
-            #store the url and add http:// or https:// to the url depending on the minio secure value
-            if MINIO_SECURE:
-                stored_url = f"https://{MINIO_URL}/{BUCKET}/{minio_key}"
-            else:
-                stored_url = f"http://{MINIO_URL}/{BUCKET}/{minio_key}"
-
-            # stored_url = f"{MINIO_URL}/{BUCKET}/{minio_key}"
-            title = request.POST.get('title')
-            category = request.POST.get('category')
-            tags = request.POST.get('tags', '')
-            description = request.POST.get('description')
-            price = request.POST.get('price', '0.00')
-
-            if not title or len(title) > 100:
-                logger.error("Invalid title")
-                return Response({"error": "Title is required and must be under 100 characters"}, status=400)
-            if not description or not (10 <= len(description) <= 100000):
-                logger.error("Invalid description")
-                return Response({"error": "Description must be 10-100,000 characters"}, status=400)
-
-            try:
-                price = float(price)
-                if price < 0:
-                    logger.error("Price cannot be negative")
-                    return Response({"error": "Price cannot be negative"}, status=400)
-            except ValueError:
-                logger.error("Invalid price format")
-                return Response({"error": "Price must be a valid number"}, status=400)
-            dataset_id = generate_id()
-            schema = {col: str(dtype) for col, dtype in df.dtypes.items()}
-            dataset = Dataset.objects.create(
-                dataset_id=dataset_id,
-                contributor_id=request.user,
-                title=title,
-                tags=tags,
-                category=category,
-                link=stored_url,
-                description=description,
-                encryption_key=encryption_key.decode(),
-                schema=schema,
-                price=price
+        logger.info(f"Processing upload request at {datetime.now()}")
 
-            )
+        # validate the metadata first so a bad request never streams the file to MinIO
+        metadata, error = dataset_metadata(request.POST)
+        if error is not None:
+            return error
 
-       
-            dataset.number_of_rows = number_of_rows
-            dataset.size = file_size
-           
+        return queue_upload(request, metadata)
 
-            dataset.save()
-
-            end_time = datetime.now()
-            logger.info(f"Upload completed in {end_time - start_time}")
-            return Response({
-                "message": "Dataset created successfully",
-                "dataset_id": dataset_id,
-                "file_url": stored_url
-            }, status=201)
-
-        except pd.errors.ParserError as e:
-            logger.error(f"Invalid CSV format: {str(e)}")
-            return Response({"error": "Invalid CSV file format"}, status=400)
-        except Exception as e:
-            logger.error(f"Upload failed: {str(e)}", exc_info=True)
-            return Response({"error": f"Upload failed: {str(e)}"}, status=500)
-
-    def _download_from_google_drive(self, file_url, access_token):
-        """Download file from Google Drive using the provided access token.
-        Args:
-
-            file_url (str): The Google Drive file URL.
-            access_token (str): The OAuth2 access token for Google Drive API.
-        Returns:
-            BytesIO: A buffer containing the downloaded file.
-        Raises:
-            Exception: If the download fails or the file is not found.
-        """
-        try:
-            file_id = file_url.split("/d/")[1].split("/")[0] if "/d/" in file_url else file_url.split("id=")[1].split("&")[0]
-            download_url = f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
-            headers = {"Authorization": f"Bearer {access_token}"}
-            logger.info(f"Attempting to download Google Drive file with ID: {file_id}")
-            response = requests.get(download_url, headers=headers, stream=True)
-            response.raise_for_status()
-            buffer = io.BytesIO()
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    buffer.write(chunk)
-            buffer.seek(0)
-            logger.info("Google Drive file downloaded successfully")
-            return buffer
-        except requests.RequestException as e:
-            logger.error(f"Google Drive download failed: {str(e)}")
-            raise Exception(f"Failed to download from Google Drive: {str(e)}")
-
-    def _download_from_dropbox(self, file_url):
-        """Download file from Dropbox.
-        Args:
-            file_url (str): The Dropbox file URL.
-        Returns:
-            BytesIO: A buffer containing the downloaded file.
-        """
-        try:
-            if "?dl=0" in file_url:
-                file_url = file_url.replace("?dl=0", "?dl=1")
-            elif "dropbox.com" in file_url and "?dl=1" not in file_url:
-                file_url += "?dl=1"
-
-            logger.info(f"Attempting to download Dropbox file from URL: {file_url}")
-            response = requests.get(file_url, stream=True)
-            response.raise_for_status()
-            buffer = io.BytesIO()
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    buffer.write(chunk)
-            buffer.seek(0)
-            logger.info("Dropbox file downloaded successfully")
-            return buffer
-        except requests.RequestException as e:
-            logger.error(f"Dropbox download failed: {str(e)}")
-            raise Exception(f"Failed to download from Dropbox: {str(e)}")
-        
 
     @role_required(['organization_admin', 'contributor'])
     def put(self, request, *args, **kwargs):
@@ -392,6 +284,324 @@ class CreateDatasetView(APIView):
             return Response(serializer.data, status=200)
         return Response(serializer.errors, status=400)
 
+@method_decorator(csrf_exempt, name='dispatch')
+class AppendDatasetView(APIView):
+    """
+    Append rows to an existing dataset.
+
+    The file goes through the same ingest pipeline as a new upload and is stored
+    as a new encrypted part; the dataset moves to a new version whose manifest
+    lists its earlier parts plus this one (see ``versions.py``). It must have the
+    dataset's columns.
+    """
+    renderer_classes = [JSONRenderer]
+    parser_classes = [MultiPartParser, FormParser, JSONParser]
+
+    @role_required(['organization_admin', 'contributor'])
+    def post(self, request, dataset_id):
+        dataset = Dataset.objects.filter(dataset_id=dataset_id).first()
+        if dataset is None:
+            return Response({"error": "Dataset not found"}, status=404)
+        if not can_edit_dataset(request.user, dataset):
+            return Response({"error": "You are not authorized to edit this dataset"}, status=403)
+        return queue_upload(request, {}, dataset=dataset)
+
+
+class DatasetVersionsView(APIView):
+    """
+    List the versions of a dataset with the parts each one is made of.
+    """
+    renderer_classes = [JSONRenderer]
+
+    @role_required(['organization_admin', 'contributor'])
+    def get(self, request, dataset_id):
+        dataset = Dataset.objects.filter(dataset_id=dataset_id).first()
+        if dataset is None:
+            return Response({"error": "Dataset not found"}, status=404)
+        if not can_edit_dataset(request.user, dataset):
+            return Response({"error": "You are not authorized to view this dataset's versions"}, status=403)
+        return Response({
+            "dataset_id": dataset.dataset_id,
+            "current_version": dataset.version,
+            "versions": [manifest(version) for version in dataset.versions.order_by('-number')],
+        }, status=200)
+
+
+def open_upload_session(request, data, file_size, resumable=False):
+    """
+    Start an upload session from the fields of a request.
+    Args:
+        request (Request): The request, for the uploader.
+        data (dict): ``fileName`` and either the dataset metadata or the ``datasetId`` to append to.
+        file_size: The declared size of the file.
+        resumable (bool): Passed on to ``start_upload_session``.
+    Returns:
+        tuple: The UploadSession and None, or None and an error Response.
+    """
+    file_name = data.get('fileName')
+    if not file_name:
+        return None, Response({"error": "fileName is required"}, status=400)
+    try:
+        file_size = int(file_size)
+    except (TypeError, ValueError):
+        return None, Response({"error": "fileSize must be a number of bytes"}, status=400)
+
+    dataset = None
+    dataset_id = data.get('datasetId')
+    if dataset_id:
+        dataset = Dataset.objects.filter(dataset_id=dataset_id).first()
+        if dataset is None:
+            return None, Response({"error": "Dataset not found"}, status=404)
+        if not can_edit_dataset(request.user, dataset):
+            return None, Response({"error": "You are not authorized to edit this dataset"}, status=403)
+        metadata = {}
+    else:
+        metadata, error = dataset_metadata(data)
+        if error is not None:
+            return None, error
+
+    try:
+        return start_upload_session(request.user, metadata, file_name, file_size, dataset=dataset, resumable=resumable), None
+    except UploadSessionError as e:
+        return None, Response({"error": str(e)}, status=400)
+    except Exception as e:
+        logger.error(f"Could not start upload session: {e}", exc_info=True)
+        return None, Response({"error": f"Could not start upload: {e}"}, status=500)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadSessionView(APIView):
+    """
+    Start a direct-to-storage upload (see ``uploads.py``).
+
+    The request carries ``fileName`` and ``fileSize``, and either the metadata of
+    a new dataset or the ``datasetId`` to append to. The response lists a
+    presigned URL per part; the browser PUTs each ``part_size`` slice of the file
+    to its URL and then calls the ``complete_url``.
+    """
+    renderer_classes = [JSONRenderer]
+    parser_classes = [JSONParser, FormParser, MultiPartParser]
+
+    @role_required(['organization_admin', 'contributor'])
+    def post(self, request):
+        session, error = open_upload_session(request, request.data, request.data.get('fileSize'))
+        if error is not None:
+            return error
+        return Response({
+            **session_payload(session),
+            "parts": part_urls(session),
+            "complete_url": f"/datasets/uploads/{session.session_id}/complete/",
+        }, status=201)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadSessionDetailView(APIView):
+    """
+    Show an upload session, with fresh part URLs while it is open, or abort it.
+    """
+    renderer_classes = [JSONRenderer]
+
+    @role_required(['organization_admin', 'contributor'])
+    def get(self, request, session_id):
+        session = UploadSession.objects.filter(session_id=session_id, user=request.user).first()
+        if session is None:
+            return Response({"error": "Upload session not found"}, status=404)
+        payload = session_payload(session)
+        if session.status == UploadSession.STATUS_OPEN:
+            payload["parts"] = part_urls(session)
+        return Response(payload, status=200)
+
+    @role_required(['organization_admin', 'contributor'])
+    def delete(self, request, session_id):
+        session = UploadSession.objects.filter(session_id=session_id, user=request.user).first()
+        if session is None:
+            return Response({"error": "Upload session not found"}, status=404)
+        if not abort_upload_session(session):
+            return Response({"error": f"Upload session is {session.status}"}, status=409)
+        return Response(status=204)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadSessionCompleteView(APIView):
+    """
+    Finish a direct-to-storage upload and queue it for ingestion.
+
+    ``parts`` lists ``{"part_number", "etag"}`` as MinIO returned them; without
+    it the uploaded parts are looked up in MinIO.
+    """
+    renderer_classes = [JSONRenderer]
+    parser_classes = [JSONParser]
+
+    @role_required(['organization_admin', 'contributor'])
+    def post(self, request, session_id):
+        session = UploadSession.objects.filter(session_id=session_id, user=request.user).first()
+        if session is None:
+            return Response({"error": "Upload session not found"}, status=404)
+        try:
+            job = complete_upload_session(session, request.data.get('parts'))
+        except UploadSessionError as e:
+            return Response({"error": str(e)}, status=409)
+        except Exception as e:
+            logger.error(f"Could not complete upload session {session_id}: {e}", exc_info=True)
+            return Response({"error": f"Upload failed: {e}"}, status=500)
+        return Response({
+            "message": "Dataset upload accepted",
+            "job_id": job.job_id,
+            "status_url": f"/datasets/ingest_jobs/{job.job_id}/",
+        }, status=202)
+
+
+TUS_VERSION = "1.0.0"
+
+
+def tus_headers(response, **headers):
+    """Add the ``Tus-Resumable`` header, and any others given as ``Upload_Offset=...``, to a response."""
+    response["Tus-Resumable"] = TUS_VERSION
+    for name, value in headers.items():
+        response[name.replace("_", "-")] = str(value)
+    return response
+
+
+def upload_metadata(header):
+    """
+    Decode a tus ``Upload-Metadata`` header: comma-separated ``key base64(value)`` pairs.
+    Returns:
+        dict: The decoded values; None for a malformed header.
+    """
+    metadata = {}
+    for pair in filter(None, (item.strip() for item in (header or "").split(","))):
+        key, _, value = pair.partition(" ")
+        try:
+            metadata[key] = base64.b64decode(value, validate=True).decode() if value else ""
+        except ValueError:
+            return None
+    return metadata
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ResumableUploadView(APIView):
+    """
+    Start a resumable upload sent through the API (see ``uploads.py``).
+
+    Follows tus creation: the size is the ``Upload-Length`` header and the fields
+    of ``UploadSessionView`` (``fileName`` or tus' ``filename``, the metadata or
+    ``datasetId``) come in ``Upload-Metadata``. The response ``Location`` is
+    where the chunks are sent, ``part_size`` bytes at a time.
+    """
+    renderer_classes = [JSONRenderer]
+
+    def options(self, request, *args, **kwargs):
+        return tus_headers(
+            Response(status=204),
+            Tus_Version=TUS_VERSION,
+            Tus_Extension="creation,checksum,termination",
+            Tus_Checksum_Algorithm=",".join(CHECKSUM_ALGORITHMS),
+            Tus_Max_Size=MAX_OBJECT_SIZE,
+        )
+
+    @role_required(['organization_admin', 'contributor'])
+    def post(self, request):
+        data = upload_metadata(request.headers.get('Upload-Metadata'))
+        if data is None:
+            return tus_headers(Response({"error": "Upload-Metadata is malformed"}, status=400))
+        data.setdefault('fileName', data.get('filename'))
+        session, error = open_upload_session(request, data, request.headers.get('Upload-Length'), resumable=True)
+        if error is not None:
+            return tus_headers(error)
+        location = f"/datasets/resumable/{session.session_id}/"
+        return tus_headers(Response({**session_payload(session), "location": location}, status=201), Location=location)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ResumableUploadDetailView(APIView):
+    """
+    Send, resume and abort a resumable upload.
+
+    ``HEAD`` gives the ``Upload-Offset`` to resume from; ``GET`` also lists the
+    chunks received, for clients that send several at once. ``PATCH`` sends the
+    chunk at ``Upload-Offset`` as ``application/offset+octet-stream``, with an
+    optional ``Upload-Checksum: <md5|sha1|sha256> <base64 digest>``. The chunk
+    that completes the file queues it for ingestion; its response carries the
+    job in ``Upload-Job-Id``.
+    """
+    renderer_classes = [JSONRenderer]
+
+    def _session(self, request, session_id):
+        return UploadSession.objects.filter(session_id=session_id, user=request.user).first()
+
+    def _not_found(self):
+        return tus_headers(Response({"error": "Upload session not found"}, status=404))
+
+    @role_required(['organization_admin', 'contributor'])
+    def head(self, request, session_id):
+        session = self._session(request, session_id)
+        if session is None:
+            return self._not_found()
+        offset = session.file_size if session.status == UploadSession.STATUS_COMPLETED else 0
+        if session.status == UploadSession.STATUS_OPEN:
+            offset = upload_offset(session, received_chunks(session))
+        response = tus_headers(Response(status=200), Upload_Offset=offset, Upload_Length=session.file_size)
+        response["Cache-Control"] = "no-store"
+        return response
+
+    @role_required(['organization_admin', 'contributor'])
+    def get(self, request, session_id):
+        session = self._session(request, session_id)
+        if session is None:
+            return self._not_found()
+        received = received_chunks(session) if session.status == UploadSession.STATUS_OPEN else []
+        offset = session.file_size if session.status == UploadSession.STATUS_COMPLETED else upload_offset(session, received)
+        return tus_headers(Response({**session_payload(session), "offset": offset, "received_chunks": received}, status=200))
+
+    @role_required(['organization_admin', 'contributor'])
+    def patch(self, request, session_id):
+        session = self._session(request, session_id)
+        if session is None:
+            return self._not_found()
+        if request.content_type != "application/offset+octet-stream":
+            return tus_headers(Response({"error": "Chunks must be sent as application/offset+octet-stream"}, status=415))
+        try:
+            offset = int(request.headers.get('Upload-Offset'))
+            length = int(request.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            return tus_headers(Response({"error": "Upload-Offset and Content-Length are required"}, status=400))
+        try:
+            offset, job = receive_chunk(session, offset, request.stream, length, request.headers.get('Upload-Checksum'))
+        except ChecksumMismatch as e:
+            return tus_headers(Response({"error": str(e)}, status=460))
+        except UploadSessionError as e:
+            return tus_headers(Response({"error": str(e)}, status=409))
+        except Exception as e:
+            logger.error(f"Could not store chunk of upload session {session_id}: {e}", exc_info=True)
+            return tus_headers(Response({"error": f"Upload failed: {e}"}, status=500))
+        response = tus_headers(Response(status=204), Upload_Offset=offset)
+        if job is not None:
+            tus_headers(response, Upload_Job_Id=job.job_id)
+        return response
+
+    @role_required(['organization_admin', 'contributor'])
+    def delete(self, request, session_id):
+        session = self._session(request, session_id)
+        if session is None:
+            return self._not_found()
+        if not abort_upload_session(session):
+            return tus_headers(Response({"error": f"Upload session is {session.status}"}, status=409))
+        return tus_headers(Response(status=204))
+
+
+class IngestionJobStatusView(APIView):
+    """
+    Report the status of a queued dataset upload.
+    """
+    renderer_classes = [JSONRenderer]
+
+    @role_required(['organization_admin', 'contributor'])
+    def get(self, request, job_id):
+        job = IngestionJob.objects.filter(job_id=job_id, user=request.user).first()
+        if job is None:
+            return Response({"error": "Ingestion job not found"}, status=404)
+        return Response(job_payload(job), status=200)
+
 @api_view(['GET'])
 @role_required(['organization_admin', 'contributor', 'researcher'])
 
@@ -426,14 +636,11 @@ def get_datasets(request):
 
 def fetch_dataset_from_minio(dataset_url):
     """Fetch dataset in chunks from MinIO and return a generator (iterator)."""
-    bucket_name = "alacrity"
-    object_name = dataset_url.split("/")[-1]
-
     try:
-        response = minio_client.get_object(bucket_name, object_name)
-        
+        data = storage.get_object(storage.object_key(dataset_url))
+
         # Read CSV in chunks of 10,000 rows to prevent memory issues
-        chunk_iterator = pd.read_csv(io.BytesIO(response.read()), chunksize=10000)
+        chunk_iterator = pd.read_csv(io.BytesIO(data), chunksize=10000)
         
         return chunk_iterator 
 
@@ -32,6 +32,9 @@ class Organization(models.Model):
     profile_picture = models.URLField(validators=[URLValidator], blank=True, null=True)
     cover_image = models.URLField(validators=[URLValidator], blank=True, null=True
     )
+    # resized copies of the images above, {size: {format: url}} (see ``alacrity_backend/images.py``)
+    profile_picture_variants = models.JSONField(default=dict, blank=True)
+    cover_image_variants = models.JSONField(default=dict, blank=True)
     date_joined = models.DateTimeField(auto_now_add=True, editable=False, null=True)
     social_links = models.JSONField(blank=True, null=True)
     field = models.CharField(max_length=100,blank=True, null=True)
@@ -1,11 +1,16 @@
 
 from rest_framework import serializers
+from alacrity_backend.images import KIND_AVATAR, KIND_COVER, ImageVariantsMixin
 from organisation.models import Organization
 from users.serializers import UserSerializer
 from django.db import transaction, IntegrityError
 from datasets.serializer import DatasetSerializer
 
-class OrganizationSerializer(serializers.ModelSerializer):
+class OrganizationSerializer(ImageVariantsMixin, serializers.ModelSerializer):
+    image_fields = {
+        "profile_picture": (KIND_AVATAR, "small", "large"),
+        "cover_image": (KIND_COVER, "medium", "large"),
+    }
     # Representation fields
     followers_count = serializers.SerializerMethodField()
     following_count = serializers.SerializerMethodField()
@@ -115,7 +120,9 @@ class OrganizationSerializer(serializers.ModelSerializer):
             ret['admin'] = UserSerializer(admin).data
         return ret
 
-class TopOrganizationSerializer(serializers.ModelSerializer):
+class TopOrganizationSerializer(ImageVariantsMixin, serializers.ModelSerializer):
+    image_fields = {"profile_picture": (KIND_AVATAR, "small", "medium")}
+
     class Meta:
         model = Organization
         fields = ['Organization_id','name', 'email', 'profile_picture']  # Only these fields are needed for top organizations
\ No newline at end of file
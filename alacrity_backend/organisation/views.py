@@ -25,8 +25,7 @@ from .serializer import OrganizationSerializer , TopOrganizationSerializer
 from datasets.models import Dataset
 from datasets.serializer import DatasetSerializer
 from rest_framework.parsers import MultiPartParser, FormParser
-from minio import Minio
-from alacrity_backend.settings import MINIO_ACCESS_KEY , MINIO_SECRET_KEY, MINIO_BUCKET_NAME, MINIO_URL, MINIO_SECURE
+from alacrity_backend.images import KIND_AVATAR, KIND_COVER, schedule_variants, store_original
 import uuid
 from django.db.models import Q
 from dataset_requests.models import DatasetRequest
@@ -35,14 +34,6 @@ from users.serializers import UserSerializer
 from datasets.models import Dataset , ViewHistory
 from django.db.models import F, ExpressionWrapper, DurationField, Sum
 
-minio_client = Minio(
-        endpoint=MINIO_URL,
-        access_key=MINIO_ACCESS_KEY,
-        secret_key=MINIO_SECRET_KEY,
-        secure=MINIO_SECURE
-
-    )
-
 
 
 
@@ -322,32 +313,20 @@ class OrganizationProfileView(APIView):
                     return Response({"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN)
 
 
+                # the resized images are made in the background once the organisation is saved
+                images = []
                 if 'profile_picture' in request.FILES:
-                    file_obj = request.FILES['profile_picture']
-                    file_extension = file_obj.name.split('.')[-1]
-                    file_name = f"profile_pictures/{org_id}/profile_picture.{file_extension}"
-                    minio_client.put_object(
-                        MINIO_BUCKET_NAME,
-                        file_name,
-                        file_obj,
-                        length=file_obj.size,
-                        content_type=file_obj.content_type
+                    organization.profile_picture, image = store_original(
+                        f"profile_pictures/{org_id}", request.FILES['profile_picture'],
                     )
-                    url = f"http://{MINIO_URL}/{MINIO_BUCKET_NAME}/{file_name}"
-                    organization.profile_picture = url
+                    organization.profile_picture_variants = {}
+                    images.append(('profile_picture', image, KIND_AVATAR))
                 if 'cover_image' in request.FILES:
-                    file_obj = request.FILES['cover_image']
-                    file_extension = file_obj.name.split('.')[-1]
-                    file_name = f"profile_pictures/cover/{org_id}/cover_image.{file_extension}"
-                    minio_client.put_object(
-                        MINIO_BUCKET_NAME,
-                        file_name,
-                        file_obj,
-                        length=file_obj.size,
-                        content_type=file_obj.content_type
+                    organization.cover_image, image = store_original(
+                        f"profile_pictures/cover/{org_id}", request.FILES['cover_image'],
                     )
-                    url = f"http://{MINIO_URL}/{MINIO_BUCKET_NAME}/{file_name}"
-                    organization.cover_image = url
+                    organization.cover_image_variants = {}
+                    images.append(('cover_image', image, KIND_COVER))
 
                 data = request.data.copy()
                 data.pop('profile_picture', None)
@@ -363,6 +342,8 @@ class OrganizationProfileView(APIView):
                 if serializer.is_valid():
 
                     serializer.save()
+                    for field, image, kind in images:
+                        schedule_variants(organization, field, f"{field}_variants", image, kind)
                     return Response(serializer.data, status=status.HTTP_200_OK)
                 print(f"Serializer errors: {serializer.errors}")
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
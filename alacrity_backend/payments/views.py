@@ -11,6 +11,7 @@ from django.contrib.auth import get_user_model
 User = get_user_model()
 from users.decorators import role_required
 from datasets.models import Dataset
+from datasets.prefetch import schedule_prefetch
 from dataset_requests.models import DatasetRequest
 from payments.models import DatasetPurchase, PendingPayment
 from django.db.models.functions import ExtractYear, ExtractMonth
@@ -123,6 +124,8 @@ def paypal_success(request):
             dataset=dataset,
             buyer=user
         )
+        # load it before the buyer opens it
+        schedule_prefetch([dataset.dataset_id], "purchased")
 
         # Optionally delete the pending payment record
         pending.delete()
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+
+from alacrity_backend import storage
+from alacrity_backend.images import KIND_AVATAR, KIND_COVER, process_image
+from organisation.models import Organization
+from users.models import User
+
+
+# model, image field, kind
+IMAGE_FIELDS = [
+    (User, 'profile_picture', KIND_AVATAR),
+    (Organization, 'profile_picture', KIND_AVATAR),
+    (Organization, 'cover_image', KIND_COVER),
+]
+
+
+class Command(BaseCommand):
+    help = "Create the resized WebP/AVIF variants of profile pictures and organisation images that have none."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Also recreate variants that already exist")
+        parser.add_argument('--limit', type=int, help="Stop after processing this many images")
+
+    def handle(self, *args, **options):
+        processed = failed = 0
+        for model, field, kind in IMAGE_FIELDS:
+            variants_field = f"{field}_variants"
+            rows = model.objects.exclude(**{f"{field}__isnull": True}).exclude(**{field: ''})
+            if not options['all']:
+                rows = rows.filter(**{variants_field: {}})
+            for pk, url in rows.values_list('pk', field):
+                if options['limit'] is not None and processed >= options['limit']:
+                    break
+                try:
+                    variants = process_image(storage.get_object(storage.object_key(url)), kind)
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"Could not process {url}: {e}")
+                    continue
+                model.objects.filter(pk=pk, **{field: url}).update(**{variants_field: variants})
+                processed += 1
+                self.stdout.write(f"processed {model.__name__} {pk} {field}")
+
+        self.stdout.write(self.style.SUCCESS(f"Processed {processed} image(s), {failed} failed"))
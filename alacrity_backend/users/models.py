@@ -52,6 +52,8 @@ class User(AbstractUser):
     
    
     profile_picture = models.URLField(blank=True, null=True)
+    # resized copies of profile_picture, {size: {format: url}} (see ``alacrity_backend/images.py``)
+    profile_picture_variants = models.JSONField(default=dict, blank=True)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'role']
@@ -1,6 +1,7 @@
 
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from alacrity_backend.images import KIND_AVATAR, ImageVariantsMixin, variant_url
 from django.contrib.auth.password_validation import validate_password
 from organisation.models import Organization
 from research.models import AnalysisSubmission
@@ -13,7 +14,8 @@ class AnalysisSubmissionSerializer(serializers.ModelSerializer):
         model = AnalysisSubmission
         fields = ["id", "title", "description", "status", "submitted_at", "is_private"]
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(ImageVariantsMixin, serializers.ModelSerializer):
+    image_fields = {"profile_picture": (KIND_AVATAR, "small", "large")}
     email = serializers.EmailField(required=True)
     password = serializers.CharField(
         write_only=True,
@@ -192,7 +194,8 @@ class UserSerializer(serializers.ModelSerializer):
         ret.pop("organization_name", None)
         return ret
 
-class TopResearcherSerializer(serializers.ModelSerializer):
+class TopResearcherSerializer(ImageVariantsMixin, serializers.ModelSerializer):
+    image_fields = {"profile_picture": (KIND_AVATAR, "small", "medium")}
     followers_count = serializers.IntegerField(read_only=True)
     class Meta:
         model = User
@@ -205,8 +208,12 @@ class MessageSerializer(serializers.ModelSerializer):
     timestamp = serializers.DateTimeField(source='created_at')
     sender_first_name = serializers.CharField(source='sender.first_name')
     sender_last_name = serializers.CharField(source='sender.last_name')
-    sender_profile_picture = serializers.ImageField(source='sender.profile_picture', allow_null=True)
+    sender_profile_picture = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ['message_id', 'sender_id', 'content', 'timestamp', 'sender_first_name', 'sender_last_name', 'sender_profile_picture']
\ No newline at end of file
+        fields = ['message_id', 'sender_id', 'content', 'timestamp', 'sender_first_name', 'sender_last_name', 'sender_profile_picture']
+
+    def get_sender_profile_picture(self, obj):
+        # chat avatars are the smallest size
+        return variant_url(obj.sender.profile_picture, obj.sender.profile_picture_variants, KIND_AVATAR, "thumb")
\ No newline at end of file
@@ -196,6 +196,12 @@ from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework_simplejwt.tokens import RefreshToken
 from unittest.mock import patch, MagicMock
 from organisation.models import Organization  
+import io
+from django.core.files.uploadedfile import SimpleUploadedFile
+from PIL import Image
+from alacrity_backend import images, storage
+from alacrity_backend.images import KIND_AVATAR, render_variants, variant_url
+from .serializers import UserSerializer
 
 User = get_user_model()
 
@@ -448,11 +454,10 @@ class ProfilePictureUpdateViewTests(BaseTestCase):
         mock_file.content_type = 'image/png'
         mock_file.size = 1024
         
-        # Setup mock for minioClient
-        with patch('users.views.minioClient') as mock_minio:
-            with patch('users.views.MINIO_SECURE', False), \
-                 patch('users.views.MINIO_URL', 'minio.example.com'), \
-                 patch('users.views.MINIO_BUCKET_NAME', 'test-bucket'):
+        # Setup mock for the storage client
+        with patch('alacrity_backend.storage.client') as mock_minio:
+            with patch('alacrity_backend.storage.MINIO_SECURE', False), \
+                 patch('alacrity_backend.storage.MINIO_URL', 'minio.example.com'):
                 
                 # Make the request
                 response = self.client.post(
@@ -463,8 +468,99 @@ class ProfilePictureUpdateViewTests(BaseTestCase):
                 self.assertIn('profile_picture', response.json())
                 mock_minio.put_object.assert_called_once()
                 args, kwargs = mock_minio.put_object.call_args
-                self.assertEqual(args[0], 'alacrity')
-                self.assertTrue(args[1].startswith('profile_pictures/'))
+                self.assertEqual(kwargs['bucket_name'], 'alacrity')
+                self.assertTrue(kwargs['object_name'].startswith('profile_pictures/'))
+                self.assertTrue(response.json()['profile_picture'].startswith('http://minio.example.com/alacrity/'))
+
+
+class ImageVariantTests(BaseTestCase):
+    """Tests for the resized WebP/AVIF copies of uploaded images."""
+
+    def setUp(self):
+        super().setUp()
+        self.stored = {}
+
+        def put_object(bucket_name, object_name, data, length=-1, part_size=0, content_type=None, metadata=None):
+            self.stored[object_name] = (data.read(), content_type, metadata)
+            return MagicMock()
+
+        patcher = patch('alacrity_backend.storage.client', MagicMock(put_object=MagicMock(side_effect=put_object)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def png(self, size=(800, 600)):
+        out = io.BytesIO()
+        Image.new('RGB', size, (200, 40, 40)).save(out, format='PNG')
+        return out.getvalue()
+
+    def test_avatars_are_square_and_never_upscaled(self):
+        variants = render_variants(self.png((300, 200)), KIND_AVATAR)
+        self.assertEqual(list(variants), ['thumb', 'small', 'medium', 'large'])
+        for size, side in [('thumb', 64), ('medium', 200), ('large', 200)]:
+            for image_format in ('webp', 'avif'):
+                with Image.open(io.BytesIO(variants[size][image_format])) as image:
+                    self.assertEqual(image.format, image_format.upper())
+                    self.assertEqual(image.size, (side, side))
+
+    def test_upload_stores_content_addressed_variants(self):
+        """The variants are written under immutable keys and serializers pick the size for the context."""
+        self.authenticate_user(self.admin_user)
+        picture = SimpleUploadedFile('me.png', self.png(), content_type='image/png')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/users/profile_pic_update/', {'profile_picture': picture})
+        self.assertEqual(response.status_code, 200)
+
+        self.admin_user.refresh_from_db()
+        variants = self.admin_user.profile_picture_variants
+        self.assertEqual(set(variants['thumb']), {'webp', 'avif'})
+        key = storage.object_key(variants['large']['avif'])
+        self.assertRegex(key, r'^images/[0-9a-f]{64}/large\.avif$')
+        data, content_type, metadata = self.stored[key]
+        self.assertEqual(content_type, 'image/avif')
+        self.assertIn('immutable', metadata['Cache-Control'])
+        self.assertEqual(len(self.stored), 1 + 4 * 2)
+
+        self.assertEqual(UserSerializer(self.admin_user).data['profile_picture'], variants['large']['webp'])
+        listed = UserSerializer([self.admin_user], many=True).data[0]
+        self.assertEqual(listed['profile_picture'], variants['small']['webp'])
+        self.assertEqual(listed['profile_picture_variants'], variants)
+        thumb = UserSerializer(self.admin_user, context={'image_size': 'thumb'}).data
+        self.assertEqual(thumb['profile_picture'], variants['thumb']['webp'])
+
+    def test_formats_pillow_cannot_write_are_skipped(self):
+        with patch('alacrity_backend.images.features.check', side_effect=lambda feature: feature != 'avif'):
+            variants = render_variants(self.png((300, 200)), KIND_AVATAR)
+        self.assertEqual(list(variants), ['thumb', 'small', 'medium', 'large'])
+        self.assertEqual({image_format for formats in variants.values() for image_format in formats}, {'webp'})
+
+    def test_a_failed_variant_does_not_lose_the_others(self):
+        encode = images._encode
+
+        def failing_encode(image, image_format):
+            if image_format == 'avif' and image.width == 64:
+                raise OSError("encoder error")
+            return encode(image, image_format)
+
+        with patch('alacrity_backend.images._encode', side_effect=failing_encode):
+            variants = render_variants(self.png((300, 200)), KIND_AVATAR)
+        self.assertEqual(set(variants['thumb']), {'webp'})
+        self.assertEqual(set(variants['large']), {'webp', 'avif'})
+
+    def test_images_without_variants_fall_back_to_the_original(self):
+        self.admin_user.profile_picture = 'http://minio.example.com/alacrity/profile_pictures/1/old.png'
+        self.assertEqual(UserSerializer(self.admin_user).data['profile_picture'], self.admin_user.profile_picture)
+        self.assertEqual(variant_url('orig', {'small': {'webp': 'small'}}, KIND_AVATAR, 'large'), 'small')
+        self.assertEqual(variant_url('orig', {'large': {'webp': 'large'}}, KIND_AVATAR, 'thumb'), 'large')
+
+    def test_unreadable_images_keep_the_original(self):
+        self.authenticate_user(self.admin_user)
+        picture = SimpleUploadedFile('me.png', b'not an image', content_type='image/png')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/users/profile_pic_update/', {'profile_picture': picture})
+        self.assertEqual(response.status_code, 200)
+        self.admin_user.refresh_from_db()
+        self.assertEqual(self.admin_user.profile_picture_variants, {})
+        self.assertEqual(len(self.stored), 1)
 
 
 class LogoutViewTests(BaseTestCase):
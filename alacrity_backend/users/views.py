@@ -43,8 +43,8 @@ from django.core.mail import send_mail
 from django.conf import settings
 from django.contrib.auth import get_user_model
 User = get_user_model()
-from alacrity_backend.settings import MINIO_URL, MINIO_ACCESS_KEY, MINIO_SECRET_KEY, MINIO_BUCKET_NAME, MINIO_SECURE
-from minio import Minio, S3Error
+from alacrity_backend.images import KIND_AVATAR, schedule_variants, store_original
+from minio import S3Error
 
 from rest_framework import status
 from  notifications.models import Notification
@@ -54,14 +54,6 @@ from organisation.serializer import OrganizationSerializer
 from organisation.models import Organization 
 
 
-
-minioClient = Minio(
-    MINIO_URL,
-    access_key=MINIO_ACCESS_KEY,
-    secret_key=MINIO_SECRET_KEY,
-    secure=False
-)
-
 class ChangePasswordView(APIView):
     """
     Logged in user can change their password and receive a confirmation email.
@@ -685,22 +677,11 @@ class ProfilePictureUpdateView(APIView):
             return Response({"detail": "Only image files are allowed"}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            file_extension = profile_picture.name.split('.')[-1] if '.' in profile_picture.name else 'png'
-            object_name = f"profile_pictures/{user.id}/profile_picture.{file_extension}"
-
-            minioClient.put_object(
-                settings.MINIO_BUCKET_NAME,
-                object_name,
-                profile_picture.file,
-                length=profile_picture.size,
-                content_type=profile_picture.content_type
-            )
-
-            if MINIO_SECURE:
-                user.profile_picture = f"https://{MINIO_URL}/{MINIO_BUCKET_NAME}/{object_name}"
-            else:
-                user.profile_picture = f"http://{MINIO_URL}/{MINIO_BUCKET_NAME}/{object_name}"
+            user.profile_picture, data = store_original(f"profile_pictures/{user.id}", profile_picture)
+            user.profile_picture_variants = {}
             user.save()
+            # the resized avatars are made in the background; until then readers get the original
+            schedule_variants(user, 'profile_picture', 'profile_picture_variants', data, KIND_AVATAR)
             return Response({"profile_picture": user.profile_picture}, status=status.HTTP_200_OK)
 
         except S3Error as e: